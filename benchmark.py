@@ -0,0 +1,476 @@
+"""
+Benchmark do diagnóstico de divergências com dados sintéticos.
+
+Gera as tabelas dos quatro bancos (tb_usuario, users, segurado, pessoa/contato) com
+tamanho e taxa de divergência configuráveis, carrega num PostgreSQL local (com dblink)
+e mede cada etapa do main() em separado: busca de divergências, lookups de segurado
+e e-mails, classificação e exportação. O resultado vai para um JSON, que pode ser
+comparado com o de uma execução anterior para detectar regressões.
+
+Uso:
+    python benchmark.py --usuarios 100000 --taxa-divergencia 0.05
+    python benchmark.py --sem-carga --repeticoes 3 --comparar resultados_benchmark/anterior.json
+    python benchmark.py --offline --usuarios 1000000   # só classificação e exportação, sem banco
+
+Conexão com o PostgreSQL local: BENCH_PG_HOST, BENCH_PG_PORT, BENCH_PG_USER e BENCH_PG_PASS
+(padrão localhost:5432, usuário postgres). O usuário precisa poder criar bancos e roles.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import main as diagnostico
+
+# Bancos criados no PostgreSQL local (o ACCOUNTS usa o mesmo nome para banco e usuário,
+# como DB_ACCOUNTS_NAME_USER no .env)
+BANCOS_BENCH = {
+    'GESTÃO': 'bench_gestao',
+    'CONTRATO': 'bench_contrato',
+    'PESSOA': 'bench_pessoa',
+    'ACCOUNTS': 'bench_accounts'
+}
+SENHA_ACCOUNTS_BENCH = 'bench_accounts'
+
+DDL_BENCH = {
+    'GESTÃO': [
+        "CREATE EXTENSION IF NOT EXISTS dblink",
+        # sso_id com o mesmo tipo de users.id: a query de produção compara os dois sem cast
+        "CREATE TABLE tb_usuario (id serial PRIMARY KEY, sso_id uuid, cpf_cnpj varchar(255))",
+        "CREATE TABLE bench_meta (chave text PRIMARY KEY, valor text)"
+    ],
+    'ACCOUNTS': ["CREATE TABLE users (id uuid PRIMARY KEY, cpf_cnpj varchar(255))"],
+    'CONTRATO': ["CREATE TABLE segurado (id serial PRIMARY KEY, cpf_cnpj varchar(255))"],
+    'PESSOA': [
+        "CREATE TABLE pessoa (id integer PRIMARY KEY, cpf_cnpj varchar(255))",
+        "CREATE TABLE contato (id serial PRIMARY KEY, pessoa_id integer, tipo varchar(20), valor varchar(255))"
+    ]
+}
+
+# Destino (banco, tabela, colunas) de cada conjunto gerado
+CARGAS_BENCH = {
+    'tb_usuario': ('GESTÃO', 'tb_usuario', ['sso_id', 'cpf_cnpj']),
+    'users': ('ACCOUNTS', 'users', ['id', 'cpf_cnpj']),
+    'segurado': ('CONTRATO', 'segurado', ['cpf_cnpj']),
+    'pessoa': ('PESSOA', 'pessoa', ['id', 'cpf_cnpj']),
+    'contato': ('PESSOA', 'contato', ['pessoa_id', 'tipo', 'valor'])
+}
+
+# --- GERADOR DE DADOS SINTÉTICOS ---
+def gerar_cpf(rng, formatado, valido=True):
+    """CPF aleatório de 11 dígitos, com ou sem máscara; com `valido`, com dígitos verificadores corretos."""
+    if not valido:
+        cpf = f"{rng.randrange(10**11):011d}"
+    else:
+        pesos_1, pesos_2 = diagnostico.PESOS_DOCUMENTO[11]
+        cpf = f"{rng.randrange(10**9):09d}"
+        cpf += str(diagnostico.digito_verificador(cpf.encode(), pesos_1))
+        cpf += str(diagnostico.digito_verificador(cpf.encode(), pesos_2))
+    return diagnostico.formatar_cpf(cpf) if formatado else cpf
+
+def gerar_dados_sinteticos(num_usuarios, taxa_divergencia, seed=42,
+                           taxa_segurado=0.8, taxa_email=0.9, taxa_email_duplicado=0.4,
+                           taxa_documento_invalido=0.05):
+    """
+    Gera os conjuntos das cinco tabelas. Cada usuário existe em tb_usuario e em users;
+    uma fração `taxa_divergencia` tem CPFs diferentes entre os dois (os demais só mudam
+    a máscara). Os CPFs entram em segurado com probabilidade `taxa_segurado` e em pessoa
+    com e-mail com probabilidade `taxa_email`; nas divergências, `taxa_email_duplicado`
+    das duplas recebe o mesmo e-mail nos dois CPFs. Uma fração `taxa_documento_invalido`
+    dos CPFs divergentes do ACCOUNTS sai com dígitos verificadores aleatórios.
+
+    Returns:
+        dict { 'tb_usuario' | 'users' | 'segurado' | 'pessoa' | 'contato': [tuplas] }
+    """
+    rng = random.Random(seed)
+    dados = {nome: [] for nome in CARGAS_BENCH}
+    pessoa_id = 0
+
+    def registrar_pessoa(cpf, email):
+        nonlocal pessoa_id
+        pessoa_id += 1
+        dados['pessoa'].append((pessoa_id, cpf))
+        if email:
+            dados['contato'].append((pessoa_id, 'EMAIL', email))
+
+    for i in range(num_usuarios):
+        sso_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        cpf_gestao = gerar_cpf(rng, formatado=rng.random() < 0.5)
+        diverge = rng.random() < taxa_divergencia
+        cpf_accounts = (
+            gerar_cpf(rng, formatado=True, valido=rng.random() >= taxa_documento_invalido)
+            if diverge else diagnostico.formatar_cpf(cpf_gestao)
+        )
+
+        dados['tb_usuario'].append((sso_id, cpf_gestao))
+        dados['users'].append((sso_id, cpf_accounts))
+
+        email_gestao = f"usuario{i}@exemplo.com.br" if rng.random() < taxa_email else None
+        if diverge:
+            email_accounts = email_gestao if rng.random() < taxa_email_duplicado else (
+                f"usuario{i}.acc@exemplo.com.br" if rng.random() < taxa_email else None
+            )
+            for cpf, email in [(cpf_gestao, email_gestao), (cpf_accounts, email_accounts)]:
+                if rng.random() < taxa_segurado:
+                    dados['segurado'].append((cpf,))
+                registrar_pessoa(cpf, email)
+        else:
+            if rng.random() < taxa_segurado:
+                dados['segurado'].append((cpf_gestao,))
+            registrar_pessoa(cpf_gestao, email_gestao)
+
+    return dados
+
+# --- CARGA NO POSTGRESQL LOCAL ---
+def config_pg_local(args, banco):
+    """Configuração psycopg2 de um banco do benchmark no PostgreSQL local."""
+    return {
+        'host': args.pg_host,
+        'port': args.pg_port,
+        'database': banco,
+        'user': args.pg_user,
+        'password': args.pg_senha
+    }
+
+def copiar_tuplas(cur, tabela, colunas, tuplas):
+    """Carrega as tuplas via COPY FROM STDIN (CSV)."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(tuplas)
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {tabela} ({', '.join(colunas)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def carregar_banco_local(args, dados, parametros):
+    """
+    Recria os bancos do benchmark, carrega os dados sintéticos e, com `args.com_indices`,
+    cria os índices de CPF normalizado do modo prepare.
+    """
+    import psycopg2
+
+    admin = psycopg2.connect(**config_pg_local(args, 'postgres'))
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute("SELECT 1 FROM pg_roles WHERE rolname = %s", (BANCOS_BENCH['ACCOUNTS'],))
+    if not cur.fetchone():
+        cur.execute(f"CREATE ROLE {BANCOS_BENCH['ACCOUNTS']} LOGIN PASSWORD %s", (SENHA_ACCOUNTS_BENCH,))
+    for rotulo, banco in BANCOS_BENCH.items():
+        cur.execute(f"DROP DATABASE IF EXISTS {banco}")
+        dono = f" OWNER {BANCOS_BENCH['ACCOUNTS']}" if rotulo == 'ACCOUNTS' else ''
+        cur.execute(f"CREATE DATABASE {banco}{dono}")
+    admin.close()
+
+    for rotulo, banco in BANCOS_BENCH.items():
+        config = config_pg_local(args, banco)
+        if rotulo == 'ACCOUNTS':
+            config.update(user=BANCOS_BENCH['ACCOUNTS'], password=SENHA_ACCOUNTS_BENCH)
+        conn = psycopg2.connect(**config)
+        cur = conn.cursor()
+        for ddl in DDL_BENCH[rotulo]:
+            cur.execute(ddl)
+        for nome, (destino, tabela, colunas) in CARGAS_BENCH.items():
+            if destino == rotulo:
+                copiar_tuplas(cur, tabela, colunas, dados[nome])
+        if rotulo == 'GESTÃO':
+            cur.executemany("INSERT INTO bench_meta VALUES (%s, %s)",
+                            [(chave, json.dumps(valor)) for chave, valor in parametros.items()])
+        conn.commit()
+
+        if args.com_indices:
+            conn.autocommit = True  # CREATE INDEX CONCURRENTLY não roda em transação
+            for rotulo_indice, tabela, nome_indice in diagnostico.INDICES_CPF:
+                if rotulo_indice == rotulo:
+                    cur.execute(diagnostico.ddl_indice_cpf(tabela, nome_indice))
+        conn.autocommit = True
+        cur.execute("ANALYZE")
+        conn.close()
+
+def ler_parametros_carregados(args):
+    """Parâmetros da última carga (tabela bench_meta do banco GESTÃO)."""
+    import psycopg2
+
+    conn = psycopg2.connect(**config_pg_local(args, BANCOS_BENCH['GESTÃO']))
+    cur = conn.cursor()
+    cur.execute("SELECT chave, valor FROM bench_meta")
+    parametros = {chave: json.loads(valor) for chave, valor in cur.fetchall()}
+    conn.close()
+    return parametros
+
+# --- MEDIÇÃO ---
+def medir(etapas, nome, funcao, *args, **kwargs):
+    """Executa `funcao` e acumula o tempo (s) da execução na etapa `nome`."""
+    inicio = time.perf_counter()
+    resultado = funcao(*args, **kwargs)
+    etapas.setdefault(nome, []).append(time.perf_counter() - inicio)
+    return resultado
+
+def montar_relatorios(listas):
+    """Relatórios no formato usado pelo main() para a exportação."""
+    return {
+        nome_aba: (listas[chave], diagnostico.CABECALHO_RELATORIO)
+        for chave, nome_aba in diagnostico.ABAS_RELATORIO.items()
+    }
+
+def medir_exportacao_excel(etapas, nome, funcao, relatorios, caminho):
+    """
+    Mede um writer de Excel. Os writers só avisam (ou, com silent, engolem) as falhas:
+    o arquivo é apagado antes e conferido depois, para não registrar o tempo de uma falha.
+    """
+    if os.path.exists(caminho):
+        os.remove(caminho)
+    medir(etapas, nome, funcao, relatorios, caminho, silent=True)
+    if not os.path.exists(caminho):
+        etapas[nome].pop()
+        raise RuntimeError(f"{nome}: o arquivo {caminho} não foi gerado")
+
+def medir_exportacoes(etapas, listas, formatos, diretorio):
+    """Mede a exportação das listas classificadas em cada formato pedido."""
+    relatorios = montar_relatorios(listas)
+    for formato in formatos:
+        if formato == 'xlsx':
+            medir_exportacao_excel(etapas, 'exportacao_xlsx', diagnostico.salvar_excel_consolidado,
+                                   relatorios, os.path.join(diretorio, 'bench.xlsx'))
+        elif formato == 'xlsx_streaming':
+            medir_exportacao_excel(etapas, 'exportacao_xlsx_streaming', diagnostico.salvar_excel_streaming,
+                                   relatorios, os.path.join(diretorio, 'bench_streaming.xlsx'))
+        else:
+            def exportar_em_lote():
+                categorias = {chave: (nome_aba, diagnostico.CABECALHO_RELATORIO)
+                              for chave, nome_aba in diagnostico.ABAS_RELATORIO.items()}
+                saida = diagnostico.abrir_saida_em_lote(formato, os.path.join(diretorio, 'bench'), categorias)
+                # Cópia: descarregar esvazia as listas, que ainda servem aos próximos formatos
+                diagnostico.descarregar_listas_na_saida({k: list(v) for k, v in listas.items()}, saida)
+                diagnostico.fechar_saida_em_lote(saida, silent=True)
+            medir(etapas, f'exportacao_{formato}', exportar_em_lote)
+
+def nova_listas():
+    """Listas de classificação vazias, como no main()."""
+    return {chave: [] for chave in diagnostico.ABAS_RELATORIO}
+
+def executar_rodada_banco(args, opcoes, etapas, diretorio):
+    """Uma rodada das etapas 1 a 4 contra o PostgreSQL local, mais as exportações."""
+    db_accounts = config_pg_local(args, BANCOS_BENCH['ACCOUNTS'])
+    db_accounts.update(user=BANCOS_BENCH['ACCOUNTS'], password=SENHA_ACCOUNTS_BENCH)
+
+    inicio = time.perf_counter()
+    conexoes, erros = diagnostico.conectar_bancos({
+        rotulo: config_pg_local(args, BANCOS_BENCH[rotulo]) for rotulo in ['GESTÃO', 'CONTRATO', 'PESSOA']
+    })
+    etapas.setdefault('conexoes', []).append(time.perf_counter() - inicio)
+    if erros:
+        diagnostico.fechar_conexoes(conexoes)
+        rotulo, erro = next(iter(erros.items()))
+        raise RuntimeError(f"falha ao conectar no banco {rotulo}: {erro}")
+
+    try:
+        # dblink roda no servidor: o ACCOUNTS é o próprio PostgreSQL local, na porta do servidor
+        cur = conexoes['GESTÃO'].cursor()
+        cur.execute("SHOW port")
+        url_accounts = f"127.0.0.1 port={cur.fetchone()[0]}"
+        cur.close()
+        sql_base = diagnostico.montar_sql_divergencias(
+            url_accounts, BANCOS_BENCH['ACCOUNTS'], SENHA_ACCOUNTS_BENCH,
+            estrategia=opcoes['estrategia_accounts'], tamanho_bloco=opcoes['tamanho_bloco_accounts']
+        )
+
+        def buscar_divergencias():
+            divergencias = []
+            for lote in diagnostico.gerar_lotes_divergencias(conexoes['GESTÃO'], db_accounts, sql_base, opcoes):
+                divergencias.extend(lote)
+            conexoes['GESTÃO'].commit()  # encerra a transação do cursor nomeado
+            return divergencias
+
+        divergencias = medir(etapas, '1_divergencias', buscar_divergencias)
+        cpfs = diagnostico.coletar_cpfs(divergencias)
+        segurados = medir(etapas, '2_lookup_segurado', diagnostico.consultar_segurados, conexoes['CONTRATO'], cpfs, opcoes)
+        mapa_emails = medir(etapas, '3_lookup_emails', diagnostico.consultar_emails, conexoes['PESSOA'], cpfs, opcoes)
+        listas = nova_listas()
+        medir(etapas, '4_classificacao', diagnostico.classificar_lote, divergencias, segurados, mapa_emails, listas, opcoes)
+    finally:
+        diagnostico.fechar_conexoes(conexoes)
+
+    medir_exportacoes(etapas, listas, args.formatos, diretorio)
+    return len(divergencias), {chave: len(lista) for chave, lista in listas.items()}
+
+def executar_rodada_offline(dados, opcoes, etapas, diretorio, formatos):
+    """
+    Uma rodada sem banco: as divergências, o set de segurados e o mapa de e-mails saem
+    direto dos dados sintéticos; mede só a classificação e as exportações.
+    """
+    limpar = diagnostico.limpar_cpf
+    divergencias = [
+        diagnostico.Divergencia(sso_id, cpf_acc, cpf_ges, limpar(cpf_acc), limpar(cpf_ges))
+        for (sso_id, cpf_ges), (_, cpf_acc) in zip(dados['tb_usuario'], dados['users'])
+        if limpar(cpf_acc) != limpar(cpf_ges)
+    ]
+    segurados = {limpar(cpf) for (cpf,) in dados['segurado']}
+    cpf_por_pessoa = dict(dados['pessoa'])
+    mapa_emails = {limpar(cpf_por_pessoa[pessoa_id]): email.strip() for pessoa_id, _, email in dados['contato']}
+
+    listas = nova_listas()
+    medir(etapas, '4_classificacao', diagnostico.classificar_lote, divergencias, segurados, mapa_emails, listas, opcoes)
+    medir_exportacoes(etapas, listas, formatos, diretorio)
+    return len(divergencias), {chave: len(lista) for chave, lista in listas.items()}
+
+# --- RESULTADO E COMPARAÇÃO ---
+def versao_codigo():
+    """Commit atual do repositório (ou 'desconhecida' fora de um checkout git)."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except Exception:
+        return 'desconhecida'
+
+def resumir_etapas(etapas):
+    """Tempos de cada etapa: todas as repetições, mínimo e mediana."""
+    return {
+        nome: {
+            'segundos': [round(t, 4) for t in tempos],
+            'minimo': round(min(tempos), 4),
+            'mediana': round(statistics.median(tempos), 4)
+        }
+        for nome, tempos in etapas.items()
+    }
+
+def comparar_resultados(atual, anterior, limiar):
+    """
+    Compara a mediana de cada etapa com a execução anterior.
+
+    Returns:
+        lista de etapas que ficaram mais lentas que `limiar` (fração, ex.: 0.10 = 10%)
+    """
+    regressoes = []
+    print(f"\n📈 Comparação com {anterior.get('versao', '?')} ({anterior.get('data', '?')}):")
+    for nome, medida in atual['etapas'].items():
+        if nome not in anterior.get('etapas', {}):
+            print(f"   {nome:<28} {medida['mediana']:>9.3f}s   (nova etapa)")
+            continue
+        base = anterior['etapas'][nome]['mediana']
+        variacao = (medida['mediana'] - base) / base if base else 0.0
+        marcador = '⚠️ ' if variacao > limiar else '  '
+        print(f"{marcador} {nome:<28} {base:>9.3f}s -> {medida['mediana']:>9.3f}s ({variacao:+.1%})")
+        if variacao > limiar:
+            regressoes.append(nome)
+    return regressoes
+
+def parse_argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do diagnóstico de divergências com dados sintéticos.")
+    parser.add_argument('--usuarios', type=int, default=100000, help="usuários gerados (padrão: 100000)")
+    parser.add_argument('--taxa-divergencia', type=float, default=0.05,
+                        help="fração dos usuários com CPF divergente (padrão: 0.05)")
+    parser.add_argument('--seed', type=int, default=42, help="semente do gerador (padrão: 42)")
+    parser.add_argument('--sem-carga', action='store_true', help="reaproveita os dados já carregados no banco")
+    parser.add_argument('--com-indices', action='store_true', help="cria os índices de CPF normalizado na carga")
+    parser.add_argument('--offline', action='store_true',
+                        help="sem banco: mede só a classificação e as exportações sobre os dados gerados")
+    parser.add_argument('--repeticoes', type=int, default=1, choices=range(1, 101), metavar='N',
+                        help="rodadas medidas, de 1 a 100 (padrão: 1)")
+    parser.add_argument('--formatos', nargs='*', default=['xlsx', 'xlsx_streaming', 'csv.gz'],
+                        choices=['xlsx', 'xlsx_streaming'] + diagnostico.FORMATOS_EM_LOTE,
+                        help="exportações medidas (padrão: xlsx xlsx_streaming csv.gz)")
+    parser.add_argument('--opcao', action='append', default=[], metavar='CHAVE=VALOR',
+                        help="variável de execução do .env, ex.: --opcao ESTRATEGIA_LOOKUP=temp (repetível)")
+    parser.add_argument('--saida', default=None,
+                        help="arquivo JSON do resultado (padrão: resultados_benchmark/benchmark_<data>.json)")
+    parser.add_argument('--comparar', default=None, help="JSON de uma execução anterior para comparação")
+    parser.add_argument('--limiar-regressao', type=float, default=0.10,
+                        help="fração de piora que conta como regressão na comparação (padrão: 0.10)")
+    parser.add_argument('--pg-host', default=os.environ.get('BENCH_PG_HOST', 'localhost'))
+    parser.add_argument('--pg-port', type=int, default=int(os.environ.get('BENCH_PG_PORT', '5432')))
+    parser.add_argument('--pg-user', default=os.environ.get('BENCH_PG_USER', 'postgres'))
+    parser.add_argument('--pg-senha', default=os.environ.get('BENCH_PG_PASS', ''))
+    return parser.parse_args(argv)
+
+def cli(argv=None):
+    args = parse_argumentos(argv)
+
+    # Opções de execução como no .env do cliente (ESTRATEGIA_LOOKUP, MOTOR_CLASSIFICACAO, ...)
+    env_opcoes = dict(opcao.split('=', 1) for opcao in args.opcao)
+    try:
+        opcoes = diagnostico.carregar_opcoes_execucao(env_opcoes)
+    except ValueError as e:
+        print(f"❌ ERRO: {e}")
+        return 1
+
+    parametros = {'usuarios': args.usuarios, 'taxa_divergencia': args.taxa_divergencia, 'seed': args.seed}
+    dados = None
+    if args.offline or not args.sem_carga:
+        print(f"🧪 Gerando dados sintéticos ({args.usuarios} usuários, {args.taxa_divergencia:.1%} divergentes)...")
+        inicio = time.perf_counter()
+        dados = gerar_dados_sinteticos(args.usuarios, args.taxa_divergencia, args.seed)
+        print(f"   └─ {', '.join(f'{nome}: {len(tuplas)}' for nome, tuplas in dados.items())} "
+              f"({time.perf_counter() - inicio:.1f}s)")
+
+    if not args.offline:
+        try:
+            if args.sem_carga:
+                parametros = ler_parametros_carregados(args)
+            else:
+                print(f"🐘 Carregando no PostgreSQL local ({args.pg_host}:{args.pg_port})...")
+                inicio = time.perf_counter()
+                carregar_banco_local(args, dados, parametros)
+                print(f"   └─ Carga concluída ({time.perf_counter() - inicio:.1f}s)")
+                dados = None  # libera a memória antes das medições
+        except Exception as e:
+            print(f"❌ ERRO no PostgreSQL local: {e}")
+            return 1
+
+    etapas = {}
+    with tempfile.TemporaryDirectory(prefix='bench_divergencias_') as diretorio:
+        for rodada in range(1, args.repeticoes + 1):
+            print(f"⏱️  Rodada {rodada}/{args.repeticoes}...")
+            try:
+                if args.offline:
+                    total, contagens = executar_rodada_offline(dados, opcoes, etapas, diretorio, args.formatos)
+                else:
+                    total, contagens = executar_rodada_banco(args, opcoes, etapas, diretorio)
+            except Exception as e:
+                print(f"❌ ERRO na rodada {rodada}: {e}")
+                return 1
+
+    resultado = {
+        'versao': versao_codigo(),
+        'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'modo': 'offline' if args.offline else 'postgresql',
+        'parametros': parametros,
+        'opcoes': {chave: valor for chave, valor in opcoes.items() if isinstance(valor, (str, int, float, bool))},
+        'formatos': args.formatos,
+        'repeticoes': args.repeticoes,
+        'divergencias': total,
+        'categorias': contagens,
+        'etapas': resumir_etapas(etapas)
+    }
+
+    print(f"\n{'ETAPA':<30} {'MEDIANA':>10} {'MÍNIMO':>10}")
+    for nome, medida in resultado['etapas'].items():
+        print(f"{nome:<30} {medida['mediana']:>9.3f}s {medida['minimo']:>9.3f}s")
+    print(f"Divergências: {total} | " + ' | '.join(f"{chave}: {qtd}" for chave, qtd in contagens.items()))
+
+    caminho = args.saida or os.path.join('resultados_benchmark', f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(caminho) or '.', exist_ok=True)
+    with open(caminho, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Resultado salvo: {caminho}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f)
+        regressoes = comparar_resultados(resultado, anterior, args.limiar_regressao)
+        if regressoes:
+            print(f"\n⚠️  Regressão acima de {args.limiar_regressao:.0%} em: {', '.join(regressoes)}")
+            return 2
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -1,17 +1,26 @@
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import csv
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
 import re
 import os
+import queue
 import sys
 import subprocess
 import time
+import uuid
 import socket
-from dotenv import load_dotenv  # <--- IMPORTANTE
-from contextlib import contextmanager
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.utils import get_column_letter
+import sqlite3
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, ExitStack
+from operator import mul
+from types import SimpleNamespace
+# psycopg2, openpyxl, dotenv e asyncio são importados dentro das funções que os usam,
+# para que o módulo seja importável (testes/ferramentas) e o --help seja instantâneo
 
 # ============================================
 # SELEÇÃO DE CLIENTE
@@ -93,54 +102,54 @@ def exibir_menu_clientes():
             print("\n\n⚠️  Operação cancelada.\n")
             sys.exit(0)
 
-# Seleciona o cliente e carrega as variáveis de ambiente
-resultado_menu = exibir_menu_clientes()
+# --- FUNÇÕES DE CONFIGURAÇÃO ---
+def carregar_configuracoes(env=None):
+    """
+    Carrega configurações do cliente.
 
-# Verifica se é execução única ou múltipla
-EXECUTAR_TODOS = False
-if resultado_menu[0] == 'TODOS':
-    EXECUTAR_TODOS = True
-    LISTA_CLIENTES = resultado_menu[1]  # Lista de (nome, arquivo)
-else:
-    env_file, NOME_CLIENTE_SELECIONADO = resultado_menu
-    load_dotenv(env_file)
+    Args:
+        env: mapeamento com as variáveis do .env do cliente (padrão: os.environ)
+    """
+    env = os.environ if env is None else env
 
-# --- FUNÇÕES DE CONFIGURAÇÃO ---
-def carregar_configuracoes():
-    """Carrega configurações do arquivo .env atual."""
     DB_GESTAO = {
-        'host': os.getenv('DB_GESTAO_HOST'),
-        'database': os.getenv('DB_GESTAO_NAME'),
-        'user': os.getenv('DB_GESTAO_USER'),
-        'password': os.getenv('DB_GESTAO_PASS')
+        'host': env.get('DB_GESTAO_HOST'),
+        'database': env.get('DB_GESTAO_NAME'),
+        'user': env.get('DB_GESTAO_USER'),
+        'password': env.get('DB_GESTAO_PASS')
     }
 
     DB_CONTRATO = {
-        'host': os.getenv('DB_CONTRATO_HOST'),
-        'database': os.getenv('DB_CONTRATO_NAME'),
-        'user': os.getenv('DB_CONTRATO_USER'),
-        'password': os.getenv('DB_CONTRATO_PASS')
+        'host': env.get('DB_CONTRATO_HOST'),
+        'database': env.get('DB_CONTRATO_NAME'),
+        'user': env.get('DB_CONTRATO_USER'),
+        'password': env.get('DB_CONTRATO_PASS')
     }
 
     DB_PESSOA = {
-        'host': os.getenv('DB_PESSOA_HOST'),
-        'database': os.getenv('DB_PESSOA_NAME'),
-        'user': os.getenv('DB_PESSOA_USER'),
-        'password': os.getenv('DB_PESSOA_PASS')
+        'host': env.get('DB_PESSOA_HOST'),
+        'database': env.get('DB_PESSOA_NAME'),
+        'user': env.get('DB_PESSOA_USER'),
+        'password': env.get('DB_PESSOA_PASS')
     }
 
-    SENHA_ACCOUNTS = os.getenv('DB_ACCOUNTS_PASS')
-    URL_ACCOUNTS = os.getenv('URL_ACCOUNTS')
-    DB_ACCOUNTS_NAME_USER = os.getenv('DB_ACCOUNTS_NAME_USER')
+    SENHA_ACCOUNTS = env.get('DB_ACCOUNTS_PASS')
+    URL_ACCOUNTS = env.get('URL_ACCOUNTS')
+    DB_ACCOUNTS_NAME_USER = env.get('DB_ACCOUNTS_NAME_USER')
 
     SSH_CONFIG = {
-        'ssh_host': os.getenv('SSH_HOST'),
-        'ssh_user': os.getenv('SSH_USER'),
-        'ssh_port': int(os.getenv('SSH_PORT', '22')),
-        'ssh_password': os.getenv('SSH_PASSWORD'),
-        'ssh_pkey': os.getenv('SSH_PKEY_PATH'),
-        'remote_bind_address': (os.getenv('SSH_REMOTE_DB_HOST', 'localhost'), int(os.getenv('SSH_REMOTE_DB_PORT', '5432'))),
-        'local_bind_port': int(os.getenv('SSH_LOCAL_PORT', '5435'))
+        'ssh_host': env.get('SSH_HOST'),
+        'ssh_user': env.get('SSH_USER'),
+        'ssh_port': int(env.get('SSH_PORT', '22')),
+        'ssh_password': env.get('SSH_PASSWORD'),
+        'ssh_pkey': env.get('SSH_PKEY_PATH'),
+        'remote_bind_address': (env.get('SSH_REMOTE_DB_HOST', 'localhost'), int(env.get('SSH_REMOTE_DB_PORT', '5432'))),
+        'local_bind_port': int(env.get('SSH_LOCAL_PORT', '5435')),
+        # Tempo máximo para o forward ficar ativo e reconexões se o ssh cair no meio da execução
+        'timeout_tunnel': float(env.get('SSH_TIMEOUT_TUNNEL', '15')),
+        'max_reconexoes': int(env.get('SSH_MAX_RECONEXOES', '5')),
+        # Definido pelo lote quando o túnel já foi aberto para o grupo (bastion + destino)
+        'tunnel_compartilhado': opcao_ativa(env.get('SSH_TUNNEL_COMPARTILHADO', 'N'))
     }
     
     # Validação: túnel SSH é obrigatório
@@ -149,11 +158,206 @@ def carregar_configuracoes():
     
     return DB_GESTAO, DB_CONTRATO, DB_PESSOA, SSH_CONFIG, SENHA_ACCOUNTS, URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER
 
+def opcao_ativa(valor):
+    """Interpreta valores do .env do tipo S/N como booleano."""
+    return str(valor or '').strip().upper() in ['S', 'SIM', 'Y', 'YES', '1', 'TRUE']
+
+def carregar_opcoes_execucao(env=None, sobrescritas=None):
+    """
+    Carrega as opções de execução (modos opcionais) do .env do cliente (padrão: os.environ).
+    `sobrescritas` traz as opções da linha de comando, que prevalecem sobre o .env.
+    """
+    env = os.environ if env is None else env
+    opcoes = {
+        # Streaming: cursor server-side + processamento lote a lote
+        'modo_streaming': opcao_ativa(env.get('MODO_STREAMING', 'N')),
+        'tamanho_lote': int(env.get('STREAM_BATCH_SIZE', '5000')),
+        # Estratégia de leitura do ACCOUNTS: dblink | dblink_filtrado | local
+        'estrategia_accounts': env.get('ESTRATEGIA_ACCOUNTS', 'dblink').strip().lower(),
+        'tamanho_bloco_accounts': int(env.get('ACCOUNTS_BLOCO_IDS', '5000')),
+        # Partições da query de divergências por faixa de sso_id, em conexões paralelas (1 = desligado)
+        'particoes_divergencias': int(env.get('PARTICOES_DIVERGENCIAS', '1')),
+        'particoes_tentativas': int(env.get('PARTICOES_TENTATIVAS', '3')),
+        # Federado: passos 1 a 4 no servidor do GESTÃO, que alcança CONTRATO e PESSOA (dblink | postgres_fdw)
+        'modo_federado': opcao_ativa(env.get('MODO_FEDERADO', 'N')),
+        'federacao': env.get('FEDERACAO', 'dblink').strip().lower(),
+        'federacao_host': env.get('FEDERACAO_HOST', 'localhost'),
+        'federacao_porta': int(env.get('FEDERACAO_PORTA') or env.get('SSH_REMOTE_DB_PORT') or '5432'),
+        'federacao_schema_contrato': env.get('FEDERACAO_SCHEMA_CONTRATO', 'contrato').strip(),
+        'federacao_schema_pessoa': env.get('FEDERACAO_SCHEMA_PESSOA', 'pessoa').strip(),
+        # Lookups de segurado/e-mail: in | temp | chunks
+        'estrategia_lookup': env.get('ESTRATEGIA_LOOKUP', 'in').strip().lower(),
+        'tamanho_chunk_lookup': int(env.get('LOOKUP_CHUNK_SIZE', '1000')),
+        # Passos 2 e 3 em paralelo (thread pool, uma conexão por banco)
+        'lookups_paralelos': opcao_ativa(env.get('LOOKUPS_PARALELOS', 'N')),
+        # Formato do relatório: xlsx | csv | csv.gz | jsonl | parquet | arrow
+        'formato_saida': env.get('FORMATO_SAIDA', 'xlsx').strip().lower(),
+        # Incremental: snapshot local por cliente com o resultado da última execução
+        'modo_incremental': opcao_ativa(env.get('MODO_INCREMENTAL', 'N')),
+        'dir_estado': env.get('DIR_ESTADO', 'estado'),
+        'incremental_max_dias': float(env.get('INCREMENTAL_MAX_DIAS', '7')),
+        # Cache em disco dos lookups de segurado/e-mail por CPF normalizado
+        'cache_lookups': opcao_ativa(env.get('CACHE_LOOKUPS', 'N')),
+        'cache_ttl_horas': float(env.get('CACHE_TTL_HORAS', '24')),
+        'cache_max_entradas': int(env.get('CACHE_MAX_ENTRADAS', '1000000')),
+        'renovar_cache': False,
+        # Excel em modo write-only (memória constante em relação ao número de linhas)
+        'excel_streaming': opcao_ativa(env.get('EXCEL_STREAMING', 'N')),
+        # E-mails compartilhados por vários CPFs em toda a base (aba extra): ordenado | hash
+        'emails_compartilhados': opcao_ativa(env.get('EMAILS_COMPARTILHADOS', 'N')),
+        'estrategia_emails_compartilhados': env.get('EMAILS_COMPARTILHADOS_ESTRATEGIA', 'ordenado').strip().lower(),
+        'particoes_emails_compartilhados': int(env.get('EMAILS_COMPARTILHADOS_PARTICOES', '64')),
+        # Motor do passo 4: python (loop por divergência) | vetorizado (numpy, operações em bloco)
+        'motor_classificacao': env.get('MOTOR_CLASSIFICACAO', 'python').strip().lower(),
+        # Métricas por etapa: relatório JSON em DIR_METRICAS e, opcionalmente, textfile do Prometheus
+        'dir_metricas': env.get('DIR_METRICAS', 'metricas'),
+        'metricas_prometheus': env.get('METRICAS_PROMETHEUS', '').strip(),
+        # Lote assíncrono (--async): clientes simultâneos no total e por bastion SSH
+        'async_max_clientes': int(env.get('ASYNC_MAX_CLIENTES', '8')),
+        'async_max_por_bastion': int(env.get('ASYNC_MAX_POR_BASTION', '2')),
+        # Checkpoints: resultado de cada etapa gravado em DIR_ESTADO para retomar após falha (--resume).
+        # Desligado por padrão: as etapas guardam CPFs e e-mails em disco até a execução terminar
+        'checkpoints': opcao_ativa(env.get('CHECKPOINTS', 'N')),
+        'retomar': False,
+        'id_execucao': None
+    }
+    opcoes.update(sobrescritas or {})
+
+    if opcoes['estrategia_accounts'] not in ['dblink', 'dblink_filtrado', 'local']:
+        raise ValueError(f"ESTRATEGIA_ACCOUNTS inválida: {opcoes['estrategia_accounts']}")
+    for chave, variavel in [('tamanho_lote', 'STREAM_BATCH_SIZE'), ('tamanho_bloco_accounts', 'ACCOUNTS_BLOCO_IDS'),
+                            ('tamanho_chunk_lookup', 'LOOKUP_CHUNK_SIZE')]:
+        if opcoes[chave] < 1:
+            raise ValueError(f"{variavel} deve ser maior que zero (recebido: {opcoes[chave]})")
+    if opcoes['particoes_divergencias'] < 1 or opcoes['particoes_tentativas'] < 1:
+        raise ValueError("PARTICOES_DIVERGENCIAS e PARTICOES_TENTATIVAS devem ser maiores que zero")
+    if opcoes['particoes_divergencias'] > 1 and opcoes['estrategia_accounts'] == 'local':
+        raise ValueError("PARTICOES_DIVERGENCIAS só vale para ESTRATEGIA_ACCOUNTS dblink ou dblink_filtrado")
+    if opcoes['federacao'] not in ['dblink', 'postgres_fdw']:
+        raise ValueError(f"FEDERACAO inválida: {opcoes['federacao']}")
+    for chave in ['federacao_schema_contrato', 'federacao_schema_pessoa']:
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', opcoes[chave]):
+            raise ValueError(f"{chave.upper()} inválido: {opcoes[chave]}")
+    if opcoes['modo_federado'] and opcoes['estrategia_accounts'] == 'local':
+        raise ValueError("MODO_FEDERADO não combina com ESTRATEGIA_ACCOUNTS=local (o ACCOUNTS precisa vir pelo dblink)")
+    if opcoes['modo_federado'] and opcoes['modo_incremental']:
+        raise ValueError("MODO_FEDERADO não combina com MODO_INCREMENTAL (o snapshot precisa das etapas no cliente)")
+    if opcoes['modo_federado'] and opcoes['particoes_divergencias'] > 1:
+        raise ValueError("MODO_FEDERADO não combina com PARTICOES_DIVERGENCIAS > 1 (a query federada não é particionada)")
+    if opcoes['estrategia_lookup'] not in ['in', 'temp', 'chunks']:
+        raise ValueError(f"ESTRATEGIA_LOOKUP inválida: {opcoes['estrategia_lookup']}")
+    if opcoes['formato_saida'] not in ['xlsx'] + FORMATOS_EM_LOTE:
+        raise ValueError(f"FORMATO_SAIDA inválido: {opcoes['formato_saida']}")
+    if opcoes['async_max_clientes'] < 1 or opcoes['async_max_por_bastion'] < 1:
+        raise ValueError("ASYNC_MAX_CLIENTES e ASYNC_MAX_POR_BASTION devem ser maiores que zero")
+    if opcoes['estrategia_emails_compartilhados'] not in ['ordenado', 'hash']:
+        raise ValueError(f"EMAILS_COMPARTILHADOS_ESTRATEGIA inválida: {opcoes['estrategia_emails_compartilhados']}")
+    if opcoes['particoes_emails_compartilhados'] < 1:
+        raise ValueError("EMAILS_COMPARTILHADOS_PARTICOES deve ser maior que zero")
+    if opcoes['motor_classificacao'] not in ['python', 'vetorizado']:
+        raise ValueError(f"MOTOR_CLASSIFICACAO inválido: {opcoes['motor_classificacao']}")
+    if opcoes['motor_classificacao'] == 'vetorizado' and importlib.util.find_spec('numpy') is None:
+        raise ValueError("MOTOR_CLASSIFICACAO=vetorizado requer o pacote numpy (pip install numpy)")
+
+    return opcoes
+
 # --- FUNÇÕES AUXILIARES ---
+# Bytes que não são dígitos ASCII: bytes.translate remove todos numa única passada em C
+NAO_DIGITOS = bytes(c for c in range(256) if not 0x30 <= c <= 0x39)
+
+def so_digitos(valor):
+    """Mantém só os dígitos (0-9) de um texto, sem regex (bytes.translate)."""
+    return str(valor).encode('utf-8', 'ignore').translate(None, NAO_DIGITOS).decode('ascii')
+
 def limpar_cpf(cpf):
     """Remove caracteres não numéricos."""
     if not cpf: return None
-    return re.sub(r'\D', '', str(cpf))
+    return so_digitos(cpf)
+
+def normalizar_documentos(valores):
+    """Normaliza uma coluna inteira de CPFs/CNPJs (só dígitos); None continua None."""
+    return [None if valor is None else so_digitos(valor) for valor in valores]
+
+# Pesos dos dígitos verificadores (módulo 11): CPF tem 11 dígitos e CNPJ tem 14
+PESOS_DOCUMENTO = {
+    11: ((10, 9, 8, 7, 6, 5, 4, 3, 2), (11, 10, 9, 8, 7, 6, 5, 4, 3, 2)),
+    14: ((5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2), (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2))
+}
+
+def digito_verificador(digitos, pesos):
+    """Dígito verificador (módulo 11) de `digitos` (bytes ASCII '0'-'9')."""
+    resto = (sum(map(mul, digitos, pesos)) - 0x30 * sum(pesos)) % 11
+    return 0 if resto < 2 else 11 - resto
+
+def documento_valido(documento):
+    """
+    Indica se o documento normalizado é um CPF (11 dígitos) ou CNPJ (14 dígitos) com
+    dígitos verificadores corretos. Sequências repetidas (000..., 111...) são inválidas.
+    """
+    if not documento or len(documento) not in PESOS_DOCUMENTO or not documento.isascii() or not documento.isdigit():
+        return False
+    digitos = documento.encode('ascii')
+    if digitos.count(digitos[:1]) == len(digitos):
+        return False
+    pesos_1, pesos_2 = PESOS_DOCUMENTO[len(digitos)]
+    return (digitos[-2] - 0x30 == digito_verificador(digitos, pesos_1)
+            and digitos[-1] - 0x30 == digito_verificador(digitos, pesos_2))
+
+def validar_documentos_vetorizado(documentos):
+    """
+    Mesma regra de documento_valido para uma coluna inteira, com numpy: os documentos de
+    cada tamanho viram uma matriz de dígitos e os verificadores saem de um produto matricial.
+
+    Returns:
+        array numpy de bool
+    """
+    import numpy as np
+
+    documentos = ['' if documento is None else documento for documento in documentos]
+    tamanhos = np.fromiter((len(documento) for documento in documentos), dtype=np.int64, count=len(documentos))
+    validos = np.zeros(len(documentos), dtype=bool)
+
+    for tamanho, (pesos_1, pesos_2) in PESOS_DOCUMENTO.items():
+        indices = np.flatnonzero(tamanhos == tamanho)
+        if not len(indices):
+            continue
+        # 'replace': caractere não ASCII vira '?' (um byte), mantendo o tamanho de cada linha
+        texto = ''.join(documentos[i] for i in indices.tolist()).encode('ascii', 'replace')
+        digitos = np.frombuffer(texto, dtype=np.uint8).reshape(-1, tamanho).astype(np.int64) - 0x30
+
+        def verificador(colunas, pesos):
+            resto = (colunas @ np.array(pesos)) % 11
+            return np.where(resto < 2, 0, 11 - resto)
+
+        validos[indices] = (
+            ((digitos >= 0) & (digitos <= 9)).all(axis=1)
+            & ~(digitos == digitos[:, :1]).all(axis=1)
+            & (digitos[:, -2] == verificador(digitos[:, :len(pesos_1)], pesos_1))
+            & (digitos[:, -1] == verificador(digitos[:, :len(pesos_2)], pesos_2))
+        )
+    return validos
+
+# numpy é opcional: sem ele, a validação em bloco cai no loop de documento_valido
+NUMPY_DISPONIVEL = importlib.util.find_spec('numpy') is not None
+
+def validar_documentos(documentos):
+    """
+    Valida uma coluna de documentos normalizados, com numpy quando disponível (bem mais
+    rápido que o loop em Python, independente de MOTOR_CLASSIFICACAO).
+
+    Returns:
+        lista de bool
+    """
+    if NUMPY_DISPONIVEL:
+        return validar_documentos_vetorizado(documentos).tolist()
+    return [documento_valido(documento) for documento in documentos]
+
+def expr_cpf_normalizado(coluna='cpf_cnpj'):
+    """
+    Expressão SQL do CPF normalizado. É exatamente a mesma expressão dos índices
+    criados pelo modo prepare, para que o planner consiga usá-los.
+    """
+    return f"REGEXP_REPLACE({coluna}, '\\D', '', 'g')"
 
 def formatar_cpf(cpf):
     """Aplica máscara de CPF (apenas para exibição se necessário)."""
@@ -161,11 +365,12 @@ def formatar_cpf(cpf):
     if len(c) != 11: return c
     return f"{c[:3]}.{c[3:6]}.{c[6:9]}-{c[9:]}"
 
-def salvar_csv(nome_arquivo, dados, cabecalho):
+def salvar_csv(nome_arquivo, dados, cabecalho, silent=False):
     """Salva lista de dicionários em CSV na raiz."""
     caminho = os.path.join(os.getcwd(), nome_arquivo)
     if not dados:
-        print(f"-> Arquivo {nome_arquivo} não gerado (sem dados).")
+        if not silent:
+            print(f"-> Arquivo {nome_arquivo} não gerado (sem dados).")
         return
 
     try:
@@ -173,18 +378,23 @@ def salvar_csv(nome_arquivo, dados, cabecalho):
             writer = csv.DictWriter(f, fieldnames=cabecalho)
             writer.writeheader()
             writer.writerows(dados)
-        print(f"-> Relatório salvo: {caminho} ({len(dados)} registros)")
+        if not silent:
+            print(f"-> Relatório salvo: {caminho} ({len(dados)} registros)")
     except Exception as e:
         print(f"Erro ao salvar {nome_arquivo}: {e}")
 
-def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolidado_lote.xlsx'):
+def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolidado_lote.xlsx', silent=False):
     """
     Salva um Excel consolidado com o resumo estatístico de todos os clientes processados em lote.
     
     Args:
         lista_resumos: lista de dicts com dados de cada cliente
         nome_arquivo: nome do arquivo Excel a ser gerado
+        silent: se True, não exibe mensagens (usado nas atualizações parciais do lote paralelo)
     """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment
+
     caminho = os.path.join(os.getcwd(), nome_arquivo)
     
     try:
@@ -194,7 +404,7 @@ def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolida
         
         # Cabeçalho
         headers = ['Cliente', 'E-mails Duplicados', 'Um CPF Inexistente', 
-                   'Ambos CPF Inexistentes', 'Outros Erros', 'Total Analisado']
+                   'Ambos CPF Inexistentes', 'Outros Erros', 'Documentos Inválidos', 'Total Analisado']
         ws.append(headers)
         
         # Estiliza cabeçalho
@@ -216,6 +426,7 @@ def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolida
                 resumo['um_cpf_inexistente'],
                 resumo['ambos_cpf_inexistentes'],
                 resumo['outros_erros'],
+                resumo.get('documentos_invalidos', 0),
                 resumo['total_analisado']
             ])
         
@@ -227,6 +438,7 @@ def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolida
             sum(r['um_cpf_inexistente'] for r in lista_resumos),
             sum(r['ambos_cpf_inexistentes'] for r in lista_resumos),
             sum(r['outros_erros'] for r in lista_resumos),
+            sum(r.get('documentos_invalidos', 0) for r in lista_resumos),
             sum(r['total_analisado'] for r in lista_resumos)
         ])
         
@@ -242,7 +454,7 @@ def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolida
         
         # Ajusta largura das colunas
         ws.column_dimensions['A'].width = 25
-        for col in ['B', 'C', 'D', 'E', 'F']:
+        for col in ['B', 'C', 'D', 'E', 'F', 'G']:
             ws.column_dimensions[col].width = 20
         
         # Congela primeira linha
@@ -251,11 +463,13 @@ def salvar_resumo_consolidado_lote(lista_resumos, nome_arquivo='resumo_consolida
         # Salva arquivo
         wb.save(caminho)
         
-        print(f"\n📊 Resumo consolidado salvo: {caminho}")
-        print(f"   └─ {len(lista_resumos)} clientes processados")
+        if not silent:
+            print(f"\n📊 Resumo consolidado salvo: {caminho}")
+            print(f"   └─ {len(lista_resumos)} clientes processados")
         
     except Exception as e:
-        print(f"⚠️  Erro ao salvar resumo consolidado: {e}")
+        if not silent:
+            print(f"⚠️  Erro ao salvar resumo consolidado: {e}")
 
 def salvar_excel_consolidado(relatorios_dict, nome_arquivo='relatorio_divergencias.xlsx', silent=False):
     """
@@ -265,7 +479,14 @@ def salvar_excel_consolidado(relatorios_dict, nome_arquivo='relatorio_divergenci
         relatorios_dict: dict com formato {'Nome da Aba': (dados, cabecalho)}
         nome_arquivo: nome do arquivo Excel a ser gerado
         silent: se True, não exibe mensagens de progresso
+
+    Returns:
+        True se o arquivo foi gerado, False se houve erro
     """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment
+    from openpyxl.utils import get_column_letter
+
     caminho = os.path.join(os.getcwd(), nome_arquivo)
     
     try:
@@ -300,8 +521,7 @@ def salvar_excel_consolidado(relatorios_dict, nome_arquivo='relatorio_divergenci
             
             # Adiciona dados
             for item in dados:
-                linha = [item.get(col, '') for col in cabecalho]
-                ws.append(linha)
+                ws.append(formatar_linha(item))
             
             # Ajusta largura das colunas
             for col_num, col_name in enumerate(cabecalho, 1):
@@ -329,11 +549,406 @@ def salvar_excel_consolidado(relatorios_dict, nome_arquivo='relatorio_divergenci
             total_registros = sum(len(dados) for dados, _ in relatorios_dict.values())
             print(f"\n📊 Relatório Excel consolidado salvo: {caminho}")
             print(f"   └─ {len(relatorios_dict)} abas criadas | {total_registros} registros totais")
+        return True
         
     except Exception as e:
         if not silent:
             print(f"⚠️  Erro ao salvar arquivo Excel: {e}")
             print(f"   Os arquivos CSV individuais foram mantidos como backup.")
+        return False
+
+# Limite de linhas de uma planilha do Excel (cabeçalho incluso)
+LIMITE_LINHAS_EXCEL = 1048576
+
+def nome_aba_particionada(nome_aba, parte):
+    """Nome da aba da parte N de uma categoria (a parte 1 mantém o nome original; máx. 31 caracteres)."""
+    if parte == 1:
+        return nome_aba
+    sufixo = f" ({parte})"
+    return f"{nome_aba[:31 - len(sufixo)]}{sufixo}"
+
+def criar_aba_streaming(wb, titulo, cabecalho, larguras, estilos_cabecalho):
+    """Cria uma aba write-only já com larguras, painel congelado e cabeçalho estilizado."""
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.utils import get_column_letter
+
+    header_fill, header_font, header_alignment = estilos_cabecalho
+    ws = wb.create_sheet(title=titulo)
+
+    # No write-only as dimensões precisam ser definidas antes da 1ª linha
+    for col_num, largura in enumerate(larguras, 1):
+        ws.column_dimensions[get_column_letter(col_num)].width = largura
+
+    # Congela primeira linha (cabeçalho)
+    ws.freeze_panes = 'A2'
+
+    celulas_cabecalho = []
+    for col_name in cabecalho:
+        cell = WriteOnlyCell(ws, value=col_name)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = header_alignment
+        celulas_cabecalho.append(cell)
+    ws.append(celulas_cabecalho)
+    return ws
+
+def salvar_excel_streaming(relatorios_dict, nome_arquivo='relatorio_divergencias.xlsx', silent=False,
+                           linhas_amostra=100, max_linhas_aba=LIMITE_LINHAS_EXCEL - 1):
+    """
+    Versão streaming de salvar_excel_consolidado: workbook write-only, em que cada linha
+    vai direto para o arquivo e a memória não cresce com o número de registros.
+    A largura das colunas é calculada sobre as primeiras `linhas_amostra` linhas.
+
+    Categorias com mais de `max_linhas_aba` registros (padrão: o limite do Excel) são
+    divididas em abas numeradas ("1-Emails Duplicados (2)", ...). A aba "0-Índice"
+    lista cada aba gerada com sua categoria e quantidade de registros.
+
+    Args:
+        relatorios_dict: dict com formato {'Nome da Aba': (dados, cabecalho)}, em que
+                         dados pode ser qualquer iterável de linhas (inclusive um gerador)
+        nome_arquivo: nome do arquivo Excel a ser gerado
+        silent: se True, não exibe mensagens de progresso
+
+    Returns:
+        True se o arquivo foi gerado, False se houve erro
+    """
+    from itertools import chain, islice
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment
+
+    caminho = os.path.join(os.getcwd(), nome_arquivo)
+
+    # Estilos do cabeçalho criados uma única vez e compartilhados entre as abas
+    estilos_cabecalho = (
+        PatternFill(start_color='366092', end_color='366092', fill_type='solid'),
+        Font(bold=True, color='FFFFFF', size=11),
+        Alignment(horizontal='center', vertical='center')
+    )
+
+    try:
+        wb = Workbook(write_only=True)
+        # Índice criado primeiro (fica na 1ª posição) e preenchido ao final
+        cabecalho_indice = ['Categoria', 'Aba', 'Registros']
+        ws_indice = criar_aba_streaming(wb, '0-Índice', cabecalho_indice, [30, 32, 12], estilos_cabecalho)
+        indice = []  # (categoria, aba, registros)
+
+        for nome_aba, (dados, cabecalho) in relatorios_dict.items():
+            linhas = (formatar_linha(item) for item in dados)
+            amostra = list(islice(linhas, linhas_amostra))
+
+            # Se não houver dados, adiciona apenas cabeçalho e mensagem
+            if not amostra:
+                ws = wb.create_sheet(title=nome_aba)
+                ws.append(cabecalho)
+                ws.append(['Nenhum registro encontrado'])
+                indice.append((nome_aba, nome_aba, 0))
+                continue
+
+            # Largura das colunas pela amostra (limite de 50 caracteres)
+            larguras = [
+                min(max([len(str(col_name))] + [len(str(linha[col_num])) for linha in amostra]) + 2, 50)
+                for col_num, col_name in enumerate(cabecalho)
+            ]
+
+            # Dados: amostra + restante do iterável, linha a linha, abrindo nova aba no limite
+            ws, parte, linhas_aba = None, 0, 0
+            for linha in chain(amostra, linhas):
+                if ws is None or linhas_aba >= max_linhas_aba:
+                    if ws is not None:
+                        indice.append((nome_aba, ws.title, linhas_aba))
+                    parte += 1
+                    ws = criar_aba_streaming(wb, nome_aba_particionada(nome_aba, parte), cabecalho, larguras, estilos_cabecalho)
+                    linhas_aba = 0
+                ws.append(linha)
+                linhas_aba += 1
+            indice.append((nome_aba, ws.title, linhas_aba))
+
+            if parte > 1 and not silent:
+                print(f"⚠️  '{nome_aba}' excede o limite de linhas do Excel: dividida em {parte} abas.")
+
+        for linha_indice in indice:
+            ws_indice.append(list(linha_indice))
+
+        # Salva o arquivo
+        wb.save(caminho)
+
+        if not silent:
+            total_registros = sum(registros for _, _, registros in indice)
+            print(f"\n📊 Relatório Excel consolidado salvo (streaming): {caminho}")
+            print(f"   └─ {len(indice)} abas de dados criadas | {total_registros} registros totais")
+        return True
+
+    except Exception as e:
+        if not silent:
+            print(f"⚠️  Erro ao salvar arquivo Excel: {e}")
+        return False
+
+# --- SAÍDAS EM LOTE (CSV / CSV.GZ / JSONL / PARQUET / ARROW) ---
+# Formatos gravados lote a lote durante o passo 4, sem manter as categorias em memória
+FORMATOS_EM_LOTE = ['csv', 'csv.gz', 'jsonl', 'parquet', 'arrow']
+
+# Categorias do relatório: chave em `listas` -> nome da aba/arquivo
+ABAS_RELATORIO = {
+    'email_duplicado': '1-Emails Duplicados',
+    'um_inexistente': '2-Um CPF Inexistente',
+    'ambos_inexistentes': '3-Ambos CPF Inexistentes',
+    'outros': '4-Outros Erros',
+    'documento_invalido': '5-Documentos Invalidos'
+}
+CABECALHO_RELATORIO = ['uuid_comum', 'cpf_gestao', 'cpf_accounts',
+                       'existe_segurado_gestao', 'existe_segurado_accounts',
+                       'email_comum']
+CABECALHO_DELTA = ['uuid_comum', 'cpf_gestao', 'cpf_accounts', 'situacao']
+# E-mails compartilhados por vários CPFs em toda a base pessoa/contato (aba opcional)
+ABA_EMAILS_COMPARTILHADOS = '7-Emails Compartilhados'
+CABECALHO_EMAILS_COMPARTILHADOS = ['email', 'qtd_cpfs', 'cpfs']
+
+# Linhas dos relatórios como tuplas nomeadas; existe_segurado_* ficam bool até a exportação
+LinhaRelatorio = namedtuple('LinhaRelatorio', CABECALHO_RELATORIO)
+LinhaDelta = namedtuple('LinhaDelta', CABECALHO_DELTA)
+LinhaEmailCompartilhado = namedtuple('LinhaEmailCompartilhado', CABECALHO_EMAILS_COMPARTILHADOS)
+
+def formatar_linha(linha):
+    """Valores de uma linha do relatório para exportação (booleanos viram "SIM"/"NAO")."""
+    return ["SIM" if valor is True else "NAO" if valor is False else valor for valor in linha]
+
+def abrir_saida_em_lote(formato, prefixo, categorias):
+    """
+    Abre um arquivo por categoria no formato escolhido ({prefixo}_{aba}.{formato}).
+    Parquet e Arrow IPC dependem do pyarrow, importado só quando usados.
+
+    Args:
+        categorias: dict { chave: (nome_aba, cabecalho) }
+
+    Returns:
+        dict com o estado da saída (arquivos abertos e contagem de registros por categoria)
+    """
+    if formato in ['parquet', 'arrow']:
+        try:
+            import pyarrow as pa
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f"FORMATO_SAIDA={formato} requer o pacote pyarrow (pip install pyarrow)")
+
+    saida = {'formato': formato, 'arquivos': {}, 'contagens': {}}
+    try:
+        for chave, (nome_aba, cabecalho) in categorias.items():
+            sufixo = nome_aba.lower().replace(" ", "_")
+            caminho = os.path.join(os.getcwd(), f'{prefixo}_{sufixo}.{formato}')
+            arquivo = {'caminho': caminho, 'cabecalho': cabecalho}
+
+            if formato in ['csv', 'csv.gz']:
+                if formato == 'csv.gz':
+                    arquivo['handle'] = gzip.open(caminho, mode='wt', newline='', encoding='utf-8')
+                else:
+                    arquivo['handle'] = open(caminho, mode='w', newline='', encoding='utf-8')
+                arquivo['writer'] = csv.writer(arquivo['handle'])
+                arquivo['writer'].writerow(cabecalho)
+            elif formato == 'jsonl':
+                arquivo['handle'] = open(caminho, mode='w', encoding='utf-8')
+            else:
+                # Todas as colunas do relatório são texto (CPFs, SIM/NAO, e-mail)
+                arquivo['schema'] = pa.schema([(col, pa.string()) for col in cabecalho])
+                if formato == 'parquet':
+                    arquivo['writer'] = pyarrow.parquet.ParquetWriter(caminho, arquivo['schema'], compression='zstd')
+                else:
+                    arquivo['writer'] = pyarrow.ipc.new_file(caminho, arquivo['schema'])
+
+            saida['arquivos'][chave] = arquivo
+            saida['contagens'][chave] = 0
+    except Exception:
+        fechar_saida_em_lote(saida, silent=True)
+        raise
+
+    return saida
+
+def escrever_lote_saida(saida, chave, linhas):
+    """Grava um lote de linhas (LinhaRelatorio/LinhaDelta) no arquivo da categoria."""
+    if not linhas:
+        return
+
+    arquivo = saida['arquivos'][chave]
+    formato = saida['formato']
+    if formato in ['csv', 'csv.gz']:
+        arquivo['writer'].writerows(formatar_linha(linha) for linha in linhas)
+    elif formato == 'jsonl':
+        arquivo['handle'].writelines(
+            json.dumps(dict(zip(arquivo['cabecalho'], formatar_linha(linha))), ensure_ascii=False) + '\n'
+            for linha in linhas
+        )
+    else:
+        import pyarrow as pa
+        valores_colunas = zip(*(formatar_linha(linha) for linha in linhas))
+        colunas = {
+            col: [None if valor is None else str(valor) for valor in valores]
+            for col, valores in zip(arquivo['cabecalho'], valores_colunas)
+        }
+        lote = pa.RecordBatch.from_pydict(colunas, schema=arquivo['schema'])
+        if formato == 'parquet':
+            arquivo['writer'].write_table(pa.Table.from_batches([lote]))
+        else:
+            arquivo['writer'].write_batch(lote)
+
+    saida['contagens'][chave] += len(linhas)
+
+def descarregar_listas_na_saida(listas, saida):
+    """Grava o conteúdo atual das listas de classificação na saída e as esvazia."""
+    for chave, linhas in listas.items():
+        escrever_lote_saida(saida, chave, linhas)
+        linhas.clear()
+
+def fechar_saida_em_lote(saida, silent=False):
+    """Fecha os arquivos da saída (pode ser chamada mais de uma vez)."""
+    for chave, arquivo in saida['arquivos'].items():
+        if arquivo.get('fechado'):
+            continue
+        if 'writer' in arquivo and hasattr(arquivo['writer'], 'close'):
+            arquivo['writer'].close()
+        if 'handle' in arquivo:
+            arquivo['handle'].close()
+        arquivo['fechado'] = True
+        if not silent:
+            print(f"-> Relatório salvo: {arquivo['caminho']} ({saida['contagens'][chave]} registros)")
+
+# --- MÉTRICAS DE EXECUÇÃO ---
+def rss_atual_mb():
+    """RSS atual do processo em MB (Linux, via /proc; None em outros sistemas)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def pico_rss_mb():
+    """Pico de RSS do processo até agora em MB (None onde o módulo resource não existe)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    return round(pico / (1048576 if sys.platform == 'darwin' else 1024), 1)
+
+def iniciar_metricas(cliente_nome):
+    """Registro das métricas de um cliente nesta execução."""
+    return {
+        'cliente': cliente_nome,
+        'inicio': time.time(),
+        'status': 'em_andamento',
+        'etapas': {}
+    }
+
+@contextmanager
+def medir_etapa(metricas, nome):
+    """
+    Mede uma etapa (tempo de parede, RSS atual e pico de RSS ao final). O bloco pode
+    preencher `linhas` e `bytes` no dict devolvido. Etapas repetidas (ex.: um lote por
+    vez no streaming) acumulam tempo e linhas. Com `metricas` None, não registra nada.
+    """
+    if metricas is None:
+        yield {'linhas': 0, 'bytes': None}
+        return
+
+    etapa = metricas['etapas'].setdefault(nome, {'segundos': 0.0, 'execucoes': 0, 'linhas': 0, 'bytes': None})
+    inicio = time.perf_counter()
+    try:
+        yield etapa
+    finally:
+        etapa['segundos'] = round(etapa['segundos'] + time.perf_counter() - inicio, 4)
+        etapa['execucoes'] += 1
+        etapa['rss_mb'] = rss_atual_mb()
+        etapa['pico_rss_mb'] = pico_rss_mb()
+
+def registrar_etapa(metricas, nome, segundos, linhas=0):
+    """Registra uma etapa medida fora de medir_etapa (ex.: setup do túnel)."""
+    if metricas is not None:
+        metricas['etapas'][nome] = {
+            'segundos': round(segundos, 4), 'execucoes': 1, 'linhas': linhas, 'bytes': None,
+            'rss_mb': rss_atual_mb(), 'pico_rss_mb': pico_rss_mb()
+        }
+
+def tamanho_arquivos(caminhos):
+    """Soma do tamanho em bytes dos arquivos que existem."""
+    return sum(os.path.getsize(caminho) for caminho in caminhos if os.path.exists(caminho))
+
+def finalizar_metricas(metricas, status='sucesso'):
+    """Fecha o registro do cliente com status, duração total e pico de RSS."""
+    metricas['status'] = status
+    metricas['segundos_total'] = round(time.time() - metricas['inicio'], 4)
+    metricas['pico_rss_mb'] = pico_rss_mb()
+    return metricas
+
+def escapar_rotulo_prometheus(valor):
+    """Escapa um valor de rótulo (label) do formato texto do Prometheus."""
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def escrever_textfile_prometheus(lista_metricas, caminho):
+    """
+    Grava as métricas no formato texto do Prometheus (node_exporter textfile collector).
+    Escreve num arquivo temporário e renomeia, para o coletor nunca ler um arquivo pela metade.
+    """
+    series = {
+        'divergencias_etapa_segundos': ('gauge', 'Tempo de parede da etapa (s)', []),
+        'divergencias_etapa_linhas': ('gauge', 'Linhas processadas na etapa', []),
+        'divergencias_etapa_bytes': ('gauge', 'Bytes transferidos/gravados na etapa', []),
+        'divergencias_execucao_segundos': ('gauge', 'Duração total da análise do cliente (s)', []),
+        'divergencias_execucao_sucesso': ('gauge', '1 se a análise do cliente terminou com sucesso', []),
+        'divergencias_pico_rss_bytes': ('gauge', 'Pico de RSS do processo da análise (bytes)', []),
+        'divergencias_ultima_execucao_timestamp_segundos': ('gauge', 'Início da última análise (epoch)', [])
+    }
+    for metricas in lista_metricas:
+        cliente = f'cliente="{escapar_rotulo_prometheus(metricas["cliente"])}"'
+        for nome, etapa in metricas.get('etapas', {}).items():
+            rotulos = f'{{{cliente},etapa="{escapar_rotulo_prometheus(nome)}"}}'
+            series['divergencias_etapa_segundos'][2].append(f"{rotulos} {etapa['segundos']}")
+            series['divergencias_etapa_linhas'][2].append(f"{rotulos} {etapa['linhas']}")
+            if etapa.get('bytes') is not None:
+                series['divergencias_etapa_bytes'][2].append(f"{rotulos} {etapa['bytes']}")
+        series['divergencias_execucao_sucesso'][2].append(f"{{{cliente}}} {int(metricas['status'] == 'sucesso')}")
+        if 'segundos_total' in metricas:
+            series['divergencias_execucao_segundos'][2].append(f"{{{cliente}}} {metricas['segundos_total']}")
+        if metricas.get('pico_rss_mb') is not None:
+            series['divergencias_pico_rss_bytes'][2].append(f"{{{cliente}}} {int(metricas['pico_rss_mb'] * 1048576)}")
+        if 'inicio' in metricas:
+            series['divergencias_ultima_execucao_timestamp_segundos'][2].append(f"{{{cliente}}} {int(metricas['inicio'])}")
+
+    linhas = []
+    for nome, (tipo, descricao, amostras) in series.items():
+        if amostras:
+            linhas.append(f"# HELP {nome} {descricao}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            linhas.extend(f"{nome}{amostra}" for amostra in amostras)
+
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    with open(temporario, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(linhas) + '\n')
+    os.replace(temporario, caminho)
+
+def salvar_relatorio_execucao(lista_metricas, diretorio, arquivo_prometheus=None, silent=False):
+    """
+    Grava o relatório da execução (JSON com as métricas por cliente e por etapa) em
+    `diretorio` e, se informado, o textfile do Prometheus.
+    """
+    try:
+        os.makedirs(diretorio, exist_ok=True)
+        caminho = os.path.join(diretorio, f"execucao_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.json")
+        with open(caminho, 'w', encoding='utf-8') as f:
+            json.dump({
+                'gerado_em': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': socket.gethostname(),
+                'clientes': lista_metricas
+            }, f, ensure_ascii=False, indent=2)
+        if not silent:
+            print(f"📈 Métricas da execução: {caminho}")
+
+        if arquivo_prometheus:
+            escrever_textfile_prometheus(lista_metricas, arquivo_prometheus)
+            if not silent:
+                print(f"📈 Textfile do Prometheus: {arquivo_prometheus}")
+    except Exception as e:
+        print(f"⚠️  Erro ao salvar métricas da execução: {e}")
 
 def verificar_porta_disponivel(port):
     """Verifica se uma porta está disponível para uso."""
@@ -346,119 +961,259 @@ def verificar_porta_disponivel(port):
         return False
 
 def aguardar_porta_aberta(port, timeout=10):
-    """Aguarda até que a porta esteja aberta e aceitando conexões."""
+    """Aguarda até que a porta esteja aberta e aceitando conexões (timeout=0: verifica uma vez)."""
     inicio = time.time()
-    while time.time() - inicio < timeout:
+    while True:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             sock.connect(('127.0.0.1', port))
-            sock.close()
             return True
         except (socket.error, ConnectionRefusedError):
+            if time.time() - inicio >= timeout:
+                return False
             time.sleep(0.5)
+        finally:
+            sock.close()
+
+# Linhas do `ssh -v` que indicam o forward local pronto para aceitar conexões
+MARCADORES_TUNNEL_PRONTO = ('Local forwarding listening on', 'Entering interactive session')
+
+def montar_comando_ssh(SSH_CONFIG):
+    """Comando do túnel: -v para acompanhar o estabelecimento do forward pela saída do ssh."""
+    remote_host, remote_port = SSH_CONFIG['remote_bind_address']
+
+    # Formato: ssh -L local_port:remote_host:remote_port user@ssh_host -p ssh_port -N -o StrictHostKeyChecking=no
+    ssh_cmd = [
+        'ssh',
+        '-v',  # Saída de debug: indica quando o forward local está escutando
+        '-L', f"{SSH_CONFIG['local_bind_port']}:{remote_host}:{remote_port}",
+        '-p', str(SSH_CONFIG['ssh_port']),
+        '-l', SSH_CONFIG['ssh_user'],
+        SSH_CONFIG['ssh_host'],
+        '-N',  # Não executa comando remoto
+        '-o', 'StrictHostKeyChecking=no',  # Aceita host automaticamente
+        '-o', 'ExitOnForwardFailure=yes',  # Encerra (em vez de seguir sem túnel) se o forward falhar
+        '-o', 'ServerAliveInterval=15',  # Keep-alive: detecta bastion caído em ~45s
+        '-o', 'ServerAliveCountMax=3'
+    ]
+
+    # Se houver chave privada, adiciona ao comando
+    if SSH_CONFIG['ssh_pkey']:
+        ssh_cmd.insert(1, '-i')
+        ssh_cmd.insert(2, SSH_CONFIG['ssh_pkey'])
+    return ssh_cmd
+
+def ler_saida_ssh(processo, tunel):
+    """
+    Thread leitora da saída do ssh: sinaliza `pronto` quando o forward está escutando e
+    `mudou` quando o túnel fica pronto ou o processo termina (EOF).
+    """
+    for linha in processo.stderr:
+        tunel['saida'].append(linha.rstrip())
+        if any(marcador in linha for marcador in MARCADORES_TUNNEL_PRONTO):
+            tunel['pronto'].set()
+            tunel['mudou'].set()
+    tunel['mudou'].set()
+
+def abrir_forward_ssh(tunel):
+    """
+    Inicia o processo ssh e espera pelo evento de túnel pronto (ou pela saída do processo),
+    sem intervalos fixos de espera.
+
+    Returns:
+        True se o forward ficou ativo dentro de `timeout_tunnel`
+    """
+    SSH_CONFIG = tunel['config']
+    tunel['pronto'].clear()
+    tunel['mudou'].clear()
+    tunel['saida'] = deque(maxlen=20)
+
+    # No Windows, usa CREATE_NEW_PROCESS_GROUP para poder encerrar depois
+    extras = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == 'nt' else {'preexec_fn': os.setsid}
+    processo = subprocess.Popen(
+        tunel['comando'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.PIPE,
+        text=True,
+        errors='replace',
+        **extras
+    )
+    tunel['processo'] = processo
+    if tunel['parar'].is_set():
+        # Encerramento pedido enquanto o supervisor reconectava
+        encerrar_processo_ssh(processo)
+        return False
+    threading.Thread(target=ler_saida_ssh, args=(processo, tunel), daemon=True).start()
+
+    limite = time.monotonic() + SSH_CONFIG['timeout_tunnel']
+    while not tunel['pronto'].is_set():
+        restante = limite - time.monotonic()
+        if processo.poll() is not None or restante <= 0:
+            break
+        tunel['mudou'].wait(restante)
+        tunel['mudou'].clear()
+
+    if tunel['pronto'].is_set():
+        return True
+
+    # ssh sem as linhas de debug esperadas (outra implementação): confere a porta uma vez
+    if processo.poll() is None and aguardar_porta_aberta(SSH_CONFIG['local_bind_port'], timeout=0):
+        tunel['pronto'].set()
+        return True
+
+    encerrar_processo_ssh(processo)
     return False
 
+def encerrar_processo_ssh(processo):
+    """Encerra o processo ssh (terminate e, se preciso, kill)."""
+    try:
+        processo.terminate()
+        processo.wait(timeout=5)
+        return "✓"
+    except Exception:
+        try:
+            processo.kill()
+            return "✓ (forçado)"
+        except Exception:
+            return "⚠️  (processo pode continuar em background)"
+
+def supervisionar_tunnel(tunel):
+    """
+    Thread supervisora: se o processo ssh morrer durante a execução, restabelece o forward
+    (até `max_reconexoes` vezes seguidas, com backoff). Enquanto isso, `pronto` fica
+    desligado e as etapas que perderam a conexão esperam por ele para repetir.
+    """
+    SSH_CONFIG = tunel['config']
+    while not tunel['parar'].is_set():
+        codigo = tunel['processo'].wait()
+        if tunel['parar'].is_set():
+            return
+
+        tunel['pronto'].clear()
+        ultima_linha = tunel['saida'][-1] if tunel['saida'] else ''
+        print(f"\n[SSH] ⚠️  Túnel caiu (código {codigo}) {ultima_linha}".rstrip())
+
+        for tentativa in range(1, SSH_CONFIG['max_reconexoes'] + 1):
+            # Backoff entre tentativas; interrompido imediatamente no encerramento
+            if tunel['parar'].wait(min(2 ** (tentativa - 1), 30)):
+                return
+            print(f"[SSH] Reconectando ({tentativa}/{SSH_CONFIG['max_reconexoes']})...")
+            if abrir_forward_ssh(tunel):
+                tunel['reconexoes'] += 1
+                print(f"[SSH] ✓ Túnel restabelecido em localhost:{SSH_CONFIG['local_bind_port']}")
+                break
+        else:
+            print("[SSH] ❌ Não foi possível restabelecer o túnel.")
+            tunel['falhou'] = True
+            tunel['mudou'].set()
+            return
+
+def aguardar_tunnel(tunel, SSH_CONFIG):
+    """
+    Espera o túnel voltar depois de uma queda. Sem supervisor neste processo (túnel
+    compartilhado ou já existente), espera a porta local voltar a aceitar conexões.
+    """
+    if tunel is None:
+        return aguardar_porta_aberta(SSH_CONFIG['local_bind_port'], timeout=SSH_CONFIG['timeout_tunnel'])
+    limite = time.monotonic() + SSH_CONFIG['timeout_tunnel'] * (SSH_CONFIG['max_reconexoes'] + 1)
+    return tunel['pronto'].wait(max(limite - time.monotonic(), 0)) and not tunel['falhou']
+
 @contextmanager
 def gerenciar_tunnel_ssh(SSH_CONFIG):
-    """Context manager para gerenciar ciclo de vida do túnel SSH usando comando nativo."""
-    processo_ssh = None
+    """
+    Context manager do ciclo de vida do túnel SSH (comando nativo), com supervisor que
+    restabelece o forward se o ssh cair no meio da execução.
+
+    Só a abertura do túnel é tratada aqui (falha encerra com sys.exit e o motivo); erros
+    do bloco `with` (banco, consultas, relatório) passam sem alteração.
+
+    Yields:
+        estado do túnel (dict com o processo e os eventos) ou None se o túnel não é
+        gerenciado por este processo (compartilhado ou já ativo na porta)
+    """
+    if SSH_CONFIG.get('tunnel_compartilhado'):
+        print(f"[SSH] Reutilizando túnel compartilhado em localhost:{SSH_CONFIG['local_bind_port']}")
+        yield None
+        return
+
+    print(f"[SSH] Conectando ao servidor {SSH_CONFIG['ssh_host']}:{SSH_CONFIG['ssh_port']}...")
+    
+    # Verifica se a porta local está disponível
+    if not verificar_porta_disponivel(SSH_CONFIG['local_bind_port']):
+        print(f"[SSH] Aviso: Porta {SSH_CONFIG['local_bind_port']} já está em uso.")
+        print(f"[SSH] Assumindo que o túnel já está ativo...")
+        yield None
+        return
     
+    remote_host, remote_port = SSH_CONFIG['remote_bind_address']
+    tunel = {
+        'config': SSH_CONFIG,
+        'comando': montar_comando_ssh(SSH_CONFIG),
+        'processo': None,
+        'pronto': threading.Event(),  # forward ativo
+        'mudou': threading.Event(),   # pronto ou processo encerrado
+        'parar': threading.Event(),   # encerramento pedido pelo script
+        'saida': deque(maxlen=20),  # últimas linhas do ssh, para as mensagens de erro
+        'reconexoes': 0,
+        'falhou': False
+    }
+
+    def encerrar_tunnel():
+        if tunel['processo']:
+            tunel['parar'].set()
+            print("[SSH] Encerrando túnel SSH...", end=" ")
+            print(encerrar_processo_ssh(tunel['processo']))
+            if tunel['reconexoes']:
+                print(f"[SSH] Túnel SSH encerrado ({tunel['reconexoes']} reconexões durante a execução).")
+            else:
+                print("[SSH] Túnel SSH encerrado.")
+
     try:
-        print(f"[SSH] Conectando ao servidor {SSH_CONFIG['ssh_host']}:{SSH_CONFIG['ssh_port']}...")
-        
-        # Verifica se a porta local está disponível
-        if not verificar_porta_disponivel(SSH_CONFIG['local_bind_port']):
-            print(f"[SSH] Aviso: Porta {SSH_CONFIG['local_bind_port']} já está em uso.")
-            print(f"[SSH] Assumindo que o túnel já está ativo...")
-            yield None
-            return
-        
-        # Monta o comando SSH para criar o túnel
-        # Formato: ssh -L local_port:remote_host:remote_port user@ssh_host -p ssh_port -N -o StrictHostKeyChecking=no
-        remote_host, remote_port = SSH_CONFIG['remote_bind_address']
-        
-        ssh_cmd = [
-            'ssh',
-            '-L', f"{SSH_CONFIG['local_bind_port']}:{remote_host}:{remote_port}",
-            '-p', str(SSH_CONFIG['ssh_port']),
-            '-l', SSH_CONFIG['ssh_user'],
-            SSH_CONFIG['ssh_host'],
-            '-N',  # Não executa comando remoto
-            '-o', 'StrictHostKeyChecking=no',  # Aceita host automaticamente
-            '-o', 'ServerAliveInterval=60',  # Keep-alive
-            '-o', 'ServerAliveCountMax=3'
-        ]
-        
-        # Se houver chave privada, adiciona ao comando
-        if SSH_CONFIG['ssh_pkey']:
-            ssh_cmd.insert(1, '-i')
-            ssh_cmd.insert(2, SSH_CONFIG['ssh_pkey'])
-        
         # Inicia o processo SSH em background
         print(f"[SSH] Estabelecendo túnel: localhost:{SSH_CONFIG['local_bind_port']} -> {remote_host}:{remote_port}")
-        
-        # No Windows, usa CREATE_NEW_PROCESS_GROUP para poder encerrar depois
-        if os.name == 'nt':  # Windows
-            processo_ssh = subprocess.Popen(
-                ssh_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
-            )
-        else:  # Linux/Mac
-            processo_ssh = subprocess.Popen(
-                ssh_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                preexec_fn=os.setsid
-            )
-        
-        # Se houver senha, envia via stdin (funciona com sshpass ou similar)
+
+        # Se houver senha, o ssh pede no terminal
         if SSH_CONFIG['ssh_password'] and not SSH_CONFIG['ssh_pkey']:
             print("[SSH] Nota: Para autenticação por senha, considere usar chave SSH.")
             print("[SSH] Você pode precisar digitar a senha manualmente...")
         
-        # Aguarda o túnel ficar disponível
+        # Aguarda o túnel ficar disponível (evento da saída do ssh, sem polling da porta)
+        inicio = time.time()
         print(f"[SSH] Aguardando túnel ficar ativo...", end=" ")
-        if aguardar_porta_aberta(SSH_CONFIG['local_bind_port'], timeout=15):
+        if abrir_forward_ssh(tunel):
             print("✓")
-            print(f"[SSH] Túnel SSH estabelecido com sucesso!")
+            print(f"[SSH] Túnel SSH estabelecido com sucesso! ({time.time() - inicio:.2f}s)")
         else:
-            raise Exception("Timeout ao aguardar túnel SSH ficar ativo")
-        
-        yield processo_ssh
+            detalhe = tunel['saida'][-1] if tunel['saida'] else 'sem resposta do ssh'
+            raise Exception(f"Túnel SSH não ficou ativo em {SSH_CONFIG['timeout_tunnel']}s: {detalhe}")
+
+        threading.Thread(target=supervisionar_tunnel, args=(tunel,), daemon=True).start()
         
     except FileNotFoundError:
-        print(f"[SSH] ERRO: Comando 'ssh' não encontrado no sistema.")
+        encerrar_tunnel()
         print(f"[SSH] Certifique-se de que o OpenSSH está instalado:")
         print(f"[SSH]   - Windows: Settings > Apps > Optional Features > OpenSSH Client")
         print(f"[SSH]   - Linux: sudo apt-get install openssh-client")
-        sys.exit(1)
+        sys.exit("[SSH] ERRO: Comando 'ssh' não encontrado no sistema.")
     except Exception as e:
-        print(f"[SSH] Erro ao estabelecer túnel: {e}")
+        encerrar_tunnel()
         print("[SSH] Verifique as configurações SSH no arquivo .env")
-        if processo_ssh:
-            try:
-                processo_ssh.terminate()
-            except:
-                pass
-        sys.exit(1)
+        sys.exit(f"[SSH] Erro ao estabelecer túnel: {e}")
+
+    try:
+        yield tunel
     finally:
-        if processo_ssh:
-            print("[SSH] Encerrando túnel SSH...", end=" ")
-            try:
-                processo_ssh.terminate()
-                processo_ssh.wait(timeout=5)
-                print("✓")
-            except:
-                try:
-                    processo_ssh.kill()
-                    print("✓ (forçado)")
-                except:
-                    print("⚠️  (processo pode continuar em background)")
-            print("[SSH] Túnel SSH encerrado.")
+        encerrar_tunnel()
+
+def descrever_falha(e):
+    """
+    Motivo de uma falha de cliente para o resumo do lote. O SystemExit da abertura do
+    túnel traz o motivo em `code` (ou só o código de saída).
+    """
+    if isinstance(e, SystemExit):
+        return e.code if isinstance(e.code, str) else f"Execução encerrada (código {e.code})"
+    return str(e)
 
 def ajustar_hosts_para_tunnel(db_config, SSH_CONFIG):
     """Ajusta host e porta dos bancos para usar túnel SSH (obrigatório)."""
@@ -468,85 +1223,1744 @@ def ajustar_hosts_para_tunnel(db_config, SSH_CONFIG):
     config['port'] = SSH_CONFIG['local_bind_port']
     return config
 
+def conectar_bancos(bancos):
+    """
+    Abre, em paralelo, uma conexão para cada banco (um handshake por banco).
+
+    Args:
+        bancos: dict { 'GESTÃO': db_config, 'CONTRATO': db_config, ... }
+
+    Returns:
+        (conexoes, erros): dict { rótulo: conexão } e dict { rótulo: exceção }
+    """
+    import psycopg2
+
+    conexoes = {}
+    erros = {}
+    with ThreadPoolExecutor(max_workers=len(bancos)) as executor:
+        futuros = {executor.submit(psycopg2.connect, **db_config): rotulo for rotulo, db_config in bancos.items()}
+        for futuro in as_completed(futuros):
+            rotulo = futuros[futuro]
+            try:
+                conexoes[rotulo] = futuro.result()
+            except Exception as e:
+                erros[rotulo] = e
+    return conexoes, erros
+
+def fechar_conexoes(conexoes):
+    """Fecha todas as conexões do registro do cliente."""
+    for conn in conexoes.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    conexoes.clear()
+
+def executar_etapa_com_reconexao(nome, funcao, conexoes, bancos, tunel, SSH_CONFIG, tentativas=3):
+    """
+    Executa `funcao(conexoes)`. Se a conexão cair no meio (túnel ou banco), espera o túnel
+    voltar (o supervisor restabelece o forward), reabre as conexões do cliente no mesmo
+    registro `conexoes` e repete a etapa, até `tentativas` vezes.
+    """
+    import psycopg2
+
+    ultimo_erro = None
+    for tentativa in range(1, tentativas + 1):
+        if ultimo_erro is not None:
+            print(f"⚠️  Conexão perdida em '{nome}' ({str(ultimo_erro).strip()[:80]}). "
+                  f"Aguardando o túnel para repetir a etapa ({tentativa}/{tentativas})...")
+            if not aguardar_tunnel(tunel, SSH_CONFIG):
+                break
+            fechar_conexoes(conexoes)
+            novas, erros = conectar_bancos(bancos)
+            conexoes.update(novas)
+            if erros:
+                ultimo_erro = next(iter(erros.values()))
+                time.sleep(min(2 ** tentativa, 30))  # banco ainda indisponível: backoff antes de tentar de novo
+                continue
+        try:
+            return funcao(conexoes)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            ultimo_erro = e
+    raise ultimo_erro
+
 def testar_conexoes(db_gestao, db_contrato, db_pessoa):
-    """Testa todas as conexões de banco de dados."""
+    """
+    Testa todas as conexões de banco de dados (em paralelo).
+
+    Returns:
+        dict { 'GESTÃO' | 'CONTRATO' | 'PESSOA': conexão } com as conexões abertas,
+        que são reaproveitadas pela análise, ou None se algum banco falhar.
+    """
     print("\n" + "="*50)
     print("TESTANDO CONEXÕES COM OS BANCOS DE DADOS")
     print("="*50)
     
-    erros = []
+    bancos = {'GESTÃO': db_gestao, 'CONTRATO': db_contrato, 'PESSOA': db_pessoa}
+    conexoes, erros = conectar_bancos(bancos)
     
-    # Teste 1: Banco GESTÃO
-    try:
-        print("[1/3] Testando conexão com banco GESTÃO...", end=" ")
-        conn = psycopg2.connect(**db_gestao)
-        conn.close()
-        print("✓ OK")
-    except Exception as e:
-        print("✗ FALHOU")
-        erros.append(f"GESTÃO: {e}")
-    
-    # Teste 2: Banco CONTRATO
-    try:
-        print("[2/3] Testando conexão com banco CONTRATO...", end=" ")
-        conn = psycopg2.connect(**db_contrato)
-        conn.close()
-        print("✓ OK")
-    except Exception as e:
-        print("✗ FALHOU")
-        erros.append(f"CONTRATO: {e}")
-    
-    # Teste 3: Banco PESSOA
-    try:
-        print("[3/3] Testando conexão com banco PESSOA...", end=" ")
-        conn = psycopg2.connect(**db_pessoa)
-        conn.close()
-        print("✓ OK")
-    except Exception as e:
-        print("✗ FALHOU")
-        erros.append(f"PESSOA: {e}")
+    for idx, rotulo in enumerate(bancos, 1):
+        status = "✗ FALHOU" if rotulo in erros else "✓ OK"
+        print(f"[{idx}/3] Testando conexão com banco {rotulo}... {status}")
     
     print("="*50)
     
     if erros:
+        fechar_conexoes(conexoes)
         print("\n❌ ERRO: Falha ao conectar nos seguintes bancos:")
-        for erro in erros:
-            print(f"   - {erro}")
+        for rotulo, erro in erros.items():
+            print(f"   - {rotulo}: {erro}")
         print("\nVerifique as configurações no arquivo .env e tente novamente.")
-        return False
+        return None
     else:
         print("\n✅ Conexões estabelecidas com sucesso!")
-        return True
+        return conexoes
+
+# --- MODO PREPARE: ÍNDICES DE CPF NORMALIZADO ---
+# (rótulo do banco, tabela, nome do índice sugerido)
+INDICES_CPF = [
+    ('GESTÃO', 'tb_usuario', 'idx_tb_usuario_cpf_normalizado'),
+    ('CONTRATO', 'segurado', 'idx_segurado_cpf_normalizado'),
+    ('PESSOA', 'pessoa', 'idx_pessoa_cpf_normalizado'),
+]
+
+def ddl_indice_cpf(tabela, nome_indice):
+    """DDL do índice de expressão sobre o CPF normalizado."""
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome_indice} ON {tabela} (({expr_cpf_normalizado('cpf_cnpj')}))"
+
+def verificar_indice_cpf(conn, tabela):
+    """
+    Verifica se a tabela já possui índice válido sobre a expressão de CPF normalizado
+    e se existe alguma coluna gerada com o CPF normalizado.
+
+    Returns:
+        (nome do índice existente ou None, nome da coluna gerada ou None)
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT i.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x
+        JOIN pg_class t ON t.oid = x.indrelid
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE t.relname = %s
+          AND x.indisvalid
+          AND x.indpred IS NULL
+    """, (tabela,))
+    indices = cur.fetchall()
+
+    cur.execute("""
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name = %s
+          AND is_generated = 'ALWAYS'
+          AND generation_expression ILIKE '%%regexp_replace%%cpf_cnpj%%'
+    """, (tabela,))
+    coluna_gerada = cur.fetchone()
+    cur.close()
+
+    # pg_get_indexdef devolve a expressão já normalizada pelo servidor, ex.:
+    # regexp_replace((cpf_cnpj)::text, '\D'::text, ''::text, 'g'::text)
+    padrao = re.compile(r"\(regexp_replace\(\(?cpf_cnpj\)?(::\w+)?,'\\d'(::text)?,''(::text)?,'g'(::text)?\)\)")
+    for nome_indice, definicao in indices:
+        if padrao.search(definicao.replace(' ', '').lower()):
+            return nome_indice, None
+
+    return None, coluna_gerada[0] if coluna_gerada else None
+
+def preparar_indices(aplicar=False, env=None, confirmar=True):
+    """
+    Modo prepare: verifica em cada banco configurado se existem os índices de expressão
+    sobre o CPF normalizado usados pelas consultas da análise. Exibe o DDL faltante e,
+    se `aplicar` for True, cria os índices após confirmação explícita (ou direto, se
+    `confirmar` for False — opção --sim da linha de comando).
+    """
+    import psycopg2
 
-def main(modo_batch=False):
-    # Carrega configurações do ambiente atual
     try:
-        DB_GESTAO, DB_CONTRATO, DB_PESSOA, SSH_CONFIG, SENHA_ACCOUNTS, URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER = carregar_configuracoes()
+        DB_GESTAO, DB_CONTRATO, DB_PESSOA, SSH_CONFIG, _, _, _ = carregar_configuracoes(env)
     except ValueError as e:
         print(f"❌ ERRO: {e}")
         sys.exit(1)
+
+    env = os.environ if env is None else env
+    cliente_nome = env.get('NOME_CLIENTE', 'CLIENTE')
+    print(f"--- PREPARE: ÍNDICES DE CPF NORMALIZADO [{cliente_nome}] ---")
+
+    bancos = {'GESTÃO': DB_GESTAO, 'CONTRATO': DB_CONTRATO, 'PESSOA': DB_PESSOA}
+
+    with gerenciar_tunnel_ssh(SSH_CONFIG):
+        faltantes = []  # (rótulo, config do banco, ddl)
+
+        for rotulo, tabela, nome_indice in INDICES_CPF:
+            db_config = ajustar_hosts_para_tunnel(bancos[rotulo], SSH_CONFIG)
+            try:
+                conn = psycopg2.connect(**db_config)
+                indice_existente, coluna_gerada = verificar_indice_cpf(conn, tabela)
+                conn.close()
+            except Exception as e:
+                print(f"   ✗ {rotulo}.{tabela}: erro ao verificar índices ({e})")
+                continue
+
+            if indice_existente:
+                print(f"   ✓ {rotulo}.{tabela}: índice {indice_existente} OK")
+                continue
+
+            if coluna_gerada:
+                print(f"   ⚠️  {rotulo}.{tabela}: coluna gerada '{coluna_gerada}' encontrada, "
+                      f"mas as consultas usam a expressão de CPF normalizado")
+            print(f"   ✗ {rotulo}.{tabela}: índice de CPF normalizado ausente")
+            faltantes.append((rotulo, db_config, ddl_indice_cpf(tabela, nome_indice)))
+
+        if not faltantes:
+            print("\n✅ Todos os índices de CPF normalizado estão presentes.")
+            return
+
+        print("\nDDL faltante:")
+        for rotulo, _, ddl in faltantes:
+            print(f"   -- {rotulo}")
+            print(f"   {ddl};")
+
+        if not aplicar:
+            print("\nExecute com 'prepare --aplicar' para criar os índices.")
+            return
+
+        if confirmar:
+            print("\n" + "="*50)
+            resposta = input(f"Criar {len(faltantes)} índice(s) em {cliente_nome}? (S/N): ").strip().upper()
+            print("="*50)
+            if resposta not in ['S', 'SIM', 'Y', 'YES']:
+                print("\n⚠️  Criação de índices cancelada pelo usuário.")
+                return
+
+        for rotulo, db_config, ddl in faltantes:
+            print(f"[{rotulo}] Criando índice...", end=" ")
+            try:
+                conn = psycopg2.connect(**db_config)
+                # CREATE INDEX CONCURRENTLY não pode rodar dentro de transação
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(ddl)
+                cur.close()
+                conn.close()
+                print("✓")
+            except Exception as e:
+                print("✗ FALHOU")
+                print(f"   └─ {e}")
+
+# --- ETAPAS DA ANÁLISE ---
+# Divergência GESTÃO x ACCOUNTS, na ordem das colunas da query de divergências.
+# Tupla nomeada em vez de dict por linha: bem menos memória por registro.
+Divergencia = namedtuple('Divergencia', [
+    'id_account', 'cpf_visual_accounts', 'cpf_visual_gestao', 'cpf_accounts_limpo', 'cpf_gestao_limpo'
+])
+
+def faixas_uuid(num_particoes):
+    """Divide o espaço dos UUIDs em `num_particoes` faixas contíguas (início, fim); a última não tem fim."""
+    limites = [str(uuid.UUID(int=i * (1 << 128) // num_particoes)) for i in range(num_particoes)]
+    return [(inicio, limites[i + 1] if i + 1 < num_particoes else None) for i, inicio in enumerate(limites)]
+
+def condicao_faixa_uuid(coluna, faixa):
+    """Condição SQL de `coluna` (uuid) dentro da faixa [início, fim)."""
+    inicio, fim = faixa
+    condicao = f"{coluna} >= '{inicio}'::uuid"
+    if fim:
+        condicao += f" AND {coluna} < '{fim}'::uuid"
+    return condicao
+
+def montar_ctes_divergencias(URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS, estrategia='dblink', tamanho_bloco=5000,
+                             faixa=None):
+    """
+    Monta o WITH da query de divergências (GESTÃO + ACCOUNTS via DBLINK), terminando
+    na CTE `divergencias`. Usado pela query de divergências e pelo modo federado.
+
+    Args:
+        estrategia: 'dblink' traz a tabela users inteira pelo dblink;
+                    'dblink_filtrado' envia ao ACCOUNTS apenas os sso_id de tb_usuario,
+                    em blocos de `tamanho_bloco` ids por chamada do dblink
+        faixa: (início, fim) de sso_id para ler só uma partição (ver faixas_uuid); o filtro
+               vale para tb_usuario e para o que o ACCOUNTS devolve pelo dblink
+    """
+    conexao_dblink = f"host={URL_ACCOUNTS} dbname={DB_ACCOUNTS_NAME_USER} user={DB_ACCOUNTS_NAME_USER} password={SENHA_ACCOUNTS}"
+    filtro_gestao = f"AND {condicao_faixa_uuid('s.sso_id::uuid', faixa)}" if faixa else ''
+
+    if estrategia == 'dblink_filtrado':
+        # O volume trafegado acompanha o número de usuários candidatos, não o tamanho de users
+        cte_accounts = f"""
+        candidatos AS (
+            SELECT sso_id::uuid AS sso_id,
+                   (ROW_NUMBER() OVER (ORDER BY sso_id) - 1) / {int(tamanho_bloco)} AS bloco
+            FROM tb_usuario
+            WHERE sso_id IS NOT NULL
+            {f"AND {condicao_faixa_uuid('sso_id::uuid', faixa)}" if faixa else ''}
+        ),
+        blocos AS (
+            SELECT bloco, ARRAY_AGG(sso_id) AS ids
+            FROM candidatos
+            GROUP BY bloco
+        ),
+        accounts AS (
+            SELECT acc.cpf_cnpj, acc.id
+            FROM blocos b
+            CROSS JOIN LATERAL dblink(
+                '{conexao_dblink}',
+                'SELECT cpf_cnpj, id FROM users WHERE id = ANY(' || quote_literal(b.ids::text) || '::uuid[])'
+            ) AS acc(cpf_cnpj varchar(255), id uuid)
+        ),"""
+    else:
+        # Com faixa, o ACCOUNTS só devolve os usuários da partição
+        sql_users = 'SELECT cpf_cnpj, id FROM users'
+        if faixa:
+            sql_users += f" WHERE {condicao_faixa_uuid('id', faixa)}".replace("'", "''")
+        cte_accounts = f"""
+        accounts AS (
+            SELECT cpf_cnpj, id
+            FROM dblink(
+                '{conexao_dblink}',
+                '{sql_users}'
+            ) AS acc(cpf_cnpj varchar(255), id uuid)
+        ),"""
+
+    return f"""
+        WITH {cte_accounts}
+        divergencias AS (
+            SELECT
+               a.id AS id_account,
+               a.cpf_cnpj AS cpf_visual_accounts,
+               s.cpf_cnpj AS cpf_visual_gestao,
+               {expr_cpf_normalizado('a.cpf_cnpj')} AS cpf_accounts_limpo,
+               {expr_cpf_normalizado('s.cpf_cnpj')} AS cpf_gestao_limpo
+            FROM tb_usuario s
+            INNER JOIN accounts a ON s.sso_id = a.id
+            WHERE {expr_cpf_normalizado('s.cpf_cnpj')} <> {expr_cpf_normalizado('a.cpf_cnpj')}
+            {filtro_gestao}
+        )"""
+
+def montar_sql_divergencias(URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS, estrategia='dblink', tamanho_bloco=5000,
+                            faixa=None):
+    """
+    Monta a query de divergências (GESTÃO + ACCOUNTS via DBLINK). Ver montar_ctes_divergencias.
+    Com `faixa`, as linhas saem ordenadas por id_account, para a partição poder ser
+    retomada a partir do último id entregue (ver buscar_particao_divergencias).
+    """
+    # Sem ';' no final: a query também é usada em DECLARE CURSOR (cursor server-side)
+    return montar_ctes_divergencias(
+        URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS, estrategia, tamanho_bloco, faixa
+    ) + f"""
+        SELECT id_account, cpf_visual_accounts, cpf_visual_gestao, cpf_accounts_limpo, cpf_gestao_limpo
+        FROM divergencias
+        {'ORDER BY id_account' if faixa else ''}
+        """
+
+def iterar_divergencias_streaming(conn, sql, tamanho_lote):
+    """
+    Executa a query de divergências em um cursor nomeado (server-side) e
+    devolve os registros em lotes de `tamanho_lote`, sem carregar tudo em memória.
+    """
+    cur = conn.cursor(name='cursor_divergencias')
+    cur.itersize = tamanho_lote
+    try:
+        cur.execute(sql)
+        while True:
+            lote = cur.fetchmany(tamanho_lote)
+            if not lote:
+                break
+            yield [Divergencia._make(row) for row in lote]
+    finally:
+        cur.close()
+
+def decodificar_linha_copy(linha):
+    """Converte uma linha do COPY em formato texto em lista de colunas, com NULL como None."""
+    return [None if c == '\\N' else c.replace('\\\\', '\\') for c in linha.split('\t')]
+
+def consumir_copy_texto(cur, sql_copy, ao_ler):
+    """
+    Executa um COPY ... TO STDOUT (formato texto) entregando cada linha, já em colunas,
+    a `ao_ler` assim que chega do servidor, sem acumular a saída inteira num buffer.
+    """
+    pendente = [b'']
+
+    def escrever(dados):
+        # O destino não é arquivo texto, então o psycopg2 entrega bytes. Junta com o
+        # resto do pedaço anterior antes de decodificar, para não cortar linha nem caractere
+        linhas = (pendente[0] + dados).split(b'\n')
+        pendente[0] = linhas.pop()
+        for linha in linhas:
+            ao_ler(decodificar_linha_copy(linha.decode()))
+
+    cur.copy_expert(sql_copy, SimpleNamespace(write=escrever))
+    if pendente[0]:
+        ao_ler(decodificar_linha_copy(pendente[0].decode()))
+
+def ler_copy_texto(cur, sql_copy):
+    """
+    Executa um COPY ... TO STDOUT (formato texto) e devolve as linhas como listas de
+    colunas, com NULL convertido para None. Para saídas pequenas (um bloco de ids).
+    """
+    linhas = []
+    consumir_copy_texto(cur, sql_copy, linhas.append)
+    return linhas
+
+def uuid_canonico(valor):
+    """Texto canônico de um UUID (minúsculo, com hífens, sem chaves); None se não for UUID."""
+    try:
+        return str(uuid.UUID(valor))
+    except (TypeError, ValueError):
+        return None
+
+def iterar_divergencias_accounts_local(conn_gestao, conn_accounts, tamanho_lote, tamanho_bloco=5000):
+    """
+    Estratégia 'local': lê os usuários de tb_usuario via COPY, montando linha a linha um
+    hash em memória por sso_id, e busca no ACCOUNTS (conexão própria) apenas os ids
+    candidatos, em blocos, também via COPY. O join e a comparação dos CPFs são feitos localmente.
+
+    Devolve lotes com o mesmo formato de linha da query de divergências.
+    """
+    # Hash local: sso_id canônico -> CPFs (gestão). Lista por chave: sso_id repetido em
+    # tb_usuario gera uma divergência por linha, como o INNER JOIN da query
+    usuarios_gestao = {}
+
+    def indexar_usuario(colunas):
+        sso_id, cpf_cnpj = colunas
+        chave = uuid_canonico(sso_id)
+        if chave is not None:
+            usuarios_gestao.setdefault(chave, []).append(cpf_cnpj)
+
+    cur_gestao = conn_gestao.cursor()
+    try:
+        consumir_copy_texto(
+            cur_gestao, "COPY (SELECT sso_id, cpf_cnpj FROM tb_usuario WHERE sso_id IS NOT NULL) TO STDOUT",
+            indexar_usuario
+        )
+    finally:
+        cur_gestao.close()
+
+    ids_candidatos = list(usuarios_gestao.keys())
+    cur_accounts = conn_accounts.cursor()
+    lote = []
+
+    try:
+        for inicio in range(0, len(ids_candidatos), tamanho_bloco):
+            bloco = ids_candidatos[inicio:inicio + tamanho_bloco]
+            sql_copy = cur_accounts.mogrify(
+                "COPY (SELECT id, cpf_cnpj FROM users WHERE id = ANY(%s::uuid[])) TO STDOUT",
+                (bloco,)
+            ).decode()
+
+            for id_account, cpf_accounts in ler_copy_texto(cur_accounts, sql_copy):
+                # Mesma semântica do SQL: CPF nulo não gera divergência
+                if cpf_accounts is None:
+                    continue
+                cpf_accounts_limpo = so_digitos(cpf_accounts)
+
+                for cpf_gestao in usuarios_gestao.get(uuid_canonico(id_account), ()):
+                    if cpf_gestao is None:
+                        continue
+                    cpf_gestao_limpo = so_digitos(cpf_gestao)
+                    if cpf_accounts_limpo == cpf_gestao_limpo:
+                        continue
+
+                    lote.append(Divergencia(id_account, cpf_accounts, cpf_gestao, cpf_accounts_limpo, cpf_gestao_limpo))
+                    if len(lote) >= tamanho_lote:
+                        yield lote
+                        lote = []
+    finally:
+        cur_accounts.close()
+
+    if lote:
+        yield lote
+
+def gerar_lotes_divergencias(conn_gestao, db_accounts, sql_base, opcoes):
+    """
+    Gera lotes de divergências conforme a estratégia de leitura do ACCOUNTS configurada.
+    A conexão do GESTÃO vem do registro do cliente; a do ACCOUNTS (estratégia 'local')
+    é aberta aqui e fechada quando o gerador termina.
+    """
+    import psycopg2
+
+    conn_accounts = None
+    try:
+        if opcoes['estrategia_accounts'] == 'local':
+            conn_accounts = psycopg2.connect(**db_accounts)
+            yield from iterar_divergencias_accounts_local(
+                conn_gestao, conn_accounts, opcoes['tamanho_lote'], opcoes['tamanho_bloco_accounts']
+            )
+        else:
+            yield from iterar_divergencias_streaming(conn_gestao, sql_base, opcoes['tamanho_lote'])
+    finally:
+        if conn_accounts:
+            conn_accounts.close()
+
+def entregar_na_fila(fila, parar, item):
+    """Coloca `item` na fila limitada, desistindo se o consumidor pediu para parar. Returns: bool."""
+    while not parar.is_set():
+        try:
+            fila.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def buscar_particao_divergencias(db_gestao, montar_consulta, faixa, tamanho_lote, fila, parar, tentativas=3,
+                                 abertas=None):
+    """
+    Lê uma partição da query de divergências numa conexão (backend) própria e entrega
+    os lotes na `fila` à medida que chegam do cursor server-side.
+
+    As linhas vêm ordenadas por id_account e só são entregues grupos completos de um
+    mesmo id. Se a conexão cair, a partição é refeita a partir do último id entregue
+    (faixa [último id, fim), pulando esse id), sem repetir nem perder linhas.
+
+    Args:
+        abertas: conjunto compartilhado onde a conexão fica registrada enquanto está
+                 aberta, para quem consome a fila poder cancelar a query em andamento
+    """
+    import psycopg2
+
+    ultimo_entregue = None
+    for tentativa in range(1, tentativas + 1):
+        if parar.is_set():
+            return
+        conn = None
+        try:
+            conn = psycopg2.connect(**db_gestao)
+            if abertas is not None:
+                abertas.add(conn)
+                if parar.is_set():
+                    return  # cancelamento pode ter passado antes do registro
+            faixa_atual = faixa if ultimo_entregue is None else (ultimo_entregue, faixa[1])
+            lote, grupo = [], []
+            for linhas in iterar_divergencias_streaming(conn, montar_consulta(faixa_atual), tamanho_lote):
+                for divergencia in linhas:
+                    if divergencia.id_account == ultimo_entregue:
+                        continue  # grupo já entregue antes da queda
+                    if grupo and divergencia.id_account != grupo[-1].id_account:
+                        lote.extend(grupo)
+                        grupo = []
+                    grupo.append(divergencia)
+                    if len(lote) >= tamanho_lote:
+                        if not entregar_na_fila(fila, parar, ('lote', lote)):
+                            return
+                        ultimo_entregue = lote[-1].id_account
+                        lote = []
+            lote.extend(grupo)
+            if lote and not entregar_na_fila(fila, parar, ('lote', lote)):
+                return
+            return
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if parar.is_set():
+                return  # query cancelada pelo consumidor, não é queda de conexão
+            if tentativa == tentativas:
+                raise
+            print(f"⚠️  Partição interrompida ({str(e).strip()[:80]}). Refazendo ({tentativa + 1}/{tentativas})...")
+            time.sleep(min(2 ** tentativa, 30))
+        finally:
+            if conn:
+                if abertas is not None:
+                    abertas.discard(conn)
+                conn.close()
+
+def gerar_lotes_divergencias_particionado(db_gestao, montar_consulta, opcoes):
+    """
+    Executa as partições da query de divergências (uma por faixa de sso_id) ao mesmo
+    tempo, cada uma na sua conexão, para usar vários núcleos do servidor. Os lotes de
+    todas as partições passam por uma fila limitada e seguem para a classificação assim
+    que chegam: a memória fica em alguns lotes por partição, não no resultado inteiro.
+
+    Args:
+        montar_consulta: função faixa -> SQL da partição (montar_sql_divergencias com a faixa)
+    """
+    faixas = faixas_uuid(opcoes['particoes_divergencias'])
+    fila = queue.Queue(maxsize=2 * len(faixas))
+    parar = threading.Event()
+    abertas = set()
+
+    def executar_particao(faixa):
+        try:
+            buscar_particao_divergencias(
+                db_gestao, montar_consulta, faixa, opcoes['tamanho_lote'], fila, parar,
+                opcoes['particoes_tentativas'], abertas=abertas
+            )
+            entregar_na_fila(fila, parar, ('fim', None))
+        except Exception as e:
+            entregar_na_fila(fila, parar, ('erro', e))
+
+    executor = ThreadPoolExecutor(max_workers=len(faixas))
+    try:
+        for faixa in faixas:
+            executor.submit(executar_particao, faixa)
+        pendentes = len(faixas)
+        while pendentes:
+            tipo, conteudo = fila.get()
+            if tipo == 'lote':
+                yield conteudo
+            elif tipo == 'fim':
+                pendentes -= 1
+            else:
+                raise conteudo
+    finally:
+        # Erro numa partição ou consumidor encerrado: as demais param na próxima entrega, e
+        # as que estão presas num fetch longo têm a query cancelada no servidor. Sem esperar
+        # as threads: o erro (ou o Ctrl+C) chega na hora, e cada uma fecha a sua conexão.
+        parar.set()
+        for conn in list(abertas):
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def coletar_cpfs(divergencias):
+    """Coleta todos os CPFs limpos (accounts e gestão) de uma lista de divergências."""
+    todos_cpfs = set()
+    for d in divergencias:
+        todos_cpfs.add(d.cpf_accounts_limpo)
+        todos_cpfs.add(d.cpf_gestao_limpo)
+    return todos_cpfs
+
+# --- CACHE DE LOOKUPS (SEGURADO / E-MAIL) ---
+def abrir_cache_lookups(cliente_nome, diretorio, ttl_horas, max_entradas, renovar=False):
+    """
+    Abre o cache em disco (SQLite) dos lookups de segurado e e-mail do cliente, por CPF
+    normalizado. Um arquivo por cliente: workers do lote paralelo não disputam o mesmo
+    banco e o limite de tamanho de um cliente não descarta as entradas dos outros.
+    Entradas com mais de `ttl_horas` são ignoradas; acima de `max_entradas` as mais
+    antigas são descartadas. Com `renovar`, nada é lido, mas tudo é regravado.
+
+    Returns:
+        dict com o estado do cache e os contadores de hits/misses
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    caminho = os.path.join(diretorio, f'cache_lookups_{cliente_nome.lower().replace(" ", "_")}.sqlite')
+    # check_same_thread=False: os lookups em paralelo usam o cache a partir de threads.
+    # WAL + timeout: leitura não bloqueia escrita e um lock momentâneo espera em vez de falhar
+    conn = sqlite3.connect(caminho, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_cpf (
+            tipo TEXT, cpf TEXT, valor TEXT, gravado_em REAL,
+            PRIMARY KEY (tipo, cpf)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_cpf_gravado_em ON cache_cpf (gravado_em)")
+    # Entradas vencidas não servem mais para nenhuma execução
+    conn.execute("DELETE FROM cache_cpf WHERE gravado_em < ?", (time.time() - ttl_horas * 3600,))
+    conn.commit()
+
+    return {
+        'conn': conn,
+        'lock': threading.Lock(),
+        'ttl': ttl_horas * 3600,
+        'max_entradas': max_entradas,
+        'renovar': renovar,
+        'hits': {'segurado': 0, 'email': 0},
+        'misses': {'segurado': 0, 'email': 0}
+    }
+
+def buscar_no_cache(cache, tipo, cpfs):
+    """
+    Busca os CPFs no cache. Se o SQLite falhar, os CPFs vão todos ao banco.
+
+    Returns:
+        (encontrados, faltantes): dict { cpf: valor } e set com os CPFs que vão ao banco
+    """
+    encontrados = {}
+    if not cache['renovar']:
+        limite = time.time() - cache['ttl']
+        lista = list(cpfs)
+        with cache['lock']:
+            try:
+                # Blocos de 500 para ficar abaixo do limite de parâmetros do SQLite
+                for inicio in range(0, len(lista), 500):
+                    bloco = lista[inicio:inicio + 500]
+                    marcadores = ','.join('?' * len(bloco))
+                    for cpf, valor in cache['conn'].execute(
+                        f"SELECT cpf, valor FROM cache_cpf WHERE tipo = ? AND gravado_em >= ? AND cpf IN ({marcadores})",
+                        [tipo, limite] + bloco
+                    ):
+                        encontrados[cpf] = valor
+            except sqlite3.OperationalError as e:
+                print(f"⚠️  Cache de lookups indisponível ({e}); consultando tudo no banco")
+                encontrados = {}
+
+    faltantes = set(cpfs) - encontrados.keys()
+    cache['hits'][tipo] += len(encontrados)
+    cache['misses'][tipo] += len(faltantes)
+    return encontrados, faltantes
+
+def gravar_no_cache(cache, tipo, valores):
+    """
+    Grava no cache o resultado { cpf: valor } consultado no banco e aplica o limite de
+    tamanho. Falha do SQLite só é avisada: o cache não derruba a análise do cliente.
+    """
+    if not valores:
+        return
+
+    agora = time.time()
+    with cache['lock']:
+        conn = cache['conn']
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache_cpf VALUES (?, ?, ?, ?)",
+                [(tipo, cpf, valor, agora) for cpf, valor in valores.items()]
+            )
+            # O rowid cresce a cada gravação: tudo abaixo de MAX(rowid) - max_entradas é mais
+            # antigo que as últimas max_entradas gravações (corte pela chave, sem COUNT(*))
+            conn.execute(
+                "DELETE FROM cache_cpf WHERE rowid <= (SELECT MAX(rowid) FROM cache_cpf) - ?",
+                (cache['max_entradas'],)
+            )
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            print(f"⚠️  Não foi possível gravar no cache de lookups: {e}")
+
+def fechar_cache_lookups(cache):
+    """Fecha o cache e devolve o resumo de hits/misses da execução."""
+    cache['conn'].close()
+    return {'hits': cache['hits'], 'misses': cache['misses']}
+
+def carregar_tabela_cpfs(conn, cpfs):
+    """
+    Carrega o conjunto de CPFs normalizados na tabela temporária tmp_lookup_cpfs
+    da sessão, via COPY (substitui o envio de listas gigantes no IN).
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_lookup_cpfs (cpf text PRIMARY KEY)
+        ON COMMIT PRESERVE ROWS
+    """)
+    cur.execute("TRUNCATE tmp_lookup_cpfs")
+    cur.copy_expert("COPY tmp_lookup_cpfs (cpf) FROM STDIN", io.StringIO('\n'.join(cpfs) + '\n'))
+    cur.execute("ANALYZE tmp_lookup_cpfs")
+    cur.close()
+
+def executar_lookup_cpfs(conn, cpfs, sql_in, sql_join, opcoes=None):
+    """
+    Executa uma consulta filtrada por um conjunto de CPFs e devolve as linhas.
+
+    Estratégias (opcoes['estrategia_lookup']):
+        'in'     -> uma única query com IN %s (comportamento original)
+        'temp'   -> COPY dos CPFs para tabela temporária + JOIN (sql_join);
+                    se a sessão não puder criar tabelas temporárias, cai para 'chunks'
+        'chunks' -> várias queries com IN %s de tamanho fixo (opcoes['tamanho_chunk_lookup'])
+    """
+    import psycopg2
+
+    estrategia = opcoes['estrategia_lookup'] if opcoes else 'in'
+
+    if estrategia == 'temp':
+        try:
+            carregar_tabela_cpfs(conn, cpfs)
+            cur = conn.cursor()
+            cur.execute(sql_join)
+            yield from cur
+            cur.close()
+            return
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"⚠️  Tabela temporária indisponível ({str(e).strip()[:80]}). Usando consultas em blocos.")
+            # Vale para o restante da execução (próximos lotes não tentam de novo)
+            opcoes['estrategia_lookup'] = estrategia = 'chunks'
+
+    cpfs = list(cpfs)
+    tamanho_chunk = opcoes['tamanho_chunk_lookup'] if estrategia == 'chunks' else len(cpfs)
+    cur = conn.cursor()
+    for inicio in range(0, len(cpfs), tamanho_chunk):
+        cur.execute(sql_in, (tuple(cpfs[inicio:inicio + tamanho_chunk]),))
+        yield from cur
+    cur.close()
+
+def consultar_segurados(conn, cpfs, opcoes=None, cache=None):
+    """
+    Retorna o set de CPFs (limpos) que existem na tabela segurado.
+    Com `cache`, só os CPFs ausentes (ou vencidos) no cache vão ao banco.
+    """
+    cpfs_existentes_segurado = set()
+    if cache:
+        encontrados, cpfs = buscar_no_cache(cache, 'segurado', cpfs)
+        cpfs_existentes_segurado.update(cpf for cpf, valor in encontrados.items() if valor == '1')
+    if not cpfs:
+        return cpfs_existentes_segurado
+
+    # Busca CPFs limpos da tabela segurado que coincidem com nossa lista
+    sql_segurado = f"""
+        SELECT {expr_cpf_normalizado('cpf_cnpj')}
+        FROM segurado
+        WHERE {expr_cpf_normalizado('cpf_cnpj')} IN %s
+    """
+    sql_segurado_join = f"""
+        SELECT {expr_cpf_normalizado('s.cpf_cnpj')}
+        FROM segurado s
+        INNER JOIN tmp_lookup_cpfs t ON {expr_cpf_normalizado('s.cpf_cnpj')} = t.cpf
+    """
+    existentes_consultados = set()
+    for row in executar_lookup_cpfs(conn, cpfs, sql_segurado, sql_segurado_join, opcoes):
+        existentes_consultados.add(row[0]) # Adiciona ao Set de existência
+
+    if cache:
+        gravar_no_cache(cache, 'segurado', {cpf: '1' if cpf in existentes_consultados else '0' for cpf in cpfs})
+    cpfs_existentes_segurado.update(existentes_consultados)
+    return cpfs_existentes_segurado
+
+def consultar_emails(conn, cpfs, opcoes=None, cache=None):
+    """
+    Retorna o mapa { 'cpf_limpo': 'email' } a partir de pessoa/contato.
+    Com `cache`, só os CPFs ausentes (ou vencidos) no cache vão ao banco.
+    """
+    mapa_emails = {}
+    if cache:
+        encontrados, cpfs = buscar_no_cache(cache, 'email', cpfs)
+        # valor None no cache = CPF consultado sem e-mail
+        mapa_emails.update((cpf, email) for cpf, email in encontrados.items() if email)
+    if not cpfs:
+        return mapa_emails
+
+    # Assumindo que o banco pessoa armazena formatado, aplicamos replace no WHERE
+    sql_emails = f"""
+        SELECT {expr_cpf_normalizado('p.cpf_cnpj')} as cpf, c.valor as email
+        FROM pessoa p
+        LEFT JOIN contato c ON p.id = c.pessoa_id
+        WHERE c.tipo = 'EMAIL'
+        AND {expr_cpf_normalizado('p.cpf_cnpj')} IN %s
+    """
+    sql_emails_join = f"""
+        SELECT {expr_cpf_normalizado('p.cpf_cnpj')} as cpf, c.valor as email
+        FROM pessoa p
+        INNER JOIN tmp_lookup_cpfs t ON {expr_cpf_normalizado('p.cpf_cnpj')} = t.cpf
+        LEFT JOIN contato c ON p.id = c.pessoa_id
+        WHERE c.tipo = 'EMAIL'
+    """
+    emails_consultados = {}
+    for cpf, email in executar_lookup_cpfs(conn, cpfs, sql_emails, sql_emails_join, opcoes):
+        if email:
+            emails_consultados[cpf] = email.strip() # Normaliza email
+
+    if cache:
+        gravar_no_cache(cache, 'email', {cpf: emails_consultados.get(cpf) for cpf in cpfs})
+    mapa_emails.update(emails_consultados)
+    return mapa_emails
+
+def classificar_divergencias(divergencias, cpfs_existentes_segurado, mapa_emails, listas):
+    """Aplica as regras de negócio e distribui cada divergência na lista da sua categoria."""
+    # CPF/CNPJ dos dois lados validados num único bloco (tamanho e dígitos verificadores)
+    validos = validar_documentos(
+        [item.cpf_accounts_limpo for item in divergencias] + [item.cpf_gestao_limpo for item in divergencias]
+    )
+    validos_acc, validos_ges = validos[:len(divergencias)], validos[len(divergencias):]
+
+    for item, valido_acc, valido_ges in zip(divergencias, validos_acc, validos_ges):
+        cpf_acc = item.cpf_accounts_limpo
+        cpf_ges = item.cpf_gestao_limpo
+
+        # Verifica existência na tabela segurado
+        existe_acc = cpf_acc in cpfs_existentes_segurado
+        existe_ges = cpf_ges in cpfs_existentes_segurado
+
+        # Estrutura base do relatório (os booleanos viram SIM/NAO só na exportação)
+        linha_relatorio = LinhaRelatorio(
+            item.id_account,  # sso_id em gestão = id em accounts
+            item.cpf_visual_gestao,
+            item.cpf_visual_accounts,
+            existe_ges,
+            existe_acc,
+            None
+        )
+
+        # CASO 0: DOCUMENTO MALFORMADO EM UM DOS LADOS (a divergência vem do próprio cadastro)
+        if not (valido_acc and valido_ges):
+            listas['documento_invalido'].append(linha_relatorio)
+            continue
+
+        # CASO 1: AMBOS INEXISTENTES EM SEGURADO
+        if not existe_acc and not existe_ges:
+            listas['ambos_inexistentes'].append(linha_relatorio)
+            continue
+
+        # CASO 2: UM DELES INEXISTENTE
+        if (existe_acc and not existe_ges) or (not existe_acc and existe_ges):
+            listas['um_inexistente'].append(linha_relatorio)
+            # Nota: O fluxo pode parar aqui ou continuar para verificar email mesmo assim?
+            # Pela lógica comum, se um não existe, é inconsistência de cadastro, mas vamos verificar email apenas se ambos existirem ou se solicitado.
+            # Vou assumir que se falta um, já cai nessa categoria e encerra.
+            continue
+
+        # CASO 3: AMBOS EXISTEM -> VERIFICAR EMAIL
+        email_acc = mapa_emails.get(cpf_acc)
+        email_ges = mapa_emails.get(cpf_ges)
+
+        if email_acc and email_ges and (email_acc == email_ges):
+            listas['email_duplicado'].append(linha_relatorio._replace(email_comum=email_acc))
+        else:
+            # Se chegou aqui: existem no segurado, mas emails diferentes ou nulos
+            listas['outros'].append(linha_relatorio)
+
+def classificar_divergencias_vetorizado(divergencias, cpfs_existentes_segurado, mapa_emails, listas):
+    """
+    Mesmas regras de classificar_divergencias (mesmo resultado, na mesma ordem), aplicadas
+    em bloco com numpy: CPFs, flags de segurado e e-mails viram arrays e as quatro categorias
+    saem de máscaras booleanas, sem desvio por linha. Só a montagem das linhas do relatório
+    continua sendo por registro.
+    """
+    import numpy as np
+
+    if not divergencias:
+        return
+
+    # CPF nulo vira '-', que nunca coincide com um CPF normalizado (só dígitos)
+    cpf_acc = np.array(['-' if item.cpf_accounts_limpo is None else item.cpf_accounts_limpo for item in divergencias])
+    cpf_ges = np.array(['-' if item.cpf_gestao_limpo is None else item.cpf_gestao_limpo for item in divergencias])
+
+    # Existência na tabela segurado
+    segurados = np.array(list(cpfs_existentes_segurado) or ['-'])
+    existe_acc = np.isin(cpf_acc, segurados) & (cpf_acc != '-')
+    existe_ges = np.isin(cpf_ges, segurados) & (cpf_ges != '-')
+
+    # E-mails: busca binária nas chaves ordenadas do mapa ('' = sem e-mail)
+    if mapa_emails:
+        chaves = np.array(sorted(mapa_emails))
+        valores = np.array([mapa_emails[chave] for chave in chaves], dtype=object)
+
+        def emails_de(cpfs):
+            posicoes = np.searchsorted(chaves, cpfs).clip(max=len(chaves) - 1)
+            encontrado = chaves[posicoes] == cpfs
+            return np.where(encontrado, valores[posicoes], '')
+
+        email_acc = emails_de(cpf_acc)
+        email_ges = emails_de(cpf_ges)
+        mesmo_email = (email_acc != '') & (email_ges != '') & (email_acc == email_ges)
+    else:
+        email_acc = np.full(len(divergencias), '', dtype=object)
+        mesmo_email = np.zeros(len(divergencias), dtype=bool)
+
+    documento_ok = (
+        validar_documentos_vetorizado([item.cpf_accounts_limpo for item in divergencias])
+        & validar_documentos_vetorizado([item.cpf_gestao_limpo for item in divergencias])
+    )
+    ambos_existem = existe_acc & existe_ges & documento_ok
+    mascaras = {
+        'documento_invalido': ~documento_ok,
+        'ambos_inexistentes': ~existe_acc & ~existe_ges & documento_ok,
+        'um_inexistente': (existe_acc ^ existe_ges) & documento_ok,
+        'email_duplicado': ambos_existem & mesmo_email,
+        'outros': ambos_existem & ~mesmo_email
+    }
+
+    # Flags como listas de bool do Python (não numpy.bool_) para as linhas do relatório
+    existe_acc, existe_ges = existe_acc.tolist(), existe_ges.tolist()
+    for categoria, mascara in mascaras.items():
+        lista = listas[categoria]
+        for i in np.flatnonzero(mascara).tolist():
+            item = divergencias[i]
+            lista.append(LinhaRelatorio(
+                item.id_account,  # sso_id em gestão = id em accounts
+                item.cpf_visual_gestao,
+                item.cpf_visual_accounts,
+                existe_ges[i],
+                existe_acc[i],
+                email_acc[i] if categoria == 'email_duplicado' else None
+            ))
+
+def classificar_lote(divergencias, cpfs_existentes_segurado, mapa_emails, listas, opcoes=None):
+    """Passo 4 com o motor escolhido em MOTOR_CLASSIFICACAO."""
+    if opcoes and opcoes['motor_classificacao'] == 'vetorizado':
+        classificar_divergencias_vetorizado(divergencias, cpfs_existentes_segurado, mapa_emails, listas)
+    else:
+        classificar_divergencias(divergencias, cpfs_existentes_segurado, mapa_emails, listas)
+
+# --- MODO FEDERADO (CLASSIFICAÇÃO NO SERVIDOR) ---
+def montar_conexao_dblink(db, host, porta):
+    """String de conexão do dblink para um banco do cliente, visto a partir do servidor do GESTÃO."""
+    return f"host={host} port={porta} dbname={db['database']} user={db['user']} password={db['password']}"
+
+def consulta_remota_por_cpfs(conexao, sql_remoto, colunas):
+    """
+    Chamada do dblink por bloco de CPFs (CTE `blocos_cpfs`): `sql_remoto` termina em
+    'ANY(' e recebe o array do bloco como literal.
+    """
+    sql_remoto = sql_remoto.replace("'", "''")
+    return f"""
+            SELECT r.*
+            FROM blocos_cpfs b
+            CROSS JOIN LATERAL dblink(
+                '{conexao}',
+                '{sql_remoto}' || quote_literal(b.cpfs::text) || '::text[])'
+            ) AS r({colunas})"""
+
+def montar_sql_federado(URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS, DB_CONTRATO, DB_PESSOA, opcoes):
+    """
+    Monta a query do modo federado: divergências, existência em segurado, e-mails e
+    regras de negócio do passo 4 executados no GESTÃO, que alcança CONTRATO e PESSOA
+    por dblink (blocos de CPFs) ou por tabelas estrangeiras do postgres_fdw.
+
+    Devolve uma linha por divergência: categoria + colunas de LinhaRelatorio.
+    """
+    ctes_divergencias = montar_ctes_divergencias(
+        URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS,
+        estrategia=opcoes['estrategia_accounts'], tamanho_bloco=opcoes['tamanho_bloco_accounts']
+    )
+    cpf_segurado = expr_cpf_normalizado('cpf_cnpj')
+    cpf_pessoa = expr_cpf_normalizado('p.cpf_cnpj')
+
+    if opcoes['federacao'] == 'postgres_fdw':
+        # segurado, pessoa e contato importados como tabelas estrangeiras (IMPORT FOREIGN SCHEMA)
+        ctes_lookups = f"""
+        segurados AS (
+            SELECT DISTINCT {cpf_segurado} AS cpf
+            FROM {opcoes['federacao_schema_contrato']}.segurado
+            WHERE {cpf_segurado} IN (SELECT cpf FROM cpfs)
+        ),
+        emails_brutos AS (
+            SELECT {cpf_pessoa} AS cpf, c.valor AS email
+            FROM {opcoes['federacao_schema_pessoa']}.pessoa p
+            LEFT JOIN {opcoes['federacao_schema_pessoa']}.contato c ON p.id = c.pessoa_id
+            WHERE c.tipo = 'EMAIL'
+            AND {cpf_pessoa} IN (SELECT cpf FROM cpfs)
+        ),"""
+    else:
+        host, porta = opcoes['federacao_host'], opcoes['federacao_porta']
+        segurados_remoto = consulta_remota_por_cpfs(
+            montar_conexao_dblink(DB_CONTRATO, host, porta),
+            f"SELECT DISTINCT {cpf_segurado} FROM segurado WHERE {cpf_segurado} = ANY(",
+            'cpf text'
+        )
+        emails_remoto = consulta_remota_por_cpfs(
+            montar_conexao_dblink(DB_PESSOA, host, porta),
+            f"SELECT {cpf_pessoa}, c.valor FROM pessoa p LEFT JOIN contato c ON p.id = c.pessoa_id "
+            f"WHERE c.tipo = 'EMAIL' AND {cpf_pessoa} = ANY(",
+            'cpf text, email text'
+        )
+        ctes_lookups = f"""
+        cpfs_numerados AS (
+            SELECT cpf, (ROW_NUMBER() OVER (ORDER BY cpf) - 1) / {int(opcoes['tamanho_chunk_lookup'])} AS bloco
+            FROM cpfs
+        ),
+        blocos_cpfs AS (
+            SELECT bloco, ARRAY_AGG(cpf) AS cpfs
+            FROM cpfs_numerados
+            GROUP BY bloco
+        ),
+        segurados AS (SELECT DISTINCT cpf FROM ({segurados_remoto}
+        ) seg),
+        emails_brutos AS ({emails_remoto}
+        ),"""
+
+    # Mesmas regras de classificar_divergencias; e-mail vazio conta como sem e-mail
+    return f"""
+        {ctes_divergencias},
+        cpfs AS (
+            SELECT cpf_accounts_limpo AS cpf FROM divergencias WHERE cpf_accounts_limpo IS NOT NULL
+            UNION
+            SELECT cpf_gestao_limpo FROM divergencias WHERE cpf_gestao_limpo IS NOT NULL
+        ),
+        {ctes_lookups.strip()}
+        emails AS (
+            SELECT DISTINCT ON (cpf) cpf, BTRIM(email, E' \\t\\r\\n') AS email
+            FROM emails_brutos
+            WHERE email <> ''
+            ORDER BY cpf
+        ),
+        cruzadas AS (
+            SELECT d.id_account, d.cpf_visual_gestao, d.cpf_visual_accounts,
+                   sg.cpf IS NOT NULL AS existe_ges, sa.cpf IS NOT NULL AS existe_acc,
+                   eg.email AS email_ges, ea.email AS email_acc
+            FROM divergencias d
+            LEFT JOIN segurados sa ON sa.cpf = d.cpf_accounts_limpo
+            LEFT JOIN segurados sg ON sg.cpf = d.cpf_gestao_limpo
+            LEFT JOIN emails ea ON ea.cpf = d.cpf_accounts_limpo
+            LEFT JOIN emails eg ON eg.cpf = d.cpf_gestao_limpo
+        ),
+        classificadas AS (
+            SELECT *,
+                   CASE
+                       WHEN NOT existe_acc AND NOT existe_ges THEN 'ambos_inexistentes'
+                       WHEN existe_acc <> existe_ges THEN 'um_inexistente'
+                       WHEN email_acc <> '' AND email_acc = email_ges THEN 'email_duplicado'
+                       ELSE 'outros'
+                   END AS categoria
+            FROM cruzadas
+        )
+        SELECT categoria, id_account, cpf_visual_gestao, cpf_visual_accounts, existe_ges, existe_acc,
+               CASE WHEN categoria = 'email_duplicado' THEN email_acc END AS email_comum
+        FROM classificadas
+        """
+
+def executar_analise_federada(conn_gestao, sql_federado, listas, opcoes, saida=None, metricas=None):
+    """
+    Executa a query federada num cursor server-side e distribui as linhas, já
+    classificadas, nas listas de cada categoria (ou direto na saída em lote).
+
+    Returns:
+        total de divergências classificadas
+    """
+    total_divergencias = 0
+    cur = conn_gestao.cursor(name='cursor_federado')
+    cur.itersize = opcoes['tamanho_lote']
+    try:
+        with medir_etapa(metricas, 'federado') as etapa:
+            cur.execute(sql_federado)
+            while True:
+                lote = cur.fetchmany(opcoes['tamanho_lote'])
+                if not lote:
+                    break
+                # Regras de documento no cliente: normalização e dígitos verificadores em bloco
+                validos = validar_documentos(
+                    normalizar_documentos([row[2] for row in lote] + [row[3] for row in lote])
+                )
+                for i, (categoria, *colunas) in enumerate(lote):
+                    linha = LinhaRelatorio._make(colunas)
+                    if not (validos[i] and validos[len(lote) + i]):
+                        categoria, linha = 'documento_invalido', linha._replace(email_comum=None)
+                    listas[categoria].append(linha)
+                total_divergencias += len(lote)
+                etapa['linhas'] += len(lote)
+                if saida:
+                    descarregar_listas_na_saida(listas, saida)
+    finally:
+        cur.close()
+    return total_divergencias
+
+# --- E-MAILS COMPARTILHADOS (TODA A BASE PESSOA/CONTATO) ---
+# Acima disso a lista de CPFs do grupo é cortada (a quantidade continua exata); cabe numa célula do Excel
+MAX_CPFS_POR_EMAIL = 1000
+
+def sql_emails_contato(ordenado):
+    """E-mails (normalizados: sem espaços nas pontas, minúsculos) e CPFs de toda a base pessoa/contato."""
+    return f"""
+        SELECT LOWER(BTRIM(c.valor)) AS email, {expr_cpf_normalizado('p.cpf_cnpj')} AS cpf
+        FROM pessoa p
+        INNER JOIN contato c ON p.id = c.pessoa_id
+        WHERE c.tipo = 'EMAIL'
+        AND BTRIM(c.valor) <> ''
+        AND p.cpf_cnpj IS NOT NULL
+        {'ORDER BY 1' if ordenado else ''}
+        """
+
+def iterar_contatos_email(conn, ordenado, tamanho_lote):
+    """Lê os pares (email, cpf) por cursor server-side, em lotes, sem carregar a base em memória."""
+    cur = conn.cursor(name='cursor_emails_contato')
+    cur.itersize = tamanho_lote
+    try:
+        cur.execute(sql_emails_contato(ordenado))
+        while True:
+            lote = cur.fetchmany(tamanho_lote)
+            if not lote:
+                break
+            yield lote
+    finally:
+        cur.close()
+
+def linha_email_compartilhado(email, cpfs):
+    """Linha do relatório para um e-mail com mais de um CPF."""
+    cpfs = sorted(cpfs)
+    return LinhaEmailCompartilhado(email, len(cpfs), ', '.join(cpfs[:MAX_CPFS_POR_EMAIL]))
+
+def agrupar_emails_ordenados(lotes):
+    """
+    Estratégia 'ordenado': o banco entrega os pares ordenados por e-mail e cada grupo é
+    fechado quando o e-mail muda. Memória: um grupo por vez.
+    """
+    email_atual, cpfs = None, set()
+    for lote in lotes:
+        for email, cpf in lote:
+            if email != email_atual:
+                if len(cpfs) > 1:
+                    yield linha_email_compartilhado(email_atual, cpfs)
+                email_atual, cpfs = email, set()
+            cpfs.add(cpf)
+    if len(cpfs) > 1:
+        yield linha_email_compartilhado(email_atual, cpfs)
+
+def agrupar_emails_particionados(lotes, num_particoes):
+    """
+    Estratégia 'hash': sem ORDER BY no banco. Os pares são espalhados por hash do e-mail
+    em `num_particoes` arquivos temporários; depois cada partição vira um índice
+    { email: set(cpfs) } em memória, uma por vez. Memória: a maior partição.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix='emails_compartilhados_') as diretorio:
+        # csv com tab: tab, aspas e quebras de linha (\n ou \r) dentro do e-mail vão entre
+        # aspas e voltam intactos; newline='' para o arquivo não reinterpretar as quebras
+        particoes = [
+            open(os.path.join(diretorio, f'particao_{i}.tsv'), 'w', encoding='utf-8', newline='')
+            for i in range(num_particoes)
+        ]
+        try:
+            escritores = [csv.writer(particao, delimiter='\t') for particao in particoes]
+            for lote in lotes:
+                for email, cpf in lote:
+                    escritores[hash(email) % num_particoes].writerow((email, cpf))
+        finally:
+            for particao in particoes:
+                particao.close()
+
+        for i in range(num_particoes):
+            indice = {}
+            with open(os.path.join(diretorio, f'particao_{i}.tsv'), encoding='utf-8', newline='') as particao:
+                for email, cpf in csv.reader(particao, delimiter='\t'):
+                    indice.setdefault(email, set()).add(cpf)
+            for email in sorted(indice):
+                if len(indice[email]) > 1:
+                    yield linha_email_compartilhado(email, indice[email])
+
+def detectar_emails_compartilhados(conn_pessoa, opcoes, saida=None, etapa=None):
+    """
+    Encontra os e-mails compartilhados por mais de um CPF em toda a base pessoa/contato
+    (não só nas duplas divergentes). Com `saida`, os grupos vão para o arquivo da
+    categoria 'emails_compartilhados' lote a lote.
+
+    Returns:
+        lista de LinhaEmailCompartilhado (vazia quando gravada direto na saída)
+    """
+    ordenado = opcoes['estrategia_emails_compartilhados'] == 'ordenado'
+    contador = {'contatos': 0}
+
+    def lotes_contados():
+        for lote in iterar_contatos_email(conn_pessoa, ordenado, opcoes['tamanho_lote']):
+            contador['contatos'] += len(lote)
+            yield lote
+
+    if ordenado:
+        grupos = agrupar_emails_ordenados(lotes_contados())
+    else:
+        grupos = agrupar_emails_particionados(lotes_contados(), opcoes['particoes_emails_compartilhados'])
+
+    linhas = []
+    for grupo in grupos:
+        linhas.append(grupo)
+        if saida and len(linhas) >= opcoes['tamanho_lote']:
+            escrever_lote_saida(saida, 'emails_compartilhados', linhas)
+            linhas = []
+    if saida:
+        escrever_lote_saida(saida, 'emails_compartilhados', linhas)
+        linhas = []
+
+    if etapa is not None:
+        etapa['linhas'] = contador['contatos']
+    return linhas
+
+# --- ANÁLISE INCREMENTAL (SNAPSHOT POR CLIENTE) ---
+def hash_divergencia(item):
+    """Hash do conteúdo de uma divergência (muda se qualquer CPF da dupla mudar)."""
+    conteudo = '|'.join(str(valor) for valor in [
+        item.id_account, item.cpf_visual_gestao, item.cpf_visual_accounts, item.cpf_gestao_limpo, item.cpf_accounts_limpo
+    ])
+    return hashlib.sha1(conteudo.encode('utf-8')).hexdigest()
+
+def abrir_snapshot_incremental(cliente_nome, diretorio, max_dias, agora=None):
+    """
+    Abre o snapshot local (SQLite) do cliente com o resultado da última execução e
+    prepara a tabela que vai receber o resultado desta execução.
+
+    Args:
+        agora: instante de referência da execução (padrão: agora); a retomada passa o
+               da execução original, para o corte de max_dias não mudar entre as tentativas
+
+    Returns:
+        dict com o estado da análise incremental desta execução
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    caminho = os.path.join(diretorio, f'snapshot_{cliente_nome.lower().replace(" ", "_")}.sqlite')
+    conn = sqlite3.connect(caminho)
+
+    colunas = """
+        uuid TEXT PRIMARY KEY, hash TEXT,
+        cpf_visual_gestao TEXT, cpf_visual_accounts TEXT,
+        cpf_gestao_limpo TEXT, cpf_accounts_limpo TEXT,
+        existe_ges INTEGER, existe_acc INTEGER,
+        email_ges TEXT, email_acc TEXT,
+        verificado_em REAL
+    """
+    conn.execute(f"CREATE TABLE IF NOT EXISTS snapshot ({colunas})")
+    conn.execute("DROP TABLE IF EXISTS snapshot_novo")
+    conn.execute(f"CREATE TABLE snapshot_novo ({colunas})")
+
+    snapshot = {}
+    for row in conn.execute("""
+        SELECT uuid, hash, cpf_gestao_limpo, cpf_accounts_limpo, existe_ges, existe_acc,
+               email_ges, email_acc, verificado_em
+        FROM snapshot
+    """):
+        snapshot[row[0]] = row[1:]
+
+    return {
+        'conn': conn,
+        'snapshot': snapshot,
+        'agora': time.time() if agora is None else agora,
+        'max_idade': max_dias * 86400,
+        'reaproveitadas': 0,
+        'delta': []  # novas/alteradas/corrigidas, para a aba de delta do relatório
+    }
+
+def separar_divergencias_incrementais(divergencias, incremental):
+    """
+    Separa as divergências que podem reaproveitar o resultado do snapshot (mesmo hash
+    e verificadas há menos de max_idade) das que precisam ser consultadas de novo.
+
+    Returns:
+        (pendentes, reaproveitadas)
+    """
+    snapshot = incremental['snapshot']
+    limite = incremental['agora'] - incremental['max_idade']
+    pendentes = []
+    reaproveitadas = []
+
+    for item in divergencias:
+        anterior = snapshot.get(str(item.id_account))
+        if anterior and anterior[0] == hash_divergencia(item) and anterior[7] >= limite:
+            reaproveitadas.append(item)
+        else:
+            pendentes.append(item)
+
+    incremental['reaproveitadas'] += len(reaproveitadas)
+    return pendentes, reaproveitadas
+
+def completar_com_snapshot(reaproveitadas, incremental, cpfs_consultados, cpfs_existentes_segurado, mapa_emails):
+    """
+    Completa o set de segurados e o mapa de e-mails com os dados do snapshot para os
+    CPFs das divergências reaproveitadas que não foram consultados nesta execução.
+    """
+    snapshot = incremental['snapshot']
+    for item in reaproveitadas:
+        _, cpf_ges, cpf_acc, existe_ges, existe_acc, email_ges, email_acc, _ = snapshot[str(item.id_account)]
+        for cpf, existe, email in [(cpf_ges, existe_ges, email_ges), (cpf_acc, existe_acc, email_acc)]:
+            if cpf in cpfs_consultados:
+                continue  # o resultado da consulta atual prevalece
+            if existe:
+                cpfs_existentes_segurado.add(cpf)
+            if email:
+                mapa_emails[cpf] = email
+
+def registrar_snapshot(divergencias, incremental, cpfs_existentes_segurado, mapa_emails, reaproveitadas=()):
+    """Grava o resultado das divergências no snapshot desta execução e registra o delta."""
+    snapshot = incremental['snapshot']
+    uuids_reaproveitados = {str(item.id_account) for item in reaproveitadas}
+    linhas = []
+
+    for item in divergencias:
+        uuid_comum = str(item.id_account)
+        hash_atual = hash_divergencia(item)
+        anterior = snapshot.get(uuid_comum)
+        cpf_ges = item.cpf_gestao_limpo
+        cpf_acc = item.cpf_accounts_limpo
+
+        if uuid_comum in uuids_reaproveitados:
+            verificado_em = anterior[7]
+        else:
+            verificado_em = incremental['agora']
+            if anterior is None or anterior[0] != hash_atual:
+                incremental['delta'].append(LinhaDelta(
+                    uuid_comum, item.cpf_visual_gestao, item.cpf_visual_accounts,
+                    'NOVA' if anterior is None else 'ALTERADA'
+                ))
+
+        linhas.append((
+            uuid_comum, hash_atual,
+            item.cpf_visual_gestao, item.cpf_visual_accounts, cpf_ges, cpf_acc,
+            int(cpf_ges in cpfs_existentes_segurado), int(cpf_acc in cpfs_existentes_segurado),
+            mapa_emails.get(cpf_ges), mapa_emails.get(cpf_acc),
+            verificado_em
+        ))
+
+    incremental['conn'].executemany(
+        "INSERT OR REPLACE INTO snapshot_novo VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", linhas
+    )
+
+def finalizar_snapshot(incremental):
+    """
+    Registra as divergências corrigidas (presentes no snapshot anterior e ausentes agora)
+    e substitui o snapshot anterior pelo desta execução.
+
+    Returns:
+        dict com a contagem de novas, alteradas, corrigidas e reaproveitadas
+    """
+    conn = incremental['conn']
+    for uuid_comum, cpf_gestao, cpf_accounts in conn.execute("""
+        SELECT uuid, cpf_visual_gestao, cpf_visual_accounts
+        FROM snapshot
+        WHERE uuid NOT IN (SELECT uuid FROM snapshot_novo)
+    """):
+        incremental['delta'].append(LinhaDelta(uuid_comum, cpf_gestao, cpf_accounts, 'CORRIGIDA'))
+
+    conn.execute("DROP TABLE snapshot")
+    conn.execute("ALTER TABLE snapshot_novo RENAME TO snapshot")
+    conn.commit()
+    conn.close()
+
+    situacoes = [d.situacao for d in incremental['delta']]
+    return {
+        'novas': situacoes.count('NOVA'),
+        'alteradas': situacoes.count('ALTERADA'),
+        'corrigidas': situacoes.count('CORRIGIDA'),
+        'reaproveitadas': incremental['reaproveitadas']
+    }
+
+# --- CHECKPOINTS DE ETAPAS (RETOMADA APÓS FALHA) ---
+# Conversão do JSON gravado de volta para o tipo de cada etapa
+TIPOS_CHECKPOINT = {
+    '0_inicio_incremental': float,
+    '1_divergencias': lambda linhas: [Divergencia._make(linha) for linha in linhas],
+    '2_segurado': set,
+    '3_emails': dict
+}
+
+# Modos em que as etapas não passam pelos checkpoints: --resume só pula o cliente já concluído
+MODOS_SEM_CHECKPOINT_DE_ETAPA = {'modo_streaming': 'MODO_STREAMING', 'modo_federado': 'MODO_FEDERADO'}
+
+def caminho_checkpoints(cliente_nome, diretorio):
+    """Arquivo SQLite dos checkpoints do cliente."""
+    return os.path.join(diretorio, f'checkpoints_{cliente_nome.lower().replace(" ", "_")}.sqlite')
+
+def novo_id_execucao():
+    """Identificador de execução (data/hora), compartilhado por todos os clientes de um lote."""
+    return time.strftime('%Y%m%d_%H%M%S')
+
+def abrir_checkpoints(cliente_nome, diretorio, opcoes, id_execucao=None, retomar=False):
+    """
+    Abre o registro local (SQLite) de checkpoints do cliente, com o resultado de cada
+    etapa já concluída, por execução. Com `retomar`, continua a execução `id_execucao`
+    (ou a última não concluída do cliente); sem ele, inicia uma execução nova e descarta
+    as etapas das execuções anteriores que não chegaram ao fim.
+
+    Returns:
+        dict com o estado dos checkpoints desta execução ('status' 'concluida' quando a
+        execução retomada já tinha terminado)
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    conn = sqlite3.connect(caminho_checkpoints(cliente_nome, diretorio))
+    # As etapas têm CPFs e e-mails: o que é apagado é sobrescrito no arquivo, não só liberado
+    conn.execute("PRAGMA secure_delete = ON")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS execucoes (
+            id TEXT PRIMARY KEY, status TEXT, assinatura TEXT,
+            iniciada_em REAL, concluida_em REAL, resumo TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS etapas (
+            id_execucao TEXT, etapa TEXT, dados BLOB, gravada_em REAL,
+            PRIMARY KEY (id_execucao, etapa)
+        )
+    """)
+
+    # Opções que mudam o conteúdo das etapas (no incremental os lookups cobrem só os CPFs pendentes)
+    assinatura = json.dumps({'modo_incremental': opcoes['modo_incremental']})
+
+    execucao = None
+    if retomar:
+        if id_execucao:
+            execucao = conn.execute(
+                "SELECT id, status, assinatura, resumo FROM execucoes WHERE id = ?", (id_execucao,)
+            ).fetchone()
+        else:
+            execucao = conn.execute(
+                "SELECT id, status, assinatura, resumo FROM execucoes "
+                "WHERE status = 'em_andamento' ORDER BY iniciada_em DESC LIMIT 1"
+            ).fetchone()
+
+    checkpoint = {
+        'conn': conn,
+        'id': execucao[0] if execucao else (id_execucao or novo_id_execucao()),
+        'status': execucao[1] if execucao else 'em_andamento',
+        'resumo': json.loads(execucao[3]) if execucao and execucao[3] else None,
+        'retomada': execucao is not None,
+        'retomadas': []  # etapas reaproveitadas nesta execução
+    }
+
+    if execucao and execucao[2] != assinatura:
+        # Etapas gravadas com outras opções: a execução continua, mas refaz tudo
+        conn.execute("DELETE FROM etapas WHERE id_execucao = ?", (checkpoint['id'],))
+        conn.execute("UPDATE execucoes SET assinatura = ? WHERE id = ?", (assinatura, checkpoint['id']))
+        print(f"⚠️  Opções diferentes da execução {checkpoint['id']}: as etapas serão refeitas.")
+    elif not execucao:
+        # Execução nova: só a última execução não concluída pode ser retomada
+        conn.execute("""
+            DELETE FROM etapas WHERE id_execucao IN (
+                SELECT id FROM execucoes WHERE status = 'em_andamento'
+            ) OR id_execucao = ?
+        """, (checkpoint['id'],))
+        conn.execute("UPDATE execucoes SET status = 'abandonada' WHERE status = 'em_andamento'")
+        conn.execute(
+            "INSERT OR REPLACE INTO execucoes VALUES (?, 'em_andamento', ?, ?, NULL, NULL)",
+            (checkpoint['id'], assinatura, time.time())
+        )
+    conn.commit()
+    return checkpoint
+
+def descartar_checkpoints(cliente_nome, diretorio):
+    """
+    Apaga o registro de checkpoints do cliente (execução com CHECKPOINTS=N), para não
+    deixar em disco as etapas de uma execução anterior que falhou.
+    """
+    caminho = caminho_checkpoints(cliente_nome, diretorio)
+    for arquivo in [caminho, caminho + '-journal']:
+        if os.path.exists(arquivo):
+            os.remove(arquivo)
+
+def ler_checkpoint(checkpoint, etapa):
+    """Resultado gravado da etapa nesta execução, ou None se ela ainda não foi concluída."""
+    if not checkpoint:
+        return None
+    row = checkpoint['conn'].execute(
+        "SELECT dados FROM etapas WHERE id_execucao = ? AND etapa = ?", (checkpoint['id'], etapa)
+    ).fetchone()
+    if row is None:
+        return None
+    checkpoint['retomadas'].append(etapa)
+    return TIPOS_CHECKPOINT[etapa](json.loads(gzip.decompress(row[0]).decode('utf-8')))
+
+def gravar_checkpoint(checkpoint, etapa, dados):
+    """Grava (JSON compactado) o resultado de uma etapa concluída."""
+    if not checkpoint:
+        return
+    if isinstance(dados, set):
+        dados = list(dados)
+    checkpoint['conn'].execute(
+        "INSERT OR REPLACE INTO etapas VALUES (?, ?, ?, ?)",
+        (checkpoint['id'], etapa, gzip.compress(json.dumps(dados).encode('utf-8'), compresslevel=1), time.time())
+    )
+    checkpoint['conn'].commit()
+
+def concluir_checkpoint(checkpoint, resumo=None):
+    """
+    Marca a execução como concluída (relatório gerado), guarda o resumo para que uma
+    retomada do lote pule o cliente e descarta os dados das etapas.
+    """
+    if not checkpoint:
+        return
+    resumo = {chave: valor for chave, valor in resumo.items() if chave != 'metricas'} if resumo else None
+    conn = checkpoint['conn']
+    conn.execute(
+        "UPDATE execucoes SET status = 'concluida', concluida_em = ?, resumo = ? WHERE id = ?",
+        (time.time(), json.dumps(resumo, ensure_ascii=False) if resumo else None, checkpoint['id'])
+    )
+    conn.execute("DELETE FROM etapas WHERE id_execucao = ?", (checkpoint['id'],))
+    conn.commit()
+    checkpoint['status'] = 'concluida'
+
+def fechar_checkpoints(checkpoint, silent=False):
+    """Fecha o registro; se a execução não terminou, indica como retomá-la."""
+    if checkpoint['status'] != 'concluida':
+        etapas = [row[0] for row in checkpoint['conn'].execute(
+            "SELECT etapa FROM etapas WHERE id_execucao = ? ORDER BY etapa", (checkpoint['id'],)
+        )]
+        if etapas and not silent:
+            print(f"💾 Etapas salvas ({', '.join(etapas)}): use --resume para continuar a execução {checkpoint['id']}")
+    checkpoint['conn'].close()
+
+def ler_ultimo_lote(diretorio):
+    """Identificador da última execução em lote (para retomar o lote), ou None."""
+    try:
+        with open(os.path.join(diretorio, 'ultimo_lote.json'), encoding='utf-8') as f:
+            return json.load(f)['id_execucao']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def registrar_ultimo_lote(diretorio, id_execucao, lista_clientes):
+    """Registra o identificador da execução em lote corrente."""
+    os.makedirs(diretorio, exist_ok=True)
+    with open(os.path.join(diretorio, 'ultimo_lote.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'id_execucao': id_execucao,
+            'iniciado_em': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'clientes': [nome for nome, _ in lista_clientes]
+        }, f, ensure_ascii=False, indent=2)
+
+def executar_lookups_paralelos(conn_contrato, conn_pessoa, cpfs, opcoes=None, executor=None, cache=None):
+    """
+    Executa os passos 2 (segurado no CONTRATO) e 3 (e-mails no PESSOA) ao mesmo tempo.
+    São bancos e conexões diferentes, então o tempo total cai para o da consulta mais lenta.
+
+    Returns:
+        (cpfs_existentes_segurado, mapa_emails)
+    """
+    executor_proprio = executor is None
+    if executor_proprio:
+        executor = ThreadPoolExecutor(max_workers=2)
+
+    try:
+        futuro_segurados = executor.submit(consultar_segurados, conn_contrato, cpfs, opcoes, cache)
+        futuro_emails = executor.submit(consultar_emails, conn_pessoa, cpfs, opcoes, cache)
+        return futuro_segurados.result(), futuro_emails.result()
+    finally:
+        if executor_proprio:
+            executor.shutdown(wait=True)
+
+def executar_analise_streaming(lotes_divergencias, conn_contrato, conn_pessoa, listas, opcoes=None,
+                               modo_batch=False, incremental=None, cache=None, saida=None, metricas=None):
+    """
+    Executa os passos 1 a 4 em streaming: as divergências chegam em lotes (cursor
+    server-side ou estratégia local) e cada lote já é validado (segurado/e-mails) e
+    classificado, mantendo o pico de memória constante independente do total de linhas.
+    Com `incremental`, só os CPFs das divergências novas/alteradas são consultados.
+    Com `saida` (formatos em lote), cada lote classificado já é gravado e as listas esvaziadas.
+    Com `metricas`, o tempo de cada passo é acumulado lote a lote.
+
+    Returns:
+        total de divergências processadas
+    """
+    total_divergencias = 0
+    lotes = iter(lotes_divergencias)
+    num_lote = 0
+    # Um único pool para todos os lotes quando os lookups rodam em paralelo
+    executor = ThreadPoolExecutor(max_workers=2) if opcoes and opcoes['lookups_paralelos'] else None
+
+    try:
+        while True:
+            # O tempo de busca é o tempo de espera pelo próximo lote do cursor/COPY
+            with medir_etapa(metricas, '1_divergencias') as etapa:
+                lote = next(lotes, None)
+                etapa['linhas'] += len(lote) if lote else 0
+            if lote is None:
+                break
+            num_lote += 1
+
+            if incremental:
+                pendentes, reaproveitadas = separar_divergencias_incrementais(lote, incremental)
+                cpfs_lote = coletar_cpfs(pendentes)
+            else:
+                cpfs_lote = coletar_cpfs(lote)
+
+            if executor:
+                with medir_etapa(metricas, '2-3_lookups_paralelos') as etapa:
+                    cpfs_existentes_segurado, mapa_emails = executar_lookups_paralelos(
+                        conn_contrato, conn_pessoa, cpfs_lote, opcoes, executor, cache
+                    )
+                    etapa['linhas'] += len(cpfs_lote)
+            else:
+                with medir_etapa(metricas, '2_segurado') as etapa:
+                    cpfs_existentes_segurado = consultar_segurados(conn_contrato, cpfs_lote, opcoes, cache)
+                    etapa['linhas'] += len(cpfs_lote)
+                with medir_etapa(metricas, '3_emails') as etapa:
+                    mapa_emails = consultar_emails(conn_pessoa, cpfs_lote, opcoes, cache)
+                    etapa['linhas'] += len(cpfs_lote)
+
+            with medir_etapa(metricas, '4_classificacao') as etapa:
+                if incremental:
+                    completar_com_snapshot(reaproveitadas, incremental, cpfs_lote, cpfs_existentes_segurado, mapa_emails)
+                    registrar_snapshot(lote, incremental, cpfs_existentes_segurado, mapa_emails, reaproveitadas)
+                classificar_lote(lote, cpfs_existentes_segurado, mapa_emails, listas, opcoes)
+                etapa['linhas'] += len(lote)
+            if saida:
+                with medir_etapa(metricas, 'exportacao'):
+                    descarregar_listas_na_saida(listas, saida)
+
+            total_divergencias += len(lote)
+            if not modo_batch:
+                print(f"   └─ Lote {num_lote}: {len(lote)} divergências ({total_divergencias} acumuladas)")
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+
+    return total_divergencias
+
+def falha_analise(mensagem, modo_batch):
+    """
+    Encerra a análise de um cliente por erro. No lote vira exceção, para o cliente sair
+    com status de erro (e o processo com código != 0); no modo interativo só exibe a mensagem.
+
+    Returns:
+        False (retorno de main quando a análise falha)
+    """
+    if modo_batch:
+        raise RuntimeError(mensagem)
+    print(mensagem)
+    return False
+
+def main(modo_batch=False, env=None, sobrescritas=None):
+    """
+    Executa o diagnóstico de divergências de um cliente.
+
+    Args:
+        modo_batch: execução silenciosa, sem confirmações; retorna o resumo estatístico
+        env: variáveis do .env do cliente (padrão: os.environ). Usado pelo lote paralelo,
+             onde cada worker tem a sua própria configuração.
+        sobrescritas: opções da linha de comando que prevalecem sobre o .env
+                      (ex.: {'formato_saida': 'csv'})
+
+    Returns:
+        resumo estatístico (modo batch), None sem relatório a gerar ou False se a análise
+        falhou (no modo batch a falha levanta RuntimeError)
+    """
+    env = os.environ if env is None else env
+
+    # Carrega configurações do ambiente atual
+    try:
+        DB_GESTAO, DB_CONTRATO, DB_PESSOA, SSH_CONFIG, SENHA_ACCOUNTS, URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER = carregar_configuracoes(env)
+        OPCOES = carregar_opcoes_execucao(env, sobrescritas)
+    except ValueError as e:
+        return falha_analise(f"❌ ERRO: {e}", modo_batch)
     
     # Obtém o nome do cliente para usar nos relatórios
-    cliente_nome = os.getenv('NOME_CLIENTE', 'CLIENTE')
+    cliente_nome = env.get('NOME_CLIENTE', 'CLIENTE')
     
     if not modo_batch:
         print(f"--- INICIANDO DIAGNÓSTICO DE DIVERGÊNCIAS [{cliente_nome}] ---")
     
+    # Métricas por etapa (relatório JSON / Prometheus ao final)
+    metricas = iniciar_metricas(cliente_nome)
+
+    # CHECKPOINTS: etapas já concluídas (--resume) não são refeitas
+    checkpoint = None
+    modos_sem_etapas = [nome for chave, nome in MODOS_SEM_CHECKPOINT_DE_ETAPA.items() if OPCOES[chave]]
+    if OPCOES['retomar'] and modos_sem_etapas:
+        print(f"{'   ' if modo_batch else ''}⚠️  --resume não retoma etapas com {', '.join(modos_sem_etapas)}: "
+              f"a análise de {cliente_nome} é refeita (só uma execução já concluída é pulada).")
+    if not OPCOES['checkpoints'] and not OPCOES['retomar']:
+        descartar_checkpoints(cliente_nome, OPCOES['dir_estado'])
+    else:
+        checkpoint = abrir_checkpoints(
+            cliente_nome, OPCOES['dir_estado'], OPCOES,
+            id_execucao=OPCOES['id_execucao'], retomar=OPCOES['retomar']
+        )
+        if checkpoint['status'] == 'concluida':
+            # Relatório desta execução já gerado: no lote retomado o cliente é pulado
+            print(f"{'   ' if modo_batch else ''}⏭️  Execução {checkpoint['id']} de {cliente_nome} já concluída; nada a retomar.")
+            resumo = checkpoint['resumo']
+            fechar_checkpoints(checkpoint)
+            if modo_batch and resumo:
+                return dict(resumo, tempo_tunnel=0.0,
+                            metricas=finalizar_metricas(metricas, status='ja_concluida'))
+            return
+        if OPCOES['retomar'] and not modo_batch:
+            if checkpoint['retomada']:
+                print(f"♻️  Retomando a execução {checkpoint['id']}")
+            else:
+                print(f"⚠️  Nenhuma execução a retomar para {cliente_nome}: iniciando a execução {checkpoint['id']}")
+
     # Gerencia túnel SSH automaticamente
-    with gerenciar_tunnel_ssh(SSH_CONFIG):
+    inicio_tunnel = time.time()
+    with gerenciar_tunnel_ssh(SSH_CONFIG) as tunel, ExitStack() as pilha:
+        tempo_tunnel = time.time() - inicio_tunnel
+        registrar_etapa(metricas, 'tunnel', tempo_tunnel)
+        if checkpoint:
+            pilha.callback(fechar_checkpoints, checkpoint)
         # Ajusta configurações dos bancos para usar túnel se necessário
         db_gestao_ajustado = ajustar_hosts_para_tunnel(DB_GESTAO, SSH_CONFIG)
         db_contrato_ajustado = ajustar_hosts_para_tunnel(DB_CONTRATO, SSH_CONFIG)
         db_pessoa_ajustado = ajustar_hosts_para_tunnel(DB_PESSOA, SSH_CONFIG)
+        # ACCOUNTS só é acessado diretamente na estratégia 'local' (mesmo servidor do túnel)
+        db_accounts_ajustado = ajustar_hosts_para_tunnel({
+            'database': DB_ACCOUNTS_NAME_USER,
+            'user': DB_ACCOUNTS_NAME_USER,
+            'password': SENHA_ACCOUNTS
+        }, SSH_CONFIG)
+        bancos = {'GESTÃO': db_gestao_ajustado, 'CONTRATO': db_contrato_ajustado, 'PESSOA': db_pessoa_ajustado}
+
+        def repetir_se_cair(nome, funcao):
+            # Etapa repetida com conexões reabertas se o túnel/banco cair no meio dela
+            return executar_etapa_com_reconexao(nome, funcao, conexoes, bancos, tunel, SSH_CONFIG)
         
         # PASSO 0: TESTE DE CONEXÕES
         if not modo_batch:
             # Modo interativo: testa conexões e pede confirmação
-            conexoes_ok = testar_conexoes(db_gestao_ajustado, db_contrato_ajustado, db_pessoa_ajustado)
+            # As conexões testadas ficam abertas e são usadas pela análise
+            with medir_etapa(metricas, 'conexoes'):
+                conexoes = testar_conexoes(db_gestao_ajustado, db_contrato_ajustado, db_pessoa_ajustado)
             
-            if not conexoes_ok:
-                print("\n⚠️  Encerrando script devido a erros de conexão.")
-                return
+            if not conexoes:
+                return falha_analise("\n⚠️  Encerrando script devido a erros de conexão.", modo_batch)
+            pilha.callback(fechar_conexoes, conexoes)
             
             # Solicita confirmação do usuário
             print("\n" + "="*50)
@@ -559,273 +2973,1099 @@ def main(modo_batch=False):
             
             print("\n🚀 Iniciando análise de divergências...\n")
         else:
-            # Modo batch: execução silenciosa e rápida
-            print("🔄 Executando análise...")
-        
-        # LISTAS PARA RELATÓRIOS
-        lista_email_duplicado = []
-        lista_um_inexistente = []
-        lista_ambos_inexistentes = []
-        lista_erros_outros = []
+            # Modo batch: execução silenciosa e rápida
+            print("🔄 Executando análise...")
+            with medir_etapa(metricas, 'conexoes'):
+                conexoes, erros_conexao = conectar_bancos(bancos)
+            pilha.callback(fechar_conexoes, conexoes)
+            if erros_conexao:
+                rotulo, erro = next(iter(erros_conexao.items()))
+                return falha_analise(f"Erro crítico ao conectar no banco {rotulo}: {erro}", modo_batch)
+        
+        # LISTAS PARA RELATÓRIOS
+        listas = {chave: [] for chave in ABAS_RELATORIO}
+
+        sql_base = montar_sql_divergencias(
+            URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS,
+            estrategia=OPCOES['estrategia_accounts'],
+            tamanho_bloco=OPCOES['tamanho_bloco_accounts']
+        )
+
+        # PARTIÇÕES: a mesma query por faixa de sso_id, cada uma em uma conexão própria
+        consulta_particao = None
+        if OPCOES['particoes_divergencias'] > 1:
+            def consulta_particao(faixa):
+                return montar_sql_divergencias(
+                    URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS,
+                    estrategia=OPCOES['estrategia_accounts'],
+                    tamanho_bloco=OPCOES['tamanho_bloco_accounts'],
+                    faixa=faixa
+                )
+
+        # ANÁLISE INCREMENTAL: reaproveita o snapshot da última execução do cliente
+        incremental = None
+        resumo_delta = None
+        if OPCOES['modo_incremental']:
+            # Na retomada vale o instante da execução original: as mesmas divergências são
+            # reaproveitadas do snapshot e batem com os lookups salvos no checkpoint
+            inicio_incremental = ler_checkpoint(checkpoint, '0_inicio_incremental')
+            incremental = abrir_snapshot_incremental(
+                cliente_nome, OPCOES['dir_estado'], OPCOES['incremental_max_dias'], agora=inicio_incremental
+            )
+            pilha.callback(incremental['conn'].close)
+            if inicio_incremental is None and not OPCOES['modo_streaming']:
+                gravar_checkpoint(checkpoint, '0_inicio_incremental', incremental['agora'])
+
+        # CACHE DE LOOKUPS: só os CPFs fora do cache (ou vencidos) vão ao banco
+        cache = None
+        if OPCOES['cache_lookups'] and not OPCOES['modo_federado']:
+            cache = abrir_cache_lookups(
+                cliente_nome, OPCOES['dir_estado'], OPCOES['cache_ttl_horas'],
+                OPCOES['cache_max_entradas'], renovar=OPCOES['renovar_cache']
+            )
+            pilha.callback(cache['conn'].close)
+
+        # Gera nome do arquivo com nome do cliente
+        prefixo_relatorio = f'relatorio_{cliente_nome.lower().replace(" ", "_")}'
+
+        # SAÍDA EM LOTE (csv, csv.gz, jsonl, parquet, arrow): arquivos abertos antes da análise
+        # e alimentados direto pelo passo 4; o Excel continua recebendo as listas completas
+        saida = None
+        if OPCOES['formato_saida'] in FORMATOS_EM_LOTE:
+            categorias = {chave: (nome_aba, CABECALHO_RELATORIO) for chave, nome_aba in ABAS_RELATORIO.items()}
+            if incremental:
+                categorias['delta'] = ('6-Delta', CABECALHO_DELTA)
+            if OPCOES['emails_compartilhados']:
+                categorias['emails_compartilhados'] = (ABA_EMAILS_COMPARTILHADOS, CABECALHO_EMAILS_COMPARTILHADOS)
+            try:
+                saida = abrir_saida_em_lote(OPCOES['formato_saida'], prefixo_relatorio, categorias)
+            except (ValueError, OSError) as e:
+                return falha_analise(f"❌ ERRO: {e}", modo_batch)
+            pilha.callback(fechar_saida_em_lote, saida, True)
+
+        if OPCOES['modo_federado']:
+            # MODO FEDERADO: passos 1 a 4 numa única query no GESTÃO; só as linhas já classificadas voltam
+            if not modo_batch:
+                print(f"[1-4/4] Classificando divergências no servidor ({OPCOES['federacao']})...")
+            sql_federado = montar_sql_federado(
+                URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS, DB_CONTRATO, DB_PESSOA, OPCOES
+            )
+            try:
+                total_divergencias = executar_analise_federada(
+                    conexoes['GESTÃO'], sql_federado, listas, OPCOES, saida=saida, metricas=metricas
+                )
+            except Exception as e:
+                return falha_analise(f"Erro crítico durante análise federada: {e}", modo_batch)
+
+            if total_divergencias == 0:
+                print("Nenhuma divergência encontrada. Encerrando.")
+                concluir_checkpoint(checkpoint)
+                return
+        elif OPCOES['modo_streaming']:
+            # MODO STREAMING: passos 1 a 4 executados lote a lote
+            if not modo_batch:
+                print(f"[1-4/4] Processando divergências em streaming (lotes de {OPCOES['tamanho_lote']})...")
+            try:
+                if consulta_particao:
+                    lotes = gerar_lotes_divergencias_particionado(db_gestao_ajustado, consulta_particao, OPCOES)
+                else:
+                    lotes = gerar_lotes_divergencias(conexoes['GESTÃO'], db_accounts_ajustado, sql_base, OPCOES)
+                total_divergencias = executar_analise_streaming(
+                    lotes, conexoes['CONTRATO'], conexoes['PESSOA'], listas, OPCOES,
+                    modo_batch=modo_batch, incremental=incremental, cache=cache, saida=saida,
+                    metricas=metricas
+                )
+            except Exception as e:
+                return falha_analise(f"Erro crítico durante análise em streaming: {e}", modo_batch)
+
+            if incremental:
+                resumo_delta = finalizar_snapshot(incremental)
+
+            if total_divergencias == 0:
+                print("Nenhuma divergência encontrada. Encerrando.")
+                concluir_checkpoint(checkpoint)
+                return
+        else:
+            # 1. BUSCAR DIVERGÊNCIAS (GESTAO + ACCOUNTS via DBLINK)
+            if not modo_batch:
+                print("[1/4] Buscando divergências iniciais...")
+            def buscar_divergencias(conexoes):
+                if consulta_particao:
+                    divergencias = []
+                    for lote in gerar_lotes_divergencias_particionado(db_gestao_ajustado, consulta_particao, OPCOES):
+                        divergencias.extend(lote)
+                    return divergencias
+                if OPCOES['estrategia_accounts'] == 'local':
+                    divergencias = []
+                    for lote in gerar_lotes_divergencias(conexoes['GESTÃO'], db_accounts_ajustado, sql_base, OPCOES):
+                        divergencias.extend(lote)
+                    return divergencias
+                cur = conexoes['GESTÃO'].cursor()
+                cur.execute(sql_base)
+                divergencias = [Divergencia._make(row) for row in cur.fetchall()]
+                cur.close()
+                return divergencias
 
-        # 1. BUSCAR DIVERGÊNCIAS (GESTAO + ACCOUNTS via DBLINK)
-        if not modo_batch:
-            print("[1/4] Buscando divergências iniciais...")
-        divergencias = []
-        
-        sql_base = f"""
-        WITH divergencias AS (
-            SELECT
-               a.id AS id_account,
-               s.sso_id AS sso_id_gestao,
-               a.cpf_cnpj AS cpf_visual_accounts,
-               s.cpf_cnpj AS cpf_visual_gestao,
-               REGEXP_REPLACE(a.cpf_cnpj, '\D','', 'g') AS cpf_accounts_limpo, 
-               REGEXP_REPLACE(s.cpf_cnpj, '\D','', 'g') AS cpf_gestao_limpo
-            FROM tb_usuario s
-            INNER JOIN (
-              SELECT cpf_cnpj, id
-              FROM dblink(
-               'host={URL_ACCOUNTS} dbname={DB_ACCOUNTS_NAME_USER} user={DB_ACCOUNTS_NAME_USER} password={SENHA_ACCOUNTS}',
-                  'SELECT cpf_cnpj, id FROM users'
-              ) AS accounts(cpf_cnpj varchar(255), id uuid) 
-            ) a ON s.sso_id = a.id 
-            WHERE REGEXP_REPLACE(s.cpf_cnpj,'\D','', 'g') <> REGEXP_REPLACE(a.cpf_cnpj,'\D','', 'g')
-        )
-        SELECT * FROM divergencias;
-        """
+            divergencias = ler_checkpoint(checkpoint, '1_divergencias')
+            if divergencias is None:
+                try:
+                    with medir_etapa(metricas, '1_divergencias') as etapa:
+                        divergencias = repetir_se_cair('1_divergencias', buscar_divergencias)
+                        etapa['linhas'] = len(divergencias)
+                except Exception as e:
+                    return falha_analise(f"Erro crítico ao buscar divergências: {e}", modo_batch)
+                gravar_checkpoint(checkpoint, '1_divergencias', divergencias)
+            elif not modo_batch:
+                print(f"   └─ {len(divergencias)} divergências retomadas do checkpoint")
 
-        try:
-            conn = psycopg2.connect(**db_gestao_ajustado)
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute(sql_base)
-            divergencias = cur.fetchall()
-            conn.close()
-        except Exception as e:
-            print(f"Erro crítico ao buscar divergências: {e}")
-            return
+            if not divergencias:
+                if incremental:
+                    resumo_delta = finalizar_snapshot(incremental)
+                    print(f"Δ Incremental: {resumo_delta['corrigidas']} divergências corrigidas desde a última execução.")
+                print("Nenhuma divergência encontrada. Encerrando.")
+                concluir_checkpoint(checkpoint)
+                return
 
-        if not divergencias:
-            print("Nenhuma divergência encontrada. Encerrando.")
-            return
+            # Coletar todos os CPFs únicos para as próximas consultas (Otimização)
+            if incremental:
+                # Só consulta os CPFs das divergências novas, alteradas ou vencidas
+                pendentes, reaproveitadas = separar_divergencias_incrementais(divergencias, incremental)
+                todos_cpfs = coletar_cpfs(pendentes)
+                if not modo_batch:
+                    print(f"   └─ Incremental: {len(reaproveitadas)} reaproveitadas do snapshot | {len(pendentes)} a verificar")
+            else:
+                todos_cpfs = coletar_cpfs(divergencias)
 
-        # Coletar todos os CPFs únicos para as próximas consultas (Otimização)
-        todos_cpfs = set()
-        for d in divergencias:
-            todos_cpfs.add(d['cpf_accounts_limpo'])
-            todos_cpfs.add(d['cpf_gestao_limpo'])
-        
-        cpfs_tuple = tuple(todos_cpfs)
+            if OPCOES['lookups_paralelos']:
+                # 2 + 3. SEGURADO E EMAILS AO MESMO TEMPO (bancos independentes)
+                if not modo_batch:
+                    print(f"[2-3/4] Validando {len(todos_cpfs)} CPFs em Segurado e buscando e-mails em paralelo...")
 
-        # 2. VERIFICAR EXISTÊNCIA NO CONTRATO (SEGURADO)
-        if not modo_batch:
-            print(f"[2/4] Validando {len(todos_cpfs)} CPFs na tabela Segurado...")
-        cpfs_existentes_segurado = set()
-        
-        try:
-            conn = psycopg2.connect(**db_contrato_ajustado)
-            cur = conn.cursor()
-            # Busca CPFs limpos da tabela segurado que coincidem com nossa lista
-            sql_segurado = f"""
-                SELECT REGEXP_REPLACE(cpf_cnpj, '\D','', 'g') 
-                FROM segurado 
-                WHERE REGEXP_REPLACE(cpf_cnpj, '\D','', 'g') IN %s
-            """
-            cur.execute(sql_segurado, (cpfs_tuple,))
-            results = cur.fetchall()
-            for row in results:
-                cpfs_existentes_segurado.add(row[0]) # Adiciona ao Set de existência
-            conn.close()
-        except Exception as e:
-            print(f"Erro ao consultar Segurado: {e}")
-            return
+                cpfs_existentes_segurado = ler_checkpoint(checkpoint, '2_segurado')
+                mapa_emails = ler_checkpoint(checkpoint, '3_emails')
+                try:
+                    with medir_etapa(metricas, '2-3_lookups_paralelos') as etapa:
+                        if cpfs_existentes_segurado is None and mapa_emails is None:
+                            cpfs_existentes_segurado, mapa_emails = repetir_se_cair(
+                                '2-3_lookups_paralelos',
+                                lambda conexoes: executar_lookups_paralelos(
+                                    conexoes['CONTRATO'], conexoes['PESSOA'], todos_cpfs, OPCOES, cache=cache
+                                )
+                            )
+                        elif cpfs_existentes_segurado is None:
+                            cpfs_existentes_segurado = repetir_se_cair(
+                                '2_segurado', lambda conexoes: consultar_segurados(conexoes['CONTRATO'], todos_cpfs, OPCOES, cache)
+                            )
+                        elif mapa_emails is None:
+                            mapa_emails = repetir_se_cair(
+                                '3_emails', lambda conexoes: consultar_emails(conexoes['PESSOA'], todos_cpfs, OPCOES, cache)
+                            )
+                        etapa['linhas'] = len(todos_cpfs)
+                except Exception as e:
+                    return falha_analise(f"Erro ao consultar Segurado/Emails: {e}", modo_batch)
+                gravar_checkpoint(checkpoint, '2_segurado', cpfs_existentes_segurado)
+                gravar_checkpoint(checkpoint, '3_emails', mapa_emails)
+            else:
+                # 2. VERIFICAR EXISTÊNCIA NO CONTRATO (SEGURADO)
+                if not modo_batch:
+                    print(f"[2/4] Validando {len(todos_cpfs)} CPFs na tabela Segurado...")
 
-        # 3. BUSCAR EMAILS (PESSOA/CONTATO)
-        if not modo_batch:
-            print("[3/4] Buscando e-mails no quarto banco...")
-        mapa_emails = {} # { 'cpf_limpo': 'email' }
-        
-        try:
-            conn = psycopg2.connect(**db_pessoa_ajustado)
-            cur = conn.cursor()
-            
-            # Query solicitada adaptada para buscar em lote
-            # Precisamos buscar pelo CPF formatado ou limpo? 
-            # Assumindo que o banco pessoa armazena formatado, aplicamos replace no WHERE
-            sql_emails = f"""
-                SELECT REGEXP_REPLACE(p.cpf_cnpj, '\D','', 'g') as cpf, c.valor as email
-                FROM pessoa p 
-                LEFT JOIN contato c ON p.id = c.pessoa_id
-                WHERE c.tipo = 'EMAIL'
-                AND REGEXP_REPLACE(p.cpf_cnpj, '\D','', 'g') IN %s
-            """
-            cur.execute(sql_emails, (cpfs_tuple,))
-            results = cur.fetchall()
-            
-            for cpf, email in results:
-                if email:
-                    mapa_emails[cpf] = email.strip() # Normaliza email
-            conn.close()
-        except Exception as e:
-            print(f"Erro ao consultar Emails: {e}")
-            return
+                cpfs_existentes_segurado = ler_checkpoint(checkpoint, '2_segurado')
+                if cpfs_existentes_segurado is None:
+                    try:
+                        with medir_etapa(metricas, '2_segurado') as etapa:
+                            cpfs_existentes_segurado = repetir_se_cair(
+                                '2_segurado', lambda conexoes: consultar_segurados(conexoes['CONTRATO'], todos_cpfs, OPCOES, cache)
+                            )
+                            etapa['linhas'] = len(todos_cpfs)
+                    except Exception as e:
+                        return falha_analise(f"Erro ao consultar Segurado: {e}", modo_batch)
+                    gravar_checkpoint(checkpoint, '2_segurado', cpfs_existentes_segurado)
+                elif not modo_batch:
+                    print("   └─ Segurado retomado do checkpoint")
 
-        # 4. PROCESSAMENTO LÓGICO E CONTAGEM
-        if not modo_batch:
-            print("[4/4] Processando regras de negócio...")
+                # 3. BUSCAR EMAILS (PESSOA/CONTATO)
+                if not modo_batch:
+                    print("[3/4] Buscando e-mails no quarto banco...")
 
-        for item in divergencias:
-            cpf_acc = item['cpf_accounts_limpo']
-            cpf_ges = item['cpf_gestao_limpo']
-            
-            # Verifica existência na tabela segurado
-            existe_acc = cpf_acc in cpfs_existentes_segurado
-            existe_ges = cpf_ges in cpfs_existentes_segurado
-            
-            # Estrutura base do relatório
-            linha_relatorio = {
-                'uuid_comum': item['id_account'],  # sso_id em gestão = id em accounts
-                'cpf_gestao': item['cpf_visual_gestao'],
-                'cpf_accounts': item['cpf_visual_accounts'],
-                'existe_segurado_gestao': "SIM" if existe_ges else "NAO",
-                'existe_segurado_accounts': "SIM" if existe_acc else "NAO",
-                'email_comum': None
-            }
-
-            # CASO 1: AMBOS INEXISTENTES EM SEGURADO
-            if not existe_acc and not existe_ges:
-                lista_ambos_inexistentes.append(linha_relatorio)
-                continue
+                mapa_emails = ler_checkpoint(checkpoint, '3_emails')
+                if mapa_emails is None:
+                    try:
+                        with medir_etapa(metricas, '3_emails') as etapa:
+                            mapa_emails = repetir_se_cair(
+                                '3_emails', lambda conexoes: consultar_emails(conexoes['PESSOA'], todos_cpfs, OPCOES, cache)
+                            )
+                            etapa['linhas'] = len(todos_cpfs)
+                    except Exception as e:
+                        return falha_analise(f"Erro ao consultar Emails: {e}", modo_batch)
+                    gravar_checkpoint(checkpoint, '3_emails', mapa_emails)
+                elif not modo_batch:
+                    print("   └─ E-mails retomados do checkpoint")
 
-            # CASO 2: UM DELES INEXISTENTE
-            if (existe_acc and not existe_ges) or (not existe_acc and existe_ges):
-                lista_um_inexistente.append(linha_relatorio)
-                # Nota: O fluxo pode parar aqui ou continuar para verificar email mesmo assim?
-                # Pela lógica comum, se um não existe, é inconsistência de cadastro, mas vamos verificar email apenas se ambos existirem ou se solicitado.
-                # Vou assumir que se falta um, já cai nessa categoria e encerra.
-                continue 
-
-            # CASO 3: AMBOS EXISTEM -> VERIFICAR EMAIL
-            email_acc = mapa_emails.get(cpf_acc)
-            email_ges = mapa_emails.get(cpf_ges)
-
-            if email_acc and email_ges and (email_acc == email_ges):
-                linha_relatorio['email_comum'] = email_acc
-                lista_email_duplicado.append(linha_relatorio)
-            else:
-                # Se chegou aqui: existem no segurado, mas emails diferentes ou nulos
-                lista_erros_outros.append(linha_relatorio)
+            # 4. PROCESSAMENTO LÓGICO E CONTAGEM
+            if not modo_batch:
+                print("[4/4] Processando regras de negócio...")
+
+            with medir_etapa(metricas, '4_classificacao') as etapa:
+                if incremental:
+                    completar_com_snapshot(reaproveitadas, incremental, todos_cpfs, cpfs_existentes_segurado, mapa_emails)
+                    registrar_snapshot(divergencias, incremental, cpfs_existentes_segurado, mapa_emails, reaproveitadas)
+                    resumo_delta = finalizar_snapshot(incremental)
+
+                classificar_lote(divergencias, cpfs_existentes_segurado, mapa_emails, listas, OPCOES)
+                etapa['linhas'] = len(divergencias)
+            if saida:
+                with medir_etapa(metricas, 'exportacao'):
+                    descarregar_listas_na_saida(listas, saida)
+            total_divergencias = len(divergencias)
+
+        # E-MAILS COMPARTILHADOS: varre toda a base pessoa/contato, não só as duplas divergentes
+        emails_compartilhados = None
+        if OPCOES['emails_compartilhados']:
+            if not modo_batch:
+                print(f"[+] Buscando e-mails compartilhados por vários CPFs em toda a base "
+                      f"({OPCOES['estrategia_emails_compartilhados']})...")
+            try:
+                with medir_etapa(metricas, 'emails_compartilhados') as etapa:
+                    emails_compartilhados = detectar_emails_compartilhados(
+                        conexoes['PESSOA'], OPCOES, saida=saida, etapa=etapa
+                    )
+            except Exception as e:
+                # Aba complementar: o relatório principal sai mesmo sem ela
+                print(f"⚠️  Erro ao buscar e-mails compartilhados: {e}")
+                emails_compartilhados = None
+
+        # Quantidade por categoria (na saída em lote as listas já foram descarregadas nos arquivos)
+        qtd = {chave: len(lista) + (saida['contagens'][chave] if saida else 0) for chave, lista in listas.items()}
 
         # 5. EXIBIÇÃO E SALVAMENTO
         if modo_batch:
             # Modo batch: resumo simplificado
-            total_problemas = len(lista_email_duplicado) + len(lista_um_inexistente) + len(lista_ambos_inexistentes) + len(lista_erros_outros)
-            print(f"   ✅ Análise concluída: {len(divergencias)} divergências | {total_problemas} problemas encontrados")
+            total_problemas = sum(qtd.values())
+            print(f"   ✅ Análise concluída: {total_divergencias} divergências | {total_problemas} problemas encontrados")
         else:
             # Modo interativo: resumo detalhado
             print("\n" + "="*40)
             print("RESUMO FINAL DA OPERAÇÃO")
             print("="*40)
-            print(f"1. E-mails Duplicados (Inconsistência Confirmada): {len(lista_email_duplicado)}")
-            print(f"2. Um dos CPFs não existe em Segurado:             {len(lista_um_inexistente)}")
-            print(f"3. Ambos CPFs não existem em Segurado:             {len(lista_ambos_inexistentes)}")
-            print(f"4. Outros (Existem mas e-mail não bate/nulo):      {len(lista_erros_outros)}")
+            print(f"1. E-mails Duplicados (Inconsistência Confirmada): {qtd['email_duplicado']}")
+            print(f"2. Um dos CPFs não existe em Segurado:             {qtd['um_inexistente']}")
+            print(f"3. Ambos CPFs não existem em Segurado:             {qtd['ambos_inexistentes']}")
+            print(f"4. Outros (Existem mas e-mail não bate/nulo):      {qtd['outros']}")
+            print(f"5. CPF/CNPJ inválido (tamanho/dígito verificador): {qtd['documento_invalido']}")
             print("-" * 40)
-            print(f"TOTAL ANALISADO: {len(divergencias)}")
+            print(f"TOTAL ANALISADO: {total_divergencias}")
+            if emails_compartilhados is not None:
+                qtd_grupos = len(emails_compartilhados) + (saida['contagens']['emails_compartilhados'] if saida else 0)
+                print(f"E-mails compartilhados por vários CPFs (toda a base): {qtd_grupos}")
             print("="*40)
 
-        # Headers para relatórios
-        headers = ['uuid_comum', 'cpf_gestao', 'cpf_accounts', 
-                   'existe_segurado_gestao', 'existe_segurado_accounts', 
-                   'email_comum']
+        if cache:
+            resumo_cache = fechar_cache_lookups(cache)
+            print(f"{'   ' if modo_batch else ''}🗃️  Cache de lookups: "
+                  f"segurado {resumo_cache['hits']['segurado']} hits / {resumo_cache['misses']['segurado']} misses | "
+                  f"e-mail {resumo_cache['hits']['email']} hits / {resumo_cache['misses']['email']} misses")
+
+        if resumo_delta:
+            print(f"{'   ' if modo_batch else ''}Δ Incremental: {resumo_delta['novas']} novas | "
+                  f"{resumo_delta['alteradas']} alteradas | {resumo_delta['corrigidas']} corrigidas | "
+                  f"{resumo_delta['reaproveitadas']} reaproveitadas do snapshot")
 
-        # Salva arquivo Excel consolidado com todas as abas
+        if saida:
+            # Formatos em lote: só falta o delta (conhecido ao fim da análise)
+            with medir_etapa(metricas, 'exportacao') as etapa:
+                if resumo_delta:
+                    escrever_lote_saida(saida, 'delta', incremental['delta'])
+                fechar_saida_em_lote(saida, silent=modo_batch)
+                etapa['linhas'] = sum(saida['contagens'].values())
+                etapa['bytes'] = tamanho_arquivos(arquivo['caminho'] for arquivo in saida['arquivos'].values())
+        else:
+            relatorios = {nome_aba: (listas[chave], CABECALHO_RELATORIO) for chave, nome_aba in ABAS_RELATORIO.items()}
+            if resumo_delta:
+                relatorios['6-Delta'] = (incremental['delta'], CABECALHO_DELTA)
+            if emails_compartilhados is not None:
+                relatorios[ABA_EMAILS_COMPARTILHADOS] = (emails_compartilhados, CABECALHO_EMAILS_COMPARTILHADOS)
+
+            # Salva arquivo Excel consolidado com todas as abas
+            if not modo_batch:
+                print("\n📊 Gerando arquivo Excel consolidado...")
+            # Categorias acima do limite de linhas do Excel só cabem no writer streaming (abas particionadas)
+            excede_limite = any(len(dados) >= LIMITE_LINHAS_EXCEL for dados, _ in relatorios.values())
+            with medir_etapa(metricas, 'exportacao') as etapa:
+                if OPCOES['excel_streaming'] or excede_limite:
+                    salvo = salvar_excel_streaming(relatorios, f'{prefixo_relatorio}.xlsx', silent=modo_batch)
+                else:
+                    salvo = salvar_excel_consolidado(relatorios, f'{prefixo_relatorio}.xlsx', silent=modo_batch)
+                etapa['linhas'] = sum(len(dados) for dados, _ in relatorios.values())
+                etapa['bytes'] = tamanho_arquivos([os.path.join(os.getcwd(), f'{prefixo_relatorio}.xlsx')])
+            if not salvo:
+                return falha_analise(f"Erro ao gerar o relatório {prefixo_relatorio}.xlsx", modo_batch)
+
+        # Métricas da execução: no lote vão no resumo (o lote grava um relatório único)
+        finalizar_metricas(metricas)
         if not modo_batch:
-            print("\n📊 Gerando arquivo Excel consolidado...")
-        relatorios = {
-            '1-Emails Duplicados': (lista_email_duplicado, headers),
-            '2-Um CPF Inexistente': (lista_um_inexistente, headers),
-            '3-Ambos CPF Inexistentes': (lista_ambos_inexistentes, headers),
-            '4-Outros Erros': (lista_erros_outros, headers)
+            salvar_relatorio_execucao([metricas], OPCOES['dir_metricas'], OPCOES['metricas_prometheus'])
+
+        resumo = {
+            'cliente': cliente_nome,
+            'emails_duplicados': qtd['email_duplicado'],
+            'um_cpf_inexistente': qtd['um_inexistente'],
+            'ambos_cpf_inexistentes': qtd['ambos_inexistentes'],
+            'outros_erros': qtd['outros'],
+            'documentos_invalidos': qtd['documento_invalido'],
+            'total_analisado': total_divergencias,
+            'tempo_tunnel': tempo_tunnel,
+            'metricas': metricas
         }
-        # Gera nome do arquivo com nome do cliente
-        nome_arquivo_relatorio = f'relatorio_{cliente_nome.lower().replace(" ", "_")}.xlsx'
-        salvar_excel_consolidado(relatorios, nome_arquivo_relatorio, silent=modo_batch)
-        
+        # Relatório gerado: a execução não é mais retomável
+        concluir_checkpoint(checkpoint, resumo)
+
         # Retorna resumo se estiver em modo batch
         if modo_batch:
-            return {
-                'cliente': cliente_nome,
-                'emails_duplicados': len(lista_email_duplicado),
-                'um_cpf_inexistente': len(lista_um_inexistente),
-                'ambos_cpf_inexistentes': len(lista_ambos_inexistentes),
-                'outros_erros': len(lista_erros_outros),
-                'total_analisado': len(divergencias)
-            }
+            return resumo
 
-if __name__ == "__main__":
-    if EXECUTAR_TODOS:
-        # Execução em lote para todos os clientes
-        print("\n" + "="*70)
-        print(f"🚀 EXECUÇÃO EM LOTE: {len(LISTA_CLIENTES)} CLIENTES")
-        print("="*70)
-        
-        inicio_lote = time.time()
+# --- TÚNEIS COMPARTILHADOS NO LOTE ---
+def chave_tunnel(SSH_CONFIG):
+    """Identifica o túnel pelo bastion (host/porta/usuário SSH) e pelo destino do banco."""
+    remote_host, remote_port = SSH_CONFIG['remote_bind_address']
+    return (SSH_CONFIG['ssh_host'], SSH_CONFIG['ssh_port'], SSH_CONFIG['ssh_user'], remote_host, remote_port)
+
+def abrir_tunnels_compartilhados(lista_clientes, pilha, portas_reservadas):
+    """
+    Agrupa os clientes por bastion + destino e abre um único túnel por grupo, que fica
+    ativo até o fim do lote (registrado em `pilha`, um ExitStack). Um único forward
+    atende todos os clientes do grupo: um handshake SSH por grupo em vez de um por cliente.
+
+    Returns:
+        dict { arquivo_env: porta local do túnel compartilhado }
+    """
+    from dotenv import dotenv_values
+
+    grupos = {}  # chave -> (SSH_CONFIG do primeiro cliente, [arquivos .env])
+    for nome_cliente, arquivo_env in lista_clientes:
+        try:
+            SSH_CONFIG = carregar_configuracoes(dict(dotenv_values(arquivo_env)))[3]
+        except ValueError:
+            continue  # o erro de configuração aparece na execução do próprio cliente
+        grupos.setdefault(chave_tunnel(SSH_CONFIG), (SSH_CONFIG, []))[1].append(arquivo_env)
+
+    portas_por_cliente = {}
+    for chave, (SSH_CONFIG, arquivos) in grupos.items():
+        if len(arquivos) < 2:
+            continue  # cliente sozinho no bastion: abre o próprio túnel normalmente
+
+        config = dict(SSH_CONFIG, local_bind_port=obter_porta_livre(portas_reservadas))
+        inicio = time.time()
+        try:
+            pilha.enter_context(gerenciar_tunnel_ssh(config))
+        except SystemExit:
+            print(f"[SSH] ⚠️  Falha no túnel compartilhado de {chave[0]}: os clientes abrirão túneis próprios")
+            continue
+
+        print(f"[SSH] Túnel compartilhado {chave[0]} -> {chave[3]}:{chave[4]} | "
+              f"{len(arquivos)} clientes | setup {time.time() - inicio:.2f}s")
+        for arquivo_env in arquivos:
+            portas_por_cliente[arquivo_env] = config['local_bind_port']
+
+    return portas_por_cliente
+
+# --- EXECUÇÃO EM LOTE PARALELA ---
+def obter_porta_livre(portas_reservadas):
+    """Pede ao sistema operacional uma porta local livre que ainda não foi reservada neste lote."""
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        porta = sock.getsockname()[1]
+        sock.close()
+        if porta not in portas_reservadas:
+            portas_reservadas.add(porta)
+            return porta
+
+def processar_cliente_worker(arquivo_env, porta_local, tunnel_compartilhado=False, sobrescritas=None):
+    """
+    Executa a análise de um cliente dentro de um processo worker, com configuração
+    própria (lida direto do .env, sem mexer em os.environ) e porta de túnel exclusiva
+    (ou a porta do túnel compartilhado do seu grupo).
+    """
+    env = ambiente_cliente(arquivo_env, porta_local, tunnel_compartilhado)
+    try:
+        return main(modo_batch=True, env=env, sobrescritas=sobrescritas)
+    except SystemExit as e:
+        # gerenciar_tunnel_ssh encerra com sys.exit em falhas de túnel
+        raise Exception(descrever_falha(e))
+
+def executar_lote_paralelo(lista_clientes, num_workers, portas_compartilhadas=None, portas_reservadas=None,
+                           sobrescritas=None):
+    """
+    Processa os clientes em até `num_workers` processos ao mesmo tempo. O resumo
+    consolidado é atualizado a cada cliente concluído.
+
+    Args:
+        portas_compartilhadas: { arquivo_env: porta } dos clientes com túnel compartilhado
+        portas_reservadas: portas locais já em uso pelo lote
+
+    Returns:
+        (resultados_geral, resumos_clientes)
+    """
+    resultados_geral = []
+    resumos_clientes = []
+    portas_compartilhadas = portas_compartilhadas or {}
+    portas_reservadas = portas_reservadas if portas_reservadas is not None else set()
+
+    executor = ProcessPoolExecutor(max_workers=num_workers)
+    futuros = {}
+    for nome_cliente, arquivo_env in lista_clientes:
+        if arquivo_env in portas_compartilhadas:
+            futuro = executor.submit(
+                processar_cliente_worker, arquivo_env, portas_compartilhadas[arquivo_env], True, sobrescritas
+            )
+        else:
+            futuro = executor.submit(
+                processar_cliente_worker, arquivo_env, obter_porta_livre(portas_reservadas), False, sobrescritas
+            )
+        futuros[futuro] = nome_cliente
+
+    try:
+        for idx, futuro in enumerate(as_completed(futuros), 1):
+            nome_cliente = futuros[futuro]
+            try:
+                resumo = futuro.result()
+                print(f"\n[{idx}/{len(lista_clientes)}] ✅ {nome_cliente}")
+
+                if resumo:
+                    resumos_clientes.append(resumo)
+                    salvar_resumo_consolidado_lote(resumos_clientes, 'resumo_consolidado_lote.xlsx', silent=True)
+
+                resultados_geral.append((nome_cliente, "✅ Sucesso"))
+            except Exception as e:
+                print(f"\n[{idx}/{len(lista_clientes)}] ❌ {nome_cliente}")
+                print(f"      └─ Erro: {str(e)[:100]}")
+                resultados_geral.append((nome_cliente, f"❌ Erro: {str(e)[:100]}"))
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Execução interrompida pelo usuário.")
+        print(f"   Clientes processados: {len(resultados_geral)}/{len(lista_clientes)}")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return resultados_geral, resumos_clientes
+
+    executor.shutdown(wait=True)
+    return resultados_geral, resumos_clientes
+
+# --- EXECUÇÃO ASSÍNCRONA (ASYNCIO + ASYNCPG) ---
+# Modos implementados só no caminho síncrono: o cliente que usa algum deles roda main() num processo do pool
+OPCOES_SOMENTE_SINCRONAS = ['modo_streaming', 'modo_incremental', 'modo_federado', 'cache_lookups', 'emails_compartilhados']
+
+def cliente_suporta_async(opcoes):
+    """Indica se as opções do cliente cabem no pipeline assíncrono."""
+    if opcoes['estrategia_accounts'] == 'local' or opcoes['particoes_divergencias'] > 1:
+        return False
+    return not any(opcoes[chave] for chave in OPCOES_SOMENTE_SINCRONAS)
+
+async def conectar_bancos_async(bancos):
+    """
+    Abre ao mesmo tempo uma conexão asyncpg para cada banco.
+
+    Returns:
+        dict { rótulo: conexão }; se algum banco falhar, fecha as abertas e levanta o erro
+    """
+    import asyncio
+    import asyncpg
+
+    resultados = await asyncio.gather(*(
+        asyncpg.connect(host=db['host'], port=db['port'], database=db['database'],
+                        user=db['user'], password=db['password'])
+        for db in bancos.values()
+    ), return_exceptions=True)
+
+    conexoes = {rotulo: r for rotulo, r in zip(bancos, resultados) if not isinstance(r, BaseException)}
+    erros = {rotulo: r for rotulo, r in zip(bancos, resultados) if isinstance(r, BaseException)}
+    if erros:
+        await fechar_conexoes_async(conexoes)
+        rotulo, erro = next(iter(erros.items()))
+        raise Exception(f"Erro crítico ao conectar no banco {rotulo}: {erro}")
+
+    # uuid como texto, como no psycopg2: uuid.UUID não vai para o Excel nem para o JSON
+    await asyncio.gather(*(
+        conn.set_type_codec('uuid', encoder=str, decoder=str, schema='pg_catalog', format='text')
+        for conn in conexoes.values()
+    ))
+    return conexoes
+
+async def fechar_conexoes_async(conexoes):
+    """Fecha as conexões asyncpg, ignorando erros."""
+    import asyncio
+
+    await asyncio.gather(*(conn.close() for conn in conexoes.values()), return_exceptions=True)
+
+async def buscar_por_cpfs_async(conn, sql, cpfs, opcoes):
+    """
+    Executa uma consulta filtrada por `= ANY($1::text[])` (o conjunto de CPFs vai como um
+    único parâmetro array). Na estratégia 'chunks', em blocos de LOOKUP_CHUNK_SIZE CPFs.
+    """
+    cpfs = list(cpfs)
+    tamanho = opcoes['tamanho_chunk_lookup'] if opcoes['estrategia_lookup'] == 'chunks' else max(len(cpfs), 1)
+    linhas = []
+    for inicio in range(0, len(cpfs), tamanho):
+        linhas.extend(await conn.fetch(sql, cpfs[inicio:inicio + tamanho]))
+    return linhas
+
+async def consultar_segurados_async(conn, cpfs, opcoes):
+    """Versão asyncpg de consultar_segurados (sem cache)."""
+    sql = f"""
+        SELECT {expr_cpf_normalizado('cpf_cnpj')}
+        FROM segurado
+        WHERE {expr_cpf_normalizado('cpf_cnpj')} = ANY($1::text[])
+    """
+    return {row[0] for row in await buscar_por_cpfs_async(conn, sql, cpfs, opcoes)}
+
+async def consultar_emails_async(conn, cpfs, opcoes):
+    """Versão asyncpg de consultar_emails (sem cache)."""
+    sql = f"""
+        SELECT {expr_cpf_normalizado('p.cpf_cnpj')} as cpf, c.valor as email
+        FROM pessoa p
+        LEFT JOIN contato c ON p.id = c.pessoa_id
+        WHERE c.tipo = 'EMAIL'
+        AND {expr_cpf_normalizado('p.cpf_cnpj')} = ANY($1::text[])
+    """
+    mapa_emails = {}
+    for cpf, email in await buscar_por_cpfs_async(conn, sql, cpfs, opcoes):
+        if email:
+            mapa_emails[cpf] = email.strip() # Normaliza email
+    return mapa_emails
+
+def classificar_e_exportar(cliente_nome, divergencias, cpfs_existentes_segurado, mapa_emails, opcoes):
+    """
+    Passo 4 e gravação do relatório de um cliente (etapas de CPU). O pipeline assíncrono
+    roda esta função num processo do pool, fora do event loop.
+
+    Returns:
+        (quantidade por categoria, métricas das etapas 4_classificacao e exportacao)
+    """
+    metricas = iniciar_metricas(cliente_nome)
+    listas = {chave: [] for chave in ABAS_RELATORIO}
+    with medir_etapa(metricas, '4_classificacao') as etapa:
+        classificar_lote(divergencias, cpfs_existentes_segurado, mapa_emails, listas, opcoes)
+        etapa['linhas'] = len(divergencias)
+    qtd = {chave: len(lista) for chave, lista in listas.items()}
+
+    prefixo_relatorio = f'relatorio_{cliente_nome.lower().replace(" ", "_")}'
+    with medir_etapa(metricas, 'exportacao') as etapa:
+        if opcoes['formato_saida'] in FORMATOS_EM_LOTE:
+            categorias = {chave: (nome_aba, CABECALHO_RELATORIO) for chave, nome_aba in ABAS_RELATORIO.items()}
+            saida = abrir_saida_em_lote(opcoes['formato_saida'], prefixo_relatorio, categorias)
+            try:
+                descarregar_listas_na_saida(listas, saida)
+            finally:
+                fechar_saida_em_lote(saida, silent=True)
+            etapa['bytes'] = tamanho_arquivos(arquivo['caminho'] for arquivo in saida['arquivos'].values())
+        else:
+            relatorios = {nome_aba: (listas[chave], CABECALHO_RELATORIO) for chave, nome_aba in ABAS_RELATORIO.items()}
+            excede_limite = any(len(dados) >= LIMITE_LINHAS_EXCEL for dados, _ in relatorios.values())
+            if opcoes['excel_streaming'] or excede_limite:
+                salvo = salvar_excel_streaming(relatorios, f'{prefixo_relatorio}.xlsx')
+            else:
+                salvo = salvar_excel_consolidado(relatorios, f'{prefixo_relatorio}.xlsx')
+            if not salvo:
+                # O erro já foi exibido pelo writer; o cliente sai do lote com status de erro
+                raise RuntimeError(f"Erro ao gerar o relatório {prefixo_relatorio}.xlsx")
+            etapa['bytes'] = tamanho_arquivos([os.path.join(os.getcwd(), f'{prefixo_relatorio}.xlsx')])
+        etapa['linhas'] = sum(qtd.values())
+
+    return qtd, metricas['etapas']
+
+async def coletar_dados_cliente_async(SSH_CONFIG, bancos, sql_base, opcoes, metricas):
+    """
+    Etapas de rede de um cliente: túnel, conexões, divergências e, ao mesmo tempo,
+    segurado e e-mails. O túnel (bloqueante) abre e fecha numa thread do executor padrão.
+
+    Returns:
+        (divergencias, cpfs_existentes_segurado, mapa_emails, tempo_tunnel)
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    pilha = ExitStack()
+    try:
+        inicio_tunnel = time.time()
+        try:
+            await loop.run_in_executor(None, pilha.enter_context, gerenciar_tunnel_ssh(SSH_CONFIG))
+        except SystemExit as e:
+            # gerenciar_tunnel_ssh encerra com sys.exit em falhas de túnel
+            raise Exception(descrever_falha(e))
+        tempo_tunnel = time.time() - inicio_tunnel
+        registrar_etapa(metricas, 'tunnel', tempo_tunnel)
+
+        with medir_etapa(metricas, 'conexoes'):
+            conexoes = await conectar_bancos_async(bancos)
+        try:
+            with medir_etapa(metricas, '1_divergencias') as etapa:
+                divergencias = [Divergencia._make(row) for row in await conexoes['GESTÃO'].fetch(sql_base)]
+                etapa['linhas'] = len(divergencias)
+            if not divergencias:
+                return divergencias, set(), {}, tempo_tunnel
+
+            todos_cpfs = coletar_cpfs(divergencias)
+            with medir_etapa(metricas, '2-3_lookups_paralelos') as etapa:
+                cpfs_existentes_segurado, mapa_emails = await asyncio.gather(
+                    consultar_segurados_async(conexoes['CONTRATO'], todos_cpfs, opcoes),
+                    consultar_emails_async(conexoes['PESSOA'], todos_cpfs, opcoes)
+                )
+                etapa['linhas'] = len(todos_cpfs)
+        finally:
+            await fechar_conexoes_async(conexoes)
+    finally:
+        await loop.run_in_executor(None, pilha.close)
+
+    return divergencias, cpfs_existentes_segurado, mapa_emails, tempo_tunnel
+
+def concluir_execucao_async(checkpoint, cliente_nome, opcoes, resumo=None):
+    """
+    Marca como concluída a execução do cliente no registro de checkpoints. O registro é
+    reaberto aqui (conexão SQLite curta) para não ficar aberto durante as etapas de rede.
+    """
+    if not checkpoint:
+        return
+    checkpoint = abrir_checkpoints(cliente_nome, opcoes['dir_estado'], opcoes, id_execucao=checkpoint['id'], retomar=True)
+    concluir_checkpoint(checkpoint, resumo)
+    fechar_checkpoints(checkpoint, silent=True)
+
+async def processar_cliente_async(arquivo_env, porta_local, tunnel_compartilhado, limites, processos, sobrescritas=None):
+    """
+    Executa a análise de um cliente no pipeline assíncrono. As etapas de rede respeitam o
+    limite global de clientes e o limite por bastion; a classificação e o relatório vão
+    para o pool de processos, liberando as vagas de rede para o próximo cliente.
+
+    Returns:
+        resumo do cliente (mesmo formato de main em modo batch) ou None sem divergências
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    env = ambiente_cliente(arquivo_env, porta_local, tunnel_compartilhado)
+    DB_GESTAO, DB_CONTRATO, DB_PESSOA, SSH_CONFIG, SENHA_ACCOUNTS, URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER = carregar_configuracoes(env)
+    OPCOES = carregar_opcoes_execucao(env, sobrescritas)
+    cliente_nome = env.get('NOME_CLIENTE', 'CLIENTE')
+
+    bastion = (SSH_CONFIG['ssh_host'], SSH_CONFIG['ssh_port'])
+    limite_bastion = limites['bastions'].setdefault(bastion, asyncio.Semaphore(limites['por_bastion']))
+
+    if not cliente_suporta_async(OPCOES):
+        # Modos só do caminho síncrono: main() completo num processo, ainda dentro dos limites
+        async with limites['global'], limite_bastion:
+            return await loop.run_in_executor(
+                processos, processar_cliente_worker, arquivo_env, porta_local, tunnel_compartilhado, sobrescritas
+            )
+
+    metricas = iniciar_metricas(cliente_nome)
+
+    # CHECKPOINTS: sem etapas salvas neste caminho, mas o cliente já concluído no lote retomado é pulado
+    checkpoint = None
+    if not OPCOES['checkpoints'] and not OPCOES['retomar']:
+        descartar_checkpoints(cliente_nome, OPCOES['dir_estado'])
+    else:
+        checkpoint = abrir_checkpoints(
+            cliente_nome, OPCOES['dir_estado'], OPCOES,
+            id_execucao=OPCOES['id_execucao'], retomar=OPCOES['retomar']
+        )
+        if checkpoint['status'] == 'concluida':
+            print(f"   ⏭️  Execução {checkpoint['id']} de {cliente_nome} já concluída; nada a retomar.")
+            resumo = checkpoint['resumo']
+            fechar_checkpoints(checkpoint, silent=True)
+            if resumo:
+                return dict(resumo, tempo_tunnel=0.0, metricas=finalizar_metricas(metricas, status='ja_concluida'))
+            return None
+        fechar_checkpoints(checkpoint, silent=True)
+
+    bancos = {
+        rotulo: ajustar_hosts_para_tunnel(db, SSH_CONFIG)
+        for rotulo, db in [('GESTÃO', DB_GESTAO), ('CONTRATO', DB_CONTRATO), ('PESSOA', DB_PESSOA)]
+    }
+    sql_base = montar_sql_divergencias(
+        URL_ACCOUNTS, DB_ACCOUNTS_NAME_USER, SENHA_ACCOUNTS,
+        estrategia=OPCOES['estrategia_accounts'],
+        tamanho_bloco=OPCOES['tamanho_bloco_accounts']
+    )
+
+    async with limites['global'], limite_bastion:
+        divergencias, cpfs_existentes_segurado, mapa_emails, tempo_tunnel = await coletar_dados_cliente_async(
+            SSH_CONFIG, bancos, sql_base, OPCOES, metricas
+        )
+    if not divergencias:
+        concluir_execucao_async(checkpoint, cliente_nome, OPCOES)
+        return None
+
+    qtd, etapas = await loop.run_in_executor(
+        processos, classificar_e_exportar, cliente_nome, divergencias, cpfs_existentes_segurado, mapa_emails, OPCOES
+    )
+    metricas['etapas'].update(etapas)
+    finalizar_metricas(metricas)
+    resumo = {
+        'cliente': cliente_nome,
+        'emails_duplicados': qtd['email_duplicado'],
+        'um_cpf_inexistente': qtd['um_inexistente'],
+        'ambos_cpf_inexistentes': qtd['ambos_inexistentes'],
+        'outros_erros': qtd['outros'],
+        'documentos_invalidos': qtd['documento_invalido'],
+        'total_analisado': len(divergencias),
+        'tempo_tunnel': tempo_tunnel,
+        'metricas': metricas
+    }
+    # Relatório gerado: numa retomada do lote o cliente é pulado
+    concluir_execucao_async(checkpoint, cliente_nome, OPCOES, resumo)
+    return resumo
+
+def executar_lote_assincrono(lista_clientes, max_clientes, max_por_bastion, portas_compartilhadas=None,
+                             portas_reservadas=None, sobrescritas=None):
+    """
+    Processa o lote num único processo com asyncio: até `max_clientes` clientes (e até
+    `max_por_bastion` por bastion SSH) nas etapas de rede ao mesmo tempo. O tempo total
+    passa a ser limitado pela E/S, não pela soma das idas e voltas de cada cliente.
+
+    Returns:
+        (resultados_geral, resumos_clientes)
+    """
+    import asyncio
+
+    resultados_geral = []
+    resumos_clientes = []
+    portas_compartilhadas = portas_compartilhadas or {}
+    portas_reservadas = portas_reservadas if portas_reservadas is not None else set()
+
+    async def executar():
+        limites = {
+            'global': asyncio.Semaphore(max_clientes),
+            'por_bastion': max_por_bastion,
+            'bastions': {}
+        }
+
+        async def rodar(nome_cliente, arquivo_env, porta_local, compartilhado):
+            try:
+                return nome_cliente, await processar_cliente_async(
+                    arquivo_env, porta_local, compartilhado, limites, processos, sobrescritas
+                ), None
+            except Exception as e:
+                return nome_cliente, None, e
+
+        with ProcessPoolExecutor(max_workers=os.cpu_count() or 1) as processos:
+            tarefas = []
+            for nome_cliente, arquivo_env in lista_clientes:
+                if arquivo_env in portas_compartilhadas:
+                    tarefas.append(rodar(nome_cliente, arquivo_env, portas_compartilhadas[arquivo_env], True))
+                else:
+                    tarefas.append(rodar(nome_cliente, arquivo_env, obter_porta_livre(portas_reservadas), False))
+
+            for idx, tarefa in enumerate(asyncio.as_completed(tarefas), 1):
+                nome_cliente, resumo, erro = await tarefa
+                if erro is None:
+                    print(f"\n[{idx}/{len(lista_clientes)}] ✅ {nome_cliente}")
+                    if resumo:
+                        resumos_clientes.append(resumo)
+                        salvar_resumo_consolidado_lote(resumos_clientes, 'resumo_consolidado_lote.xlsx', silent=True)
+                    resultados_geral.append((nome_cliente, "✅ Sucesso"))
+                else:
+                    print(f"\n[{idx}/{len(lista_clientes)}] ❌ {nome_cliente}")
+                    print(f"      └─ Erro: {str(erro)[:100]}")
+                    resultados_geral.append((nome_cliente, f"❌ Erro: {str(erro)[:100]}"))
+
+    try:
+        asyncio.run(executar())
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Execução interrompida pelo usuário.")
+        print(f"   Clientes processados: {len(resultados_geral)}/{len(lista_clientes)}")
+
+    return resultados_geral, resumos_clientes
+
+def ambiente_cliente(arquivo_env, porta_local=None, tunnel_compartilhado=False):
+    """
+    Configuração de um cliente lida direto do .env, sem mexer em os.environ: no lote,
+    nenhuma opção de um cliente (MODO_*, FORMATO_SAIDA, ESTRATEGIA_*...) vaza para o próximo.
+
+    Args:
+        porta_local: porta do túnel deste cliente no lote (padrão: SSH_LOCAL_PORT do .env)
+        tunnel_compartilhado: o túnel já foi aberto pelo lote para o grupo do cliente
+    """
+    from dotenv import dotenv_values
+
+    env = dict(dotenv_values(arquivo_env))
+    if porta_local is not None:
+        env['SSH_LOCAL_PORT'] = str(porta_local)
+    if tunnel_compartilhado:
+        env['SSH_TUNNEL_COMPARTILHADO'] = 'S'
+    return env
+
+def carregar_ambiente_cliente(arquivo_env):
+    """
+    Limpa as variáveis do cliente anterior e carrega o .env do cliente em os.environ
+    (execução interativa de um único cliente; o lote usa ambiente_cliente).
+    """
+    from dotenv import load_dotenv
+
+    # Limpa variáveis de ambiente anteriores
+    for key in list(os.environ.keys()):
+        if key.startswith('DB_') or key.startswith('SSH_') or key == 'NOME_CLIENTE':
+            os.environ.pop(key, None)
+
+    # Carrega novo ambiente
+    load_dotenv(arquivo_env, override=True)
+
+# ============================================
+# MODOS DE EXECUÇÃO (LOTE / PREPARE / CLI)
+# ============================================
+def executar_lote(lista_clientes, num_workers=1, tunnel_compartilhado=False, sobrescritas=None, assincrono=False):
+    """
+    Executa a análise em lote para uma lista de clientes (sem confirmações).
+
+    Returns:
+        lista de (nome_cliente, status)
+    """
+    print("\n" + "="*70)
+    print(f"🚀 EXECUÇÃO EM LOTE: {len(lista_clientes)} CLIENTES")
+    print("="*70)
+    
+    inicio_lote = time.time()
+
+    # Destino das métricas do lote: .env do processo (não o de cada cliente) + linha de comando
+    try:
+        opcoes_lote = carregar_opcoes_execucao(os.environ, sobrescritas)
+    except ValueError:
+        opcoes_lote = carregar_opcoes_execucao({}, sobrescritas)
+
+    # Uma execução (id) para o lote inteiro; --resume continua o último lote e pula os clientes concluídos
+    id_execucao = opcoes_lote['id_execucao']
+    if opcoes_lote['retomar'] and not id_execucao:
+        id_execucao = ler_ultimo_lote(opcoes_lote['dir_estado'])
+        if id_execucao:
+            print(f"♻️  Retomando o lote {id_execucao}")
+        else:
+            print("⚠️  Nenhum lote anterior para retomar: iniciando um lote novo")
+    if opcoes_lote['retomar'] and assincrono:
+        print("⚠️  --resume com --async: as etapas dos clientes não são retomadas; "
+              "só os clientes já concluídos no lote são pulados.")
+    id_execucao = id_execucao or novo_id_execucao()
+    registrar_ultimo_lote(opcoes_lote['dir_estado'], id_execucao, lista_clientes)
+    sobrescritas = dict(sobrescritas or {}, id_execucao=id_execucao)
+
+    # Túneis compartilhados por bastion
+    pilha_tunnels = ExitStack()
+    portas_reservadas = set()
+    portas_compartilhadas = {}
+    if tunnel_compartilhado:
+        portas_compartilhadas = abrir_tunnels_compartilhados(lista_clientes, pilha_tunnels, portas_reservadas)
+
+    if assincrono:
+        # --paralelo N, se informado, vale como limite global de clientes simultâneos
+        max_clientes = num_workers if num_workers > 1 else opcoes_lote['async_max_clientes']
+        print(f"⚙️  Pipeline assíncrono: até {max_clientes} clientes simultâneos "
+              f"({opcoes_lote['async_max_por_bastion']} por bastion)")
+        resultados_geral, resumos_clientes = executar_lote_assincrono(
+            lista_clientes, max_clientes, opcoes_lote['async_max_por_bastion'],
+            portas_compartilhadas, portas_reservadas, sobrescritas
+        )
+    elif num_workers > 1:
+        print(f"⚙️  Processando até {num_workers} clientes em paralelo")
+        resultados_geral, resumos_clientes = executar_lote_paralelo(
+            lista_clientes, num_workers, portas_compartilhadas, portas_reservadas, sobrescritas
+        )
+    else:
         resultados_geral = []
         resumos_clientes = []  # Lista para armazenar resumos estatísticos
-        
-        for idx, (nome_cliente, arquivo_env) in enumerate(LISTA_CLIENTES, 1):
-            print(f"\n[{idx}/{len(LISTA_CLIENTES)}] 🔄 {nome_cliente}...", end=" ")
-            
-            # Limpa variáveis de ambiente anteriores
-            for key in list(os.environ.keys()):
-                if key.startswith('DB_') or key.startswith('SSH_') or key == 'NOME_CLIENTE':
-                    os.environ.pop(key, None)
-            
-            # Carrega novo ambiente
-            load_dotenv(arquivo_env, override=True)
-            
+
+        for idx, (nome_cliente, arquivo_env) in enumerate(lista_clientes, 1):
+            print(f"\n[{idx}/{len(lista_clientes)}] 🔄 {nome_cliente}...", end=" ")
+
             try:
-                # Executa análise em modo batch (sem confirmações)
-                resumo = main(modo_batch=True)
+                # Executa análise em modo batch (sem confirmações); falhas levantam exceção
+                env = ambiente_cliente(
+                    arquivo_env, portas_compartilhadas.get(arquivo_env), arquivo_env in portas_compartilhadas
+                )
+                resumo = main(modo_batch=True, env=env, sobrescritas=sobrescritas)
                 print("✅")
-                
+
                 # Armazena resumo estatístico
                 if resumo:
                     resumos_clientes.append(resumo)
-                
+
                 resultados_geral.append((nome_cliente, "✅ Sucesso"))
-                    
+
             except KeyboardInterrupt:
                 print("\n\n⚠️  Execução interrompida pelo usuário.")
-                print(f"   Clientes processados: {idx-1}/{len(LISTA_CLIENTES)}")
+                print(f"   Clientes processados: {idx-1}/{len(lista_clientes)}")
                 break
-            except Exception as e:
+            except (Exception, SystemExit) as e:
+                # gerenciar_tunnel_ssh encerra com sys.exit em falhas de túnel: só este cliente falha
+                erro = descrever_falha(e)
                 print(f"❌")
-                print(f"      └─ Erro: {str(e)[:100]}")
-                resultados_geral.append((nome_cliente, f"❌ Erro: {str(e)[:50]}"))
+                print(f"      └─ Erro: {erro[:100]}")
+                resultados_geral.append((nome_cliente, f"❌ Erro: {erro[:100]}"))
                 continue
-        
-        # Resumo final
-        tempo_total = time.time() - inicio_lote
-        minutos = int(tempo_total // 60)
-        segundos = int(tempo_total % 60)
-        
+
+    # Encerra os túneis compartilhados
+    pilha_tunnels.close()
+
+    # Resumo final
+    tempo_total = time.time() - inicio_lote
+    minutos = int(tempo_total // 60)
+    segundos = int(tempo_total % 60)
+    
+    print("\n" + "="*70)
+    print("📋 RESUMO DA EXECUÇÃO EM LOTE")
+    print("="*70)
+    for nome, status in resultados_geral:
+        print(f"  {status} - {nome}")
+    print("="*70)
+    print(f"\n✅ Processamento concluído: {len(resultados_geral)}/{len(lista_clientes)} clientes")
+    print(f"⏱️  Tempo total: {minutos}min {segundos}s")
+
+    # Tempo de setup do túnel por cliente (perto de zero quando compartilhado)
+    if resumos_clientes:
+        print("\n🔐 Setup do túnel SSH por cliente:")
+        for resumo in resumos_clientes:
+            print(f"  {resumo['cliente']}: {resumo['tempo_tunnel']:.2f}s")
+    
+    # Gera arquivo Excel consolidado com resumo estatístico de todos os clientes
+    if resumos_clientes:
         print("\n" + "="*70)
-        print("📋 RESUMO DA EXECUÇÃO EM LOTE")
-        print("="*70)
-        for nome, status in resultados_geral:
-            print(f"  {status} - {nome}")
+        salvar_resumo_consolidado_lote(resumos_clientes, 'resumo_consolidado_lote.xlsx')
         print("="*70)
-        print(f"\n✅ Processamento concluído: {len(resultados_geral)}/{len(LISTA_CLIENTES)} clientes")
-        print(f"⏱️  Tempo total: {minutos}min {segundos}s")
-        
-        # Gera arquivo Excel consolidado com resumo estatístico de todos os clientes
-        if resumos_clientes:
-            print("\n" + "="*70)
-            salvar_resumo_consolidado_lote(resumos_clientes, 'resumo_consolidado_lote.xlsx')
-            print("="*70)
-        
+
+    # Relatório de métricas do lote; clientes sem resumo entram com o status da execução
+    lista_metricas = [resumo['metricas'] for resumo in resumos_clientes]
+    clientes_com_metricas = {metricas['cliente'] for metricas in lista_metricas}
+    for nome, status in resultados_geral:
+        if nome not in clientes_com_metricas:
+            lista_metricas.append({
+                'cliente': nome,
+                'status': 'erro' if status.startswith("❌") else 'sem_resultado',
+                'etapas': {}
+            })
+    if lista_metricas:
+        salvar_relatorio_execucao(lista_metricas, opcoes_lote['dir_metricas'], opcoes_lote['metricas_prometheus'])
+
+    return resultados_geral
+
+def executar_prepare(lista_clientes, aplicar=False, confirmar=True):
+    """Executa o modo prepare (índices de CPF normalizado) para cada cliente."""
+    for nome_cliente, arquivo_env in lista_clientes:
+        preparar_indices(aplicar=aplicar, env=ambiente_cliente(arquivo_env), confirmar=confirmar)
+        print()
+
+def resolver_clientes(identificadores):
+    """
+    Resolve os clientes informados na linha de comando. Aceita o arquivo (.env.cliente),
+    o sufixo do arquivo (cliente) ou o NOME_CLIENTE (sem diferenciar maiúsculas).
+
+    Returns:
+        lista de (nome_cliente, arquivo_env)
+    """
+    clientes = listar_clientes()
+    selecionados = []
+    for identificador in identificadores:
+        alvo = identificador.strip().lower()
+        encontrados = [
+            (nome, arquivo) for nome, arquivo in clientes
+            if alvo in (arquivo.lower(), arquivo.lower().replace('.env.', ''), nome.lower())
+        ]
+        if not encontrados:
+            raise ValueError(f"Cliente não encontrado: {identificador}")
+        selecionados.extend(c for c in encontrados if c not in selecionados)
+    return selecionados
+
+def parse_argumentos(argv=None):
+    """Argumentos da linha de comando (sem argumentos: menu interativo)."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Diagnóstico de divergências de CPF entre GESTÃO e ACCOUNTS."
+    )
+    parser.add_argument('modo', nargs='?', choices=['analise', 'prepare'], default='analise',
+                        help="analise (padrão) ou prepare (índices de CPF normalizado)")
+    parser.add_argument('--cliente', action='append', default=[], metavar='CLIENTE',
+                        help="cliente a processar sem menu (arquivo .env, sufixo ou NOME_CLIENTE); pode repetir")
+    parser.add_argument('--todos', action='store_true',
+                        help="processa todos os clientes sem menu")
+    parser.add_argument('--formato', choices=['xlsx'] + FORMATOS_EM_LOTE, default=None,
+                        help="formato do relatório (padrão: FORMATO_SAIDA do .env ou xlsx)")
+    parser.add_argument('--paralelo', type=int, nargs='?', const=os.cpu_count() or 1, default=1, metavar='N',
+                        help="processa até N clientes em paralelo no lote")
+    parser.add_argument('--async', dest='assincrono', action='store_true',
+                        help="lote assíncrono (asyncio + asyncpg): etapas de rede de vários clientes ao mesmo tempo")
+    parser.add_argument('--sem-cache', action='store_true',
+                        help="ignora o cache de lookups (consulta tudo no banco e não grava)")
+    parser.add_argument('--renovar-cache', action='store_true',
+                        help="consulta tudo no banco e regrava o cache de lookups")
+    parser.add_argument('--resume', '--retomar', dest='retomar', nargs='?', const='', default=None,
+                        metavar='ID_EXECUCAO',
+                        help="retoma a última execução não concluída (ou ID_EXECUCAO) sem refazer as etapas salvas")
+    parser.add_argument('--metricas-prometheus', default=None, metavar='ARQUIVO',
+                        help="grava as métricas da execução neste textfile do Prometheus (.prom)")
+    parser.add_argument('--tunnel-compartilhado', action='store_true',
+                        help="abre um único túnel SSH por bastion + destino no lote")
+    parser.add_argument('--aplicar', action='store_true',
+                        help="prepare: cria os índices faltantes (pede confirmação)")
+    parser.add_argument('--sim', action='store_true',
+                        help="prepare: confirma a criação dos índices sem perguntar")
+    return parser.parse_args(argv)
+
+def cli(argv=None):
+    """
+    Ponto de entrada. Com --cliente/--todos roda sem interação (cron, containers);
+    sem eles, mantém o menu interativo de seleção de cliente.
+
+    Returns:
+        código de saída do processo
+    """
+    args = parse_argumentos(argv)
+    headless = bool(args.cliente or args.todos)
+
+    # Opções da linha de comando que prevalecem sobre o .env de cada cliente
+    sobrescritas = {}
+    if args.formato:
+        sobrescritas['formato_saida'] = args.formato
+    if args.sem_cache:
+        sobrescritas['cache_lookups'] = False
+    if args.renovar_cache:
+        sobrescritas['renovar_cache'] = True
+    if args.metricas_prometheus:
+        sobrescritas['metricas_prometheus'] = args.metricas_prometheus
+    if args.retomar is not None:
+        sobrescritas['retomar'] = True
+        if args.retomar:
+            sobrescritas['id_execucao'] = args.retomar
+    executar_em_lote = headless
+
+    if headless:
+        try:
+            lista_clientes = listar_clientes() if args.todos else resolver_clientes(args.cliente)
+        except ValueError as e:
+            print(f"❌ ERRO: {e}")
+            return 2
+        if not lista_clientes:
+            print("❌ ERRO: Nenhum arquivo de configuração encontrado!")
+            return 2
     else:
-        # Execução única para cliente selecionado
-        main()
\ No newline at end of file
+        # Seleciona o cliente pelo menu interativo
+        resultado_menu = exibir_menu_clientes()
+        if resultado_menu[0] == 'TODOS':
+            executar_em_lote = True
+            lista_clientes = resultado_menu[1]  # Lista de (nome, arquivo)
+        else:
+            env_file, nome_cliente = resultado_menu
+            lista_clientes = [(nome_cliente, env_file)]
+
+    if args.modo == 'prepare':
+        executar_prepare(lista_clientes, aplicar=args.aplicar, confirmar=not args.sim)
+        return 0
+
+    if executar_em_lote:
+        if args.assincrono and importlib.util.find_spec('asyncpg') is None:
+            print("❌ ERRO: --async requer o pacote asyncpg (pip install asyncpg)")
+            return 2
+        resultados = executar_lote(lista_clientes, args.paralelo, args.tunnel_compartilhado, sobrescritas,
+                                   assincrono=args.assincrono)
+        return 0 if all(status.startswith("✅") for _, status in resultados) else 1
+
+    # Execução única para cliente selecionado
+    carregar_ambiente_cliente(lista_clientes[0][1])
+    return 1 if main(sobrescritas=sobrescritas) is False else 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
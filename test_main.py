@@ -0,0 +1,223 @@
+import random
+import sys
+import threading
+import types
+import uuid
+
+import pytest
+
+import main
+
+CPFS_VALIDOS = ['52998224725', '11144477735', '39053344705']
+CNPJS_VALIDOS = ['11222333000181', '00394460005887', '11444777000161']
+DOCUMENTOS_INVALIDOS = [
+    None, '', '5299822472', '529982247250',   # tamanho errado
+    '52998224724', '52998224715',               # dígito verificador errado
+    '11222333000180', '11222333000191',
+    '00000000000', '11111111111', '99999999999999',  # sequências repetidas
+    '5299822472a', '529.982.247-25',            # não normalizado
+    '５２９９８２２４７２５',                    # dígitos não ASCII
+]
+
+
+def digito_referencia(digitos):
+    """Dígito verificador (módulo 11) calculado do jeito mais literal possível."""
+    if len(digitos) < 12:
+        # CPF: pesos decrescentes até 2
+        pesos = range(len(digitos) + 1, 1, -1)
+    else:
+        # CNPJ: pesos de 2 a 9 repetidos, da direita para a esquerda
+        pesos = [2 + i % 8 for i in range(len(digitos))][::-1]
+    resto = sum(int(d) * p for d, p in zip(digitos, pesos)) % 11
+    return '0' if resto < 2 else str(11 - resto)
+
+
+def documento_aleatorio(rng):
+    """CPF/CNPJ válido, com dígito trocado ou lixo qualquer, com a mesma chance."""
+    tamanho = rng.choice([11, 14])
+    base = ''.join(rng.choice('0123456789') for _ in range(tamanho - 2))
+    documento = base + digito_referencia(base)
+    documento += digito_referencia(documento)
+    sorteio = rng.random()
+    if sorteio < 0.4:
+        return documento
+    if sorteio < 0.7:
+        return documento[:-1] + str((int(documento[-1]) + 1) % 10)
+    return rng.choice([None, '', documento[:-1], documento + '0', documento[0] * tamanho, 'x' * tamanho])
+
+
+@pytest.mark.parametrize('documento', CPFS_VALIDOS + CNPJS_VALIDOS)
+def test_documento_valido_aceita_documentos_validos(documento):
+    assert main.documento_valido(documento)
+
+
+@pytest.mark.parametrize('documento', DOCUMENTOS_INVALIDOS)
+def test_documento_valido_rejeita_documentos_invalidos(documento):
+    assert not main.documento_valido(documento)
+
+
+def test_validar_documentos_vetorizado_conhecidos():
+    pytest.importorskip('numpy')
+    documentos = CPFS_VALIDOS + CNPJS_VALIDOS + DOCUMENTOS_INVALIDOS
+    esperado = [True] * (len(CPFS_VALIDOS) + len(CNPJS_VALIDOS)) + [False] * len(DOCUMENTOS_INVALIDOS)
+    assert main.validar_documentos_vetorizado(documentos).tolist() == esperado
+
+
+def test_validadores_concordam_com_referencia():
+    pytest.importorskip('numpy')
+    rng = random.Random(7)
+    documentos = [documento_aleatorio(rng) for _ in range(5000)]
+    referencia = [
+        bool(d) and d.isdigit() and len(d) in (11, 14) and len(set(d)) > 1
+        and d[-2] == digito_referencia(d[:-2]) and d[-1] == digito_referencia(d[:-1])
+        for d in documentos
+    ]
+    assert [main.documento_valido(d) for d in documentos] == referencia
+    assert main.validar_documentos_vetorizado(documentos).tolist() == referencia
+
+
+def test_normalizar_documentos():
+    assert main.normalizar_documentos(['529.982.247-25', None, '11.222.333/0001-81', '']) == [
+        '52998224725', None, '11222333000181', ''
+    ]
+
+
+def test_motores_de_classificacao_equivalentes():
+    pytest.importorskip('numpy')
+    rng = random.Random(11)
+    cpfs = [documento_aleatorio(rng) or '' for _ in range(300)]
+    divergencias = []
+    for i in range(3000):
+        cpf_acc, cpf_ges = rng.sample(cpfs, 2)
+        divergencias.append(main.Divergencia(f'id-{i}', f'acc {cpf_acc}', f'ges {cpf_ges}', cpf_acc, cpf_ges))
+    segurados = set(rng.sample(cpfs, 150))
+    emails = ['a@x.com', 'b@x.com', 'c@x.com']
+    mapa_emails = {cpf: rng.choice(emails) for cpf in rng.sample(cpfs, 200)}
+
+    listas_python = {chave: [] for chave in main.ABAS_RELATORIO}
+    listas_vetorizado = {chave: [] for chave in main.ABAS_RELATORIO}
+    main.classificar_divergencias(divergencias, segurados, mapa_emails, listas_python)
+    main.classificar_divergencias_vetorizado(divergencias, segurados, mapa_emails, listas_vetorizado)
+
+    assert listas_python == listas_vetorizado
+    assert all(listas_python[chave] for chave in main.ABAS_RELATORIO)
+    assert sum(len(lista) for lista in listas_python.values()) == len(divergencias)
+
+
+def test_estrategias_de_emails_compartilhados_equivalentes():
+    rng = random.Random(5)
+    # Variantes de caixa e espaço nas pontas, e também \r, \n, tab e aspas dentro do valor
+    brutos = ['Ana@X.com', ' ana@x.com ', 'ANA@X.COM', 'bia@x.com', 'Bia@x.com  ', 'c\r@x.com',
+              'c\r@X.com', 'd\n"e"@x.com', 'f\t@x.com', 'unico@x.com']
+    pares = []
+    for _ in range(4000):
+        # Mesma normalização de sql_emails_contato: LOWER(BTRIM(valor))
+        email = rng.choice(brutos).strip(' ').lower()
+        pares.append((email, f'{rng.randrange(60):011d}'))
+    pares.append(('so-um-cpf@x.com', '00000000001'))
+
+    lotes_ordenados = [sorted(pares)[i:i + 333] for i in range(0, len(pares), 333)]
+    lotes_hash = [pares[i:i + 333] for i in range(0, len(pares), 333)]
+    ordenado = list(main.agrupar_emails_ordenados(lotes_ordenados))
+    particionado = list(main.agrupar_emails_particionados(lotes_hash, 4))
+
+    assert sorted(ordenado) == sorted(particionado)
+    emails = {linha.email for linha in ordenado}
+    assert emails == {'ana@x.com', 'bia@x.com', 'c\r@x.com', 'd\n"e"@x.com', 'f\t@x.com', 'unico@x.com'}
+    assert all(linha.qtd_cpfs > 1 for linha in ordenado)
+
+
+class FalhaConexao(Exception):
+    pass
+
+
+def psycopg2_falso(linhas, fetchmany):
+    """psycopg2 mínimo: cursor nomeado que filtra `linhas` pela faixa recebida como "SQL"."""
+    modulo = types.ModuleType('psycopg2')
+    modulo.OperationalError = modulo.InterfaceError = FalhaConexao
+
+    class Cursor:
+        itersize = 0
+
+        def execute(self, faixa):
+            inicio, fim = faixa
+            self.linhas = [l for l in linhas if l[0] >= inicio and (fim is None or l[0] < fim)]
+            self.posicao = 0
+
+        def fetchmany(self, n):
+            return fetchmany(self, n)
+
+        def close(self):
+            pass
+
+    class Conexao:
+        cancelada = threading.Event()
+
+        def cursor(self, name=None):
+            cursor = Cursor()
+            cursor.conexao = self
+            return cursor
+
+        def cancel(self):
+            self.cancelada.set()
+
+        def close(self):
+            pass
+
+    modulo.connect = lambda **kwargs: Conexao()
+    modulo.Conexao = Conexao
+    return modulo
+
+
+def ler_lote(cursor, n):
+    lote = cursor.linhas[cursor.posicao:cursor.posicao + n]
+    cursor.posicao += n
+    return lote
+
+
+def test_particao_que_cai_no_meio_nao_perde_nem_repete_linhas(monkeypatch):
+    rng = random.Random(3)
+    ids = sorted(str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(3000))
+    # Vários ids com mais de uma linha: a retomada não pode partir um grupo ao meio
+    linhas = [(i, 'acc', 'ges', 'a', str(k)) for i in ids for k in range(rng.choice([1, 1, 1, 2, 3]))]
+    quedas = []
+
+    def fetchmany(cursor, n):
+        if cursor.posicao > 0 and len(quedas) < 6 and rng.random() < 0.3:
+            quedas.append(cursor.posicao)
+            raise FalhaConexao('server closed the connection unexpectedly')
+        return ler_lote(cursor, n)
+
+    monkeypatch.setitem(sys.modules, 'psycopg2', psycopg2_falso(linhas, fetchmany))
+    monkeypatch.setattr(main.time, 'sleep', lambda segundos: None)
+    opcoes = {'particoes_divergencias': 4, 'tamanho_lote': 37, 'particoes_tentativas': 10}
+
+    saida = [tuple(d) for lote in main.gerar_lotes_divergencias_particionado({}, lambda f: f, opcoes) for d in lote]
+
+    assert quedas
+    assert sorted(saida) == sorted(linhas)
+
+
+def test_erro_numa_particao_cancela_fetch_das_outras(monkeypatch):
+    linhas = [(str(uuid.UUID(int=i << 120)), 'acc', 'ges', 'a', 'g') for i in range(256)]
+
+    def fetchmany(cursor, n):
+        inicio = cursor.linhas[0][0] if cursor.linhas else None
+        if inicio == linhas[0][0]:
+            raise RuntimeError('erro na partição')
+        # As demais ficam presas num fetch longo até a query ser cancelada
+        assert cursor.conexao.cancelada.wait(10)
+        raise FalhaConexao('canceling statement due to user request')
+
+    psycopg2 = psycopg2_falso(linhas, fetchmany)
+    monkeypatch.setitem(sys.modules, 'psycopg2', psycopg2)
+    opcoes = {'particoes_divergencias': 4, 'tamanho_lote': 10, 'particoes_tentativas': 3}
+
+    with pytest.raises(RuntimeError, match='erro na partição'):
+        list(main.gerar_lotes_divergencias_particionado({}, lambda f: f, opcoes))
+    assert psycopg2.Conexao.cancelada.is_set()
+
+
+def test_modo_federado_recusa_particoes():
+    with pytest.raises(ValueError, match='PARTICOES_DIVERGENCIAS'):
+        main.carregar_opcoes_execucao({'MODO_FEDERADO': 'S', 'PARTICOES_DIVERGENCIAS': '4'})